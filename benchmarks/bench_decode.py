@@ -0,0 +1,85 @@
+'''
+Benchmark the decoding of provider responses.
+
+Times OEmbedResponse.newFromJSON and OEmbedEndpoint.parse on bodies of
+several sizes, with the standard json module and with every optional JSON
+backend installed (simplejson, ujson, orjson).
+
+Usage:
+
+    python benchmarks/bench_decode.py [seconds]
+'''
+import importlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oembed
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def payload(size):
+    data = {'type': 'video', 'version': '1.0', 'title': 'A resource',
+            'author_name': 'author', 'author_url': 'http://example.com/user',
+            'provider_name': 'Example', 'provider_url': 'http://example.com/',
+            'cache_age': 3600, 'width': 640, 'height': 480,
+            'thumbnail_url': 'http://example.com/thumb.jpg',
+            'thumbnail_width': 120, 'thumbnail_height': 90,
+            'html': '<iframe src="http://example.com/embed/1"></iframe>'}
+    data['html'] += ' ' * max(0, size - len(json.dumps(data)))
+    return json.dumps(data).encode('utf8')
+
+
+def rate(fn, seconds):
+    fn()
+    count = 0
+    start = _timer()
+    while True:
+        for i in range(100):
+            fn()
+        count += 100
+        elapsed = _timer() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def backends():
+    yield 'json', None
+    for name in ('simplejson', 'ujson', 'orjson'):
+        try:
+            yield name, importlib.import_module(name).loads
+        except ImportError:
+            pass
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 0.5
+    endpoint = oembed.OEmbedEndpoint('http://example.com/oembed')
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+    print('%-28s %10s %14s' % ('benchmark', 'size', 'ops/s'))
+    for name, loads in backends():
+        if loads is not None:
+            if not hasattr(oembed, 'setJSONDecoder'):
+                continue
+            oembed.setJSONDecoder(loads)
+        try:
+            for size in (512, 4096, 65536):
+                raw = payload(size)
+                print('%-28s %10d %14.0f' % (
+                    'newFromJSON/' + name, size,
+                    rate(lambda: oembed.OEmbedResponse.newFromJSON(raw),
+                         seconds)))
+                print('%-28s %10d %14.0f' % (
+                    'parse/' + name, size,
+                    rate(lambda: endpoint.parse(headers, raw), seconds)))
+        finally:
+            if loads is not None:
+                oembed.setJSONDecoder(None)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,63 @@
+'''
+Benchmark url dispatch as the number of url schemes grows.
+
+Compares the indexed OEmbedConsumer._endpointFor against a linear scan of
+the endpoints for urls that hit the first endpoint, the last endpoint and
+no endpoint at all.
+
+Usage:
+
+    python benchmarks/bench_dispatch.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oembed
+
+
+def buildConsumer(providers):
+    consumer = oembed.OEmbedConsumer()
+    for i in range(providers):
+        consumer.addEndpoint(oembed.OEmbedEndpoint(
+            'http://provider%d.com/oembed' % i,
+            ['http://*.provider%d.com/*' % i,
+             'http://provider%d.com/video/*' % i,
+             'https://provider%d.com/photo/*' % i,
+             'http://p%d.sh/*' % i]))
+    return consumer
+
+
+def linearLookup(consumer, url):
+    for endpoint in consumer.getEndpoints():
+        if endpoint.match(url):
+            return endpoint
+    return None
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main():
+    print('%8s %8s %14s %14s' % ('schemes', 'url', 'linear (us)', 'index (us)'))
+    for providers in (10, 100, 1000, 5000):
+        consumer = buildConsumer(providers)
+        urls = {
+            'first': 'http://www.provider0.com/photos/1/',
+            'last': 'http://provider%d.com/video/1' % (providers - 1),
+            'miss': 'http://www.nowhere.org/photos/1/',
+        }
+        consumer._endpointFor(urls['miss'])
+        number = max(10, 20000 // providers)
+        for name, url in sorted(urls.items()):
+            linear = bench(lambda: linearLookup(consumer, url), number)
+            indexed = bench(lambda: consumer._endpointFor(url), 2000)
+            print('%8d %8s %14.2f %14.2f' % (providers * 4, name,
+                                             linear * 1e6, indexed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''
+Benchmark the startup cost of loading a large provider list.
+
+Compares compiling every scheme up front, adding endpoints one by one
+with lazily compiled schemes, loading a providers.json document
+and loading a saved index file, followed by a first lookup.
+
+Usage:
+
+    python benchmarks/bench_load.py [providers]
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oembed
+
+
+def providers(count):
+    return [{'provider_name': 'Provider %d' % i,
+             'provider_url': 'http://provider%d.com/' % i,
+             'endpoints': [{'url': 'http://provider%d.com/oembed' % i,
+                            'schemes': ['http://*.provider%d.com/*' % i,
+                                        'http://provider%d.com/video/*' % i,
+                                        'https://provider%d.com/photo/*' % i,
+                                        'http://p%d.sh/*' % i]}]}
+            for i in range(count)]
+
+
+def timed(fn):
+    start = time.time()
+    consumer = fn()
+    consumer._endpointFor('http://www.nowhere.org/')
+    return time.time() - start
+
+
+def addOneByOne(data):
+    consumer = oembed.OEmbedConsumer()
+    for provider in data:
+        for spec in provider['endpoints']:
+            endpoint = oembed.OEmbedEndpoint(spec['url'])
+            for urlScheme in spec['schemes']:
+                endpoint.addUrlScheme(urlScheme)
+            consumer.addEndpoint(endpoint)
+    return consumer
+
+
+def addEager(data):
+    # Previous behaviour: every regex compiled when the scheme is added.
+    consumer = addOneByOne(data)
+    for endpoint in consumer.getEndpoints():
+        for urlScheme in endpoint.getUrlSchemes().values():
+            urlScheme.match('')
+    return consumer
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    data = providers(count)
+    tmp = tempfile.mkdtemp()
+    try:
+        providersPath = os.path.join(tmp, 'providers.json')
+        indexPath = os.path.join(tmp, 'index.json')
+        with open(providersPath, 'w') as f:
+            f.write(oembed.json_encode(data))
+        addOneByOne(data).saveIndex(indexPath)
+
+        def loadProviders():
+            consumer = oembed.OEmbedConsumer()
+            consumer.loadProvidersFile(providersPath)
+            return consumer
+
+        def loadIndex():
+            consumer = oembed.OEmbedConsumer()
+            consumer.loadIndex(indexPath)
+            return consumer
+
+        print('%d providers, %d schemes' % (count, count * 4))
+        for name, fn in (('eager compile', lambda: addEager(data)),
+                         ('addEndpoint', lambda: addOneByOne(data)),
+                         ('loadProvidersFile', loadProviders),
+                         ('loadIndex', loadIndex)):
+            print('%-18s %8.1f ms' % (name, timed(fn) * 1000))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Benchmark the memory used by OEmbedResponse objects.
+
+Compares the slot-based responses with the previous representation, which
+kept every field in a per-instance dict.
+
+Usage:
+
+    python benchmarks/bench_memory.py [count]
+'''
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oembed
+
+
+class DictResponse(object):
+    '''The response representation used before slots.'''
+    def loadData(self, data):
+        self._data = data
+
+
+def payloads(count):
+    for i in range(count):
+        kind = ('photo', 'video', 'rich', 'link')[i % 4]
+        data = {'type': kind, 'version': '1.0',
+                'title': 'Resource number %d' % i,
+                'author_name': 'author%d' % (i % 100),
+                'author_url': 'http://example.com/user/%d' % (i % 100),
+                'provider_name': 'Example', 'provider_url': 'http://example.com/',
+                'cache_age': 3600, 'width': 640, 'height': 480,
+                'thumbnail_url': 'http://example.com/thumb/%d.jpg' % i,
+                'thumbnail_width': 120, 'thumbnail_height': 90}
+        if kind == 'photo':
+            data['url'] = 'http://example.com/photo/%d.jpg' % i
+        elif kind != 'link':
+            data['html'] = '<iframe src="http://example.com/embed/%d"></iframe>' % i
+        # Decoded JSON gives every response its own copy of the strings.
+        yield dict((k, v[:1] + v[1:] if isinstance(v, str) else v)
+                   for k, v in data.items())
+
+
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    responses = [build(data) for data in payloads(count)]
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del responses
+    return current
+
+
+def buildDict(data):
+    response = DictResponse()
+    response.loadData(data)
+    return response
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    legacy = measure(buildDict, count)
+    compact = measure(oembed.OEmbedResponse.createLoad, count)
+    print('%d responses' % count)
+    print('%-10s %12s %16s' % ('', 'total (MB)', 'per response (B)'))
+    for name, size in (('dict', legacy), ('slots', compact)):
+        print('%-10s %12.1f %16.0f' % (name, size / 1e6, float(size) / count))
+    print('saving: %.0f%%' % (100.0 * (legacy - compact) / legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+'''
+Performance benchmark suite for python-oembed.
+
+Measures url matching, response parsing and end-to-end embedding against a
+local provider, reporting p50/p99 latency and operations per second. Results
+can be saved as JSON and compared with a previous run.
+
+Usage:
+
+    python benchmarks/suite.py [--quick] [--filter TEXT]
+                               [--output results.json]
+                               [--compare baseline.json]
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer # Python 3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer # Python 2
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import oembed
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def measure(fn, samples, batch=1):
+    '''
+    Time a callable, one call at a time so that the percentiles show the
+    tail of its latency. Each timing includes the overhead of reading the
+    timer, which matters only for calls of well under a microsecond.
+
+    Args:
+        fn: The callable to time.
+        samples: Number of timings to take.
+        batch: Multiplier of samples, for operations fast enough to need
+               more calls.
+
+    Returns:
+        A dict with the p50 and p99 latency in microseconds, the number of
+        operations per second and the number of operations run.
+    '''
+    fn()
+    times = []
+    for i in range(samples * batch):
+        start = _timer()
+        fn()
+        times.append(_timer() - start)
+    return summarize(times)
+
+
+def summarize(times):
+    times = sorted(times)
+    total = sum(times)
+    return {'p50_us': times[len(times) // 2] * 1e6,
+            'p99_us': times[min(len(times) - 1, int(len(times) * 0.99))] * 1e6,
+            'ops_per_sec': len(times) / total if total else float('inf'),
+            'n': len(times)}
+
+
+# Matching
+
+def buildConsumer(providers):
+    consumer = oembed.OEmbedConsumer()
+    for i in range(providers):
+        consumer.addEndpoint(oembed.OEmbedEndpoint(
+            'http://provider%d.com/oembed' % i,
+            ['http://*.provider%d.com/*' % i,
+             'http://provider%d.com/video/*' % i,
+             'https://provider%d.com/photo/*' % i,
+             'regex:https?://p%d\\.sh/\\w+' % i]))
+    return consumer
+
+
+def benchMatching(scale):
+    results = {}
+    scheme = oembed.OEmbedUrlScheme('http://*.flickr.com/*')
+    url = 'http://www.flickr.com/photos/wizardbt/2584979382/'
+    results['match/scheme/hit'] = measure(lambda: scheme.match(url),
+                                          200 * scale, 100)
+    results['match/scheme/miss'] = measure(
+        lambda: scheme.match('http://www.vimeo.com/1'), 200 * scale, 100)
+
+    canonicalizer = oembed.OEmbedCanonicalizer()
+    results['match/canonicalize'] = measure(
+        lambda: canonicalizer.canonicalize(url + '?utm_source=feed&id=1'),
+        200 * scale, 100)
+
+    for providers in (10, 100, 1000):
+        consumer = buildConsumer(providers)
+        urls = (('first', 'http://www.provider0.com/photos/1/'),
+                ('last', 'https://provider%d.com/photo/1' % (providers - 1)),
+                ('regex', 'http://p%d.sh/abc' % (providers - 1)),
+                ('miss', 'http://www.nowhere.org/photos/1/'))
+        for name, url in urls:
+            results['match/endpointFor/%d/%s' % (providers * 4, name)] = \
+                measure(lambda: consumer._endpointFor(url), 50 * scale, 20)
+    return results
+
+
+# Parsing
+
+def payload(size):
+    data = {'type': 'rich', 'version': '1.0', 'title': 'A resource',
+            'provider_name': 'Example', 'width': 640, 'height': 480,
+            'html': '<div>%s</div>' % ('x' * max(0, size - 150))}
+    raw = json.dumps(data).encode('utf8')
+    xml = ('<?xml version="1.0" encoding="utf-8"?><oembed>%s</oembed>' %
+           ''.join(['<%s>%s</%s>' % (k, str(v).replace('<', '&lt;'), k)
+                    for k, v in data.items()])).encode('utf8')
+    return raw, xml
+
+
+def benchParsing(scale):
+    results = {}
+    for size in (256, 4096, 65536, 524288):
+        raw, xml = payload(size)
+        samples = max(10, scale * 200 // (1 + size // 4096))
+        results['parse/json/%d' % size] = measure(
+            lambda: oembed.OEmbedResponse.newFromJSON(raw), samples, 10)
+        results['parse/xml/%d' % size] = measure(
+            lambda: oembed.OEmbedResponse.newFromXML(xml), samples, 10)
+    return results
+
+
+# End to end
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which would otherwise stall
+    # every keep-alive response on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        query = dict(parse_qsl(urlparse(self.path).query))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = json.dumps({'type': 'photo', 'version': '1.0',
+                           'url': query.get('url'), 'width': 640,
+                           'height': 480}).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubProvider(object):
+    '''A local provider answering every request after a fixed delay.'''
+
+    def __init__(self, delay=0):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.delay = delay
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/oembed' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def benchEmbed(scale):
+    results = {}
+    for delay in (0, 0.005):
+        provider = StubProvider(delay)
+        try:
+            consumer = oembed.OEmbedConsumer()
+            consumer.addEndpoint(oembed.OEmbedEndpoint(
+                provider.url, ['http://example.com/*']))
+            counter = iter(range(10 ** 9))
+            name = 'embed/%dms' % (delay * 1000)
+
+            results[name + '/sequential'] = measure(
+                lambda: consumer.embed('http://example.com/%d' % next(counter)),
+                20 * scale)
+
+            count = 40 * scale
+            urls = ['http://example.com/batch/%d' % i for i in range(count)]
+            start = _timer()
+            responses = consumer.embedMany(urls, workers=8, maxPerEndpoint=8)
+            elapsed = _timer() - start
+            assert not [r for r in responses if isinstance(r, Exception)]
+            # Calls overlap, so only the throughput is meaningful; latency
+            # percentiles are left out.
+            results[name + '/embedMany8'] = {
+                'p50_us': None, 'p99_us': None,
+                'ops_per_sec': count / elapsed, 'n': count}
+
+            consumer.setCache(oembed.OEmbedMemoryCache())
+            consumer.embed('http://example.com/cached')
+            results[name + '/cached'] = measure(
+                lambda: consumer.embed('http://example.com/cached'),
+                100 * scale, 10)
+        finally:
+            provider.stop()
+    return results
+
+
+SUITES = (('matching', benchMatching),
+          ('parsing', benchParsing),
+          ('embed', benchEmbed))
+
+
+def compare(results, baseline):
+    print('')
+    print('%-40s %12s %12s %8s' % ('benchmark', 'base ops/s', 'ops/s', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['ops_per_sec']
+        new = results[name]['ops_per_sec']
+        print('%-40s %12.0f %12.0f %+7.1f%%' % (name, old, new,
+                                                100.0 * (new - old) / old))
+
+
+def formatLatency(value):
+    return '' if value is None else '%.2f' % value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--quick', action='store_true',
+                        help='run fewer iterations')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains TEXT')
+    parser.add_argument('--output', help='save the results to a JSON file')
+    parser.add_argument('--compare', help='compare with a saved JSON file')
+    args = parser.parse_args(argv)
+
+    scale = 1 if args.quick else 10
+    results = {}
+    for name, suite in SUITES:
+        if args.filter and args.filter not in name:
+            continue
+        results.update(suite(scale))
+
+    print('%-40s %12s %12s %12s' % ('benchmark', 'p50 (us)', 'p99 (us)', 'ops/s'))
+    for name in sorted(results):
+        r = results[name]
+        print('%-40s %12s %12s %12.0f' % (name, formatLatency(r['p50_us']),
+                                          formatLatency(r['p99_us']),
+                                          r['ops_per_sec']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'quick': args.quick},
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -63,7 +63,70 @@ try:
 except ImportError:
     import urllib2 # Python 2
 
+try:
+    from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl # Python 3
+except ImportError:
+    from urlparse import urlsplit, urlunsplit, urljoin, parse_qsl # Python 2
+
+try:
+    from html.parser import HTMLParser # Python 3
+except ImportError:
+    from HTMLParser import HTMLParser # Python 2
+
+try:
+    import http.client as httplib # Python 3
+except ImportError:
+    import httplib # Python 2
+
+from email.utils import parsedate_tz, mktime_tz
+from io import BytesIO as _BytesIO
+import codecs
+import errno
+import os
+import random
 import re
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+try:
+    import queue as Queue # Python 3
+except ImportError:
+    import Queue # Python 2
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None # Python built without SQLite support
+
+# Monotonic clock used for expiry times; time.monotonic is Python 3 only.
+_clock = getattr(time, 'monotonic', time.time)
+
+# Python 2 can only intern byte strings, which are its str type.
+_intern = getattr(sys, 'intern', None) or intern
+
+# Marks fields missing from a response.
+_missing = object()
+
+# Size of the blocks read from response bodies.
+_CHUNK_SIZE = 16 * 1024
+
+# Characters allowed in the host part of a url; also used to split urls into
+# the runs searched by the endpoint index.
+_HOST_CHARS = 'A-Za-z0-9._-'
+_REGEX_SPECIAL = frozenset('\\^$+?{}[]()|')
+# Special characters making the character before them optional or repeated.
+_QUANTIFIERS = frozenset('?+{')
+# Constructs that refer to other groups of a pattern.
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+_DEFAULT_FLAGS = re.compile('').flags
+_SCHEME_HOST = re.compile(r'[A-Za-z0-9.-]*://[%s]+' % _HOST_CHARS)
+_SCHEME_HOST_END = re.compile(r'([A-Za-z0-9.-]*://[%s]+)[/:?#]' % _HOST_CHARS)
+_HOST_SUFFIX_END = re.compile(r'(\.[%s]+)[/:?#]' % _HOST_CHARS)
+_HOST_RUN = re.compile(r'[%s]+' % _HOST_CHARS)
 
 # json module is in the standard library as of python 2.6; fall back to
 # simplejson if present for older versions.
@@ -90,6 +153,31 @@ except Exception:
                     "http://pypi.python.org/pypi/simplejson/")
             json_encode = json_decode
 
+if (3, 0) <= sys.version_info < (3, 6):
+    def _defaultJSONDecode(raw):
+        # json.loads only takes bytes as of Python 3.6
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf8')
+        return json_decode(raw)
+else:
+    _defaultJSONDecode = json_decode
+
+_jsonDecode = _defaultJSONDecode
+
+
+def setJSONDecoder(decode):
+    '''
+    Override the function decoding JSON responses, e.g. with orjson.loads
+    or ujson.loads. The json module of the standard library is used by
+    default.
+
+    Args:
+        decode: A callable taking a JSON document as UTF-8 bytes and
+                returning a dict, or None for the default.
+    '''
+    global _jsonDecode
+    _jsonDecode = decode or _defaultJSONDecode
+
 try:
     from xml.etree import cElementTree as etree
 except ImportError:
@@ -106,6 +194,18 @@ class OEmbedInvalidRequest(OEmbedError):
 class OEmbedNoEndpoint(OEmbedError):
     '''Raised when no endpoint is available for a particular URL'''
 
+class OEmbedResponseTooLarge(OEmbedError):
+    '''Raised when a provider response exceeds the maximum allowed size'''
+
+class OEmbedProviderUnavailable(OEmbedError):
+    '''Raised without contacting a provider while its circuit breaker is open'''
+
+class OEmbedTimeout(OEmbedError):
+    '''Raised when an embed does not complete within its deadline'''
+
+class OEmbedRateLimited(OEmbedError):
+    '''Raised when a request would wait too long for its provider rate limit'''
+
 
 class OEmbedResponse(object):
     '''
@@ -114,19 +214,67 @@ class OEmbedResponse(object):
     This class provides a factory of OEmbed responses according to the format
     detected in the type field. It also validates that mandatory fields are
     present.
+
+    Responses are stored compactly: the standard fields of each response type
+    live in slots and only non-standard fields use a dict.
     '''
+    __slots__ = ('type', 'version', 'title', 'author_name', 'author_url',
+                 'provider_name', 'provider_url', 'cache_age',
+                 'thumbnail_url', 'thumbnail_width', 'thumbnail_height',
+                 '_extra', '_etag', '_lastModified')
+
+    # Standard fields of this response type, stored in slots.
+    _fields = __slots__[:-3]
+    _fieldSet = frozenset(_fields)
+
+    # Fields whose values are shared by many responses.
+    _interned = frozenset(['type', 'version', 'provider_name', 'provider_url'])
+
+    def __init__(self):
+        self._extra = None
+        # HTTP validators of the fetched response, to revalidate it.
+        self._etag = None
+        self._lastModified = None
+
     def _validateData(self, data):
         pass
 
     def __getitem__(self, name):
-        return self._data.get(name)
+        if name in self._fieldSet:
+            return getattr(self, name, None)
+        if self._extra is not None:
+            return self._extra.get(name)
+        return None
 
     def getData(self):
-        return self._data
+        data = {}
+        for name in self._fields:
+            value = getattr(self, name, _missing)
+            if value is not _missing:
+                data[name] = value
+        if self._extra is not None:
+            data.update(self._extra)
+        return data
 
     def loadData(self, data):
         self._validateData(data)
-        self._data = data
+        for name in self._fields:
+            if hasattr(self, name):
+                delattr(self, name)
+        self._extra = None
+        self._load(data)
+
+    def _load(self, data):
+        # Set the fields of data on a response that has none yet.
+        for name, value in data.items():
+            if name in self._fieldSet:
+                if name in self._interned and type(value) is str:
+                    value = _intern(value)
+                setattr(self, name, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[name] = value
 
     @classmethod
     def createLoad(cls, data):
@@ -134,7 +282,8 @@ class OEmbedResponse(object):
            not 'version' in data:
             raise OEmbedError('Missing required fields on OEmbed response.')
         response = cls.create(data['type'])
-        response.loadData(data)
+        response._validateData(data)
+        response._load(data)
         return response
 
     @classmethod
@@ -143,21 +292,67 @@ class OEmbedResponse(object):
 
     @classmethod
     def newFromJSON(cls, raw):
-        data = json_decode(raw)
-        return cls.createLoad(data)
+        '''
+        Create a response from a JSON document.
+
+        Args:
+            raw: The document as a string, or an iterable of string chunks.
+        '''
+        return cls.createLoad(cls._decodeJSON(raw))
 
     @classmethod
     def newFromXML(cls, raw):
-        elem = etree.XML(raw)
-        data = dict([(e.tag, e.text) for e in elem.getiterator() \
-                    if e.tag not in ['oembed']])
-        return cls.createLoad(data)
+        '''
+        Create a response from an XML document.
+
+        Args:
+            raw: The document as a string, or an iterable of string chunks.
+                 Chunks are parsed as they are produced.
+        '''
+        return cls.createLoad(cls._decodeXML(raw))
+
+    @staticmethod
+    def _decodeJSON(raw):
+        if not isinstance(raw, (bytes, type(u''))):
+            chunks = list(raw)
+            # Joined with the type of the chunks, bytes or text.
+            raw = chunks[0][:0].join(chunks) if chunks else b''
+        return _jsonDecode(raw)
+
+    @staticmethod
+    def _decodeXML(raw):
+        if isinstance(raw, (bytes, type(u''))):
+            raw = (raw,)
+        data = {}
+        for event, elem in etree.iterparse(_ChunkFile(raw)):
+            if elem.tag not in ['oembed']:
+                data[elem.tag] = elem.text
+            elem.clear()
+        return data
+
+
+class _ChunkFile(object):
+    '''A file-like object reading from an iterable of string chunks.'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        # An empty chunk would read as the end of the file.
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        return b''
 
 
 class OEmbedPhotoResponse(OEmbedResponse):
     '''
     This type is used for representing static photos.
     '''
+    __slots__ = ('url', 'width', 'height')
+    _fields = OEmbedResponse._fields + __slots__
+    _fieldSet = frozenset(_fields)
+
     def _validateData(self, data):
         OEmbedResponse._validateData(self, data)
 
@@ -170,6 +365,10 @@ class OEmbedVideoResponse(OEmbedResponse):
     '''
     This type is used for representing playable videos.
     '''
+    __slots__ = ('html', 'width', 'height')
+    _fields = OEmbedResponse._fields + __slots__
+    _fieldSet = frozenset(_fields)
+
     def _validateData(self, data):
         OEmbedResponse._validateData(self, data)
 
@@ -185,12 +384,17 @@ class OEmbedLinkResponse(OEmbedResponse):
     parameters. The consumer may then link to the resource, using the URL
     specified in the original request.
     '''
+    __slots__ = ()
 
 class OEmbedRichResponse(OEmbedResponse):
     '''
     This type is used for rich HTML content that does not fall under
     one of the other categories.
     '''
+    __slots__ = ('html', 'width', 'height')
+    _fields = OEmbedResponse._fields + __slots__
+    _fieldSet = frozenset(_fields)
+
     def _validateData(self, data):
         OEmbedResponse._validateData(self, data)
 
@@ -207,11 +411,566 @@ resourceTypes = {
     'rich':  OEmbedRichResponse
 }
 
+class _PooledResponse(object):
+    '''
+    A response read from a pooled connection. The connection goes back to
+    the pool once the body has been fully read.
+    '''
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._url = url
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self._response.status
+
+    def geturl(self):
+        return self._url
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except Exception:
+            self.close()
+            raise
+        if self._conn is not None and self._response.isclosed():
+            self._release()
+        return data
+
+    def _readAtMost(self, limit):
+        # Read a body that is not used much, such as that of an error. A body
+        # over limit bytes is cut, and its connection closed rather than
+        # read to the end.
+        if limit is None:
+            return self.read()
+        chunks = []
+        total = 0
+        while total <= limit:
+            chunk = self.read(min(_CHUNK_SIZE, limit + 1 - total))
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+            total += len(chunk)
+        self.close()
+        return b''.join(chunks)[:limit]
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if self._response.will_close:
+            conn.close()
+        else:
+            self._pool._put(self._key, conn)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+
+
+class OEmbedConnectionPool(object):
+    '''
+    A pool of persistent HTTP connections, kept alive per host.
+
+    Connections are checked out for the duration of a request and given
+    back once the response body has been read, so a pool is safe to share
+    between threads and between endpoints on the same host. Errors are
+    raised as urllib2.URLError and urllib2.HTTPError, like urllib2 does.
+
+    Hosts reached through a proxy set in the environment (http_proxy,
+    https_proxy and no_proxy) are fetched with a urllib2 opener instead,
+    which sends the request to the proxy. Like urllib2.ProxyHandler, the
+    proxies are read once, when the pool is created.
+    '''
+
+    _redirects = (301, 302, 303, 307, 308)
+
+    def __init__(self, maxConnections=10, idleTimeout=60, timeout=None,
+                 maxRedirects=5):
+        '''
+        Create a new OEmbedConnectionPool object.
+
+        Args:
+            maxConnections: Maximum number of idle connections kept per host.
+            idleTimeout: Seconds an idle connection is kept before closing it.
+            timeout: Socket timeout in seconds, None for the system default.
+            maxRedirects: Maximum number of redirects followed per request.
+        '''
+        self._maxConnections = maxConnections
+        self._idleTimeout = idleTimeout
+        self._timeout = timeout
+        self._maxRedirects = maxRedirects
+        self._idle = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._proxies = urllib2.getproxies()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if self._timeout is None:
+            kwargs = {}
+        else:
+            kwargs = {'timeout': self._timeout}
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, **kwargs)
+        return httplib.HTTPConnection(host, port, **kwargs)
+
+    def _get(self, key):
+        now = _clock()
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the idle sockets belong to the parent process.
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(key)
+            while idle:
+                conn, lastUsed = idle.pop()
+                if now - lastUsed < self._idleTimeout:
+                    return conn, True
+                conn.close()
+        return self._connect(key), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._maxConnections and self._pid == os.getpid():
+                idle.append((conn, _clock()))
+                return
+        conn.close()
+
+    def clear(self):
+        '''Close all the idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, lastUsed in conns:
+                conn.close()
+
+    def _send(self, key, path, headers, timeout=None):
+        while True:
+            conn, reused = self._get(key)
+            try:
+                if timeout is not None:
+                    connectTimeout, readTimeout = timeout
+                    if conn.sock is None:
+                        conn.timeout = connectTimeout
+                        conn.connect()
+                    conn.sock.settimeout(readTimeout)
+                elif conn.sock is not None:
+                    # Undo the timeout of the last request on the connection.
+                    conn.sock.settimeout(self._timeout
+                                         if self._timeout is not None
+                                         else socket.getdefaulttimeout())
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                # A kept-alive connection may have been closed by the server,
+                # GET is idempotent so try again on a new connection.
+                if not reused or isinstance(e, socket.timeout):
+                    raise urllib2.URLError(e)
+
+    def _proxied(self, scheme, host):
+        # Whether urllib2 would send a request for host through a proxy.
+        return scheme in self._proxies and not urllib2.proxy_bypass(host)
+
+    def _openProxied(self, url, headers, timeout):
+        opener = urllib2.build_opener()
+        opener.addheaders = list(headers.items())
+        if timeout is not None:
+            return opener.open(url, timeout=max(timeout))
+        if self._timeout is not None:
+            return opener.open(url, timeout=self._timeout)
+        return opener.open(url)
+
+    def open(self, url, headers=None, timeout=None, maxSize=None):
+        '''
+        Send a GET request, following redirects.
+
+        Args:
+            url: The url to fetch.
+            headers: A dict of request headers.
+            timeout: A (connect, read) tuple of timeouts in seconds for this
+                     request, overriding the timeout of the pool.
+            maxSize: Maximum number of bytes read of the bodies of redirects
+                     and errors, None for no limit. Larger bodies are cut.
+
+        Returns:
+            A file-like response object with info(), getcode() and read().
+        '''
+        headers = dict(headers or {})
+        for redirect in range(self._maxRedirects + 1):
+            parts = urlsplit(url)
+            scheme = parts.scheme.lower()
+            if scheme not in ('http', 'https') or not parts.hostname:
+                raise urllib2.URLError('unknown url type: %s' % url)
+            if self._proxied(scheme, parts.hostname):
+                return self._openProxied(url, headers, timeout)
+            port = parts.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            conn, response = self._send(key, path, headers, timeout)
+            result = _PooledResponse(self, key, conn, response, url)
+            location = response.getheader('Location')
+            if response.status in self._redirects and location:
+                result._readAtMost(maxSize)
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                body = result._readAtMost(maxSize)
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, _BytesIO(body))
+            return result
+
+        raise urllib2.HTTPError(url, response.status,
+                                'Too many redirects', response.msg, None)
+
+
+defaultConnectionPool = OEmbedConnectionPool()
+
+
+# Socket errors of a connection refused or dropped, worth retrying; others,
+# such as an unknown host, will not go away by themselves.
+_transientErrnos = frozenset([errno.ECONNREFUSED, errno.ECONNRESET,
+                              errno.ECONNABORTED, errno.EPIPE,
+                              errno.ETIMEDOUT])
+
+
+def _isTransientCode(code):
+    # Throttling and server errors, but 501 Not Implemented is not temporary.
+    return code == 429 or (500 <= code < 600 and code != 501)
+
+
+def _isTransientReason(reason):
+    # Timeouts, refused and reset connections. EOFError covers bodies cut
+    # short by asyncio, BadStatusLine and IncompleteRead those cut short by
+    # httplib.
+    if isinstance(reason, (socket.timeout, EOFError, httplib.BadStatusLine,
+                           httplib.IncompleteRead)):
+        return True
+    return isinstance(reason, socket.error) and \
+        getattr(reason, 'errno', None) in _transientErrnos
+
+
+def _retryAfter(error):
+    '''
+    Get the seconds to wait given by the Retry-After header of a 429 or 503
+    error, or None.
+    '''
+    if not isinstance(error, urllib2.HTTPError) or error.code not in (429, 503):
+        return None
+    headers = error.info()
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+def _isTimeout(error):
+    if isinstance(error, urllib2.URLError):
+        error = error.reason
+    return isinstance(error, (socket.timeout, OEmbedTimeout))
+
+
+class _Deadline(object):
+    '''
+    The time by which a fetch must be done, threaded down to its socket
+    timeouts and retries. A cancelled fetch stops at its next step.
+    '''
+    __slots__ = ('end', 'cancelled')
+
+    def __init__(self, seconds=None, end=None):
+        self.end = _clock() + seconds if seconds is not None else end
+        self.cancelled = False
+
+    def passed(self):
+        return self.cancelled or \
+            (self.end is not None and _clock() >= self.end)
+
+    def left(self):
+        '''
+        Get the seconds left, None for no limit, raising OEmbedTimeout once
+        the deadline has passed.
+        '''
+        if self.cancelled:
+            raise OEmbedTimeout('Fetch cancelled')
+        if self.end is None:
+            return None
+        left = self.end - _clock()
+        if left <= 0:
+            raise OEmbedTimeout('Deadline exceeded')
+        return left
+
+    def timeout(self, timeout, default=None):
+        '''
+        Cut a (connect, read) tuple of timeouts to the seconds left. A
+        timeout of None stands for default.
+        '''
+        left = self.left()
+        if left is None:
+            return timeout
+        return tuple(left if t is None else min(t, left)
+                     for t in timeout or (default, default))
+
+
+class OEmbedRateLimit(object):
+    '''
+    A token bucket limiting the rate of requests to a provider.
+
+    Requests over the rate wait for their turn in arrival order. A request
+    whose wait would exceed maxWait fails at once with OEmbedRateLimited
+    instead, so that callers can shed load rather than queue it.
+    '''
+
+    def __init__(self, rate, burst=None, maxWait=None):
+        '''
+        Create a new OEmbedRateLimit object.
+
+        Args:
+            rate: Number of requests allowed per second.
+            burst: Number of requests allowed at once, by default the rate
+                   (at least 1).
+            maxWait: Maximum number of seconds a request may wait, None for
+                     no limit.
+        '''
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(1, rate))
+        self._maxWait = maxWait
+        self._tokens = self._burst
+        self._updated = _clock()
+        self._blockedUntil = 0
+        self._lock = threading.Lock()
+
+    def _wait(self, now):
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        return max(0, self._blockedUntil - now,
+                   (1 - self._tokens) / self._rate)
+
+    def delay(self):
+        '''
+        Get the time a request sent now would wait.
+
+        Returns:
+            The wait in seconds, 0 if a request can be sent at once.
+        '''
+        with self._lock:
+            return self._wait(_clock())
+
+    def reserve(self, maxWait=None):
+        '''
+        Reserve the next turn to send a request.
+
+        Args:
+            maxWait: Maximum number of seconds this request may wait, on top
+                     of the maxWait of the limit.
+
+        Returns:
+            The seconds to wait before sending the request.
+
+        Raises:
+            OEmbedRateLimited: if the wait would exceed maxWait. No turn is
+                               reserved then.
+        '''
+        if self._maxWait is not None:
+            maxWait = self._maxWait if maxWait is None \
+                else min(maxWait, self._maxWait)
+        with self._lock:
+            wait = self._wait(_clock())
+            if maxWait is not None and wait > maxWait:
+                raise OEmbedRateLimited(
+                    'Rate limit wait of %.3f seconds exceeds %s seconds' % \
+                    (wait, maxWait))
+            self._tokens -= 1
+            return wait
+
+    def cancel(self):
+        '''
+        Give back a turn reserved for a request that is not sent after all,
+        so that it does not hold back the following ones.
+        '''
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + 1)
+
+    def acquire(self):
+        '''Wait for the next turn to send a request.'''
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds):
+        '''
+        Hold back all requests for a while, as asked by a Retry-After
+        header.
+
+        Args:
+            seconds: The number of seconds to wait.
+        '''
+        with self._lock:
+            self._blockedUntil = max(self._blockedUntil, _clock() + seconds)
+
+
+class OEmbedCircuitBreaker(object):
+    '''
+    Tracks the health of a provider.
+
+    After failureThreshold consecutive transient failures the circuit opens
+    and requests fail fast. Once resetTimeout seconds have passed a single
+    probe request is let through: the circuit closes if it succeeds, and
+    stays open for another resetTimeout seconds otherwise.
+    '''
+
+    def __init__(self, failureThreshold=5, resetTimeout=30):
+        '''
+        Create a new OEmbedCircuitBreaker object.
+
+        Args:
+            failureThreshold: Consecutive failures that open the circuit.
+            resetTimeout: Seconds to wait before probing the provider again.
+        '''
+        self._failureThreshold = failureThreshold
+        self._resetTimeout = resetTimeout
+        self._failures = 0
+        self._openedAt = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Check whether a request may be sent.
+
+        Returns:
+            True if the circuit is closed, or if the request is the probe of
+            an open circuit. False otherwise.
+        '''
+        with self._lock:
+            if self._openedAt is None:
+                return True
+            now = _clock()
+            if now - self._openedAt < self._resetTimeout:
+                return False
+            self._openedAt = now
+            return True
+
+    def isOpen(self):
+        '''
+        Check whether requests fail fast.
+
+        Returns:
+            True while the circuit is open, False otherwise.
+        '''
+        return self._openedAt is not None
+
+    def success(self):
+        '''Record a successful request, closing the circuit.'''
+        with self._lock:
+            self._failures = 0
+            self._openedAt = None
+
+    def failure(self):
+        '''Record a failed request.'''
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._failureThreshold:
+                self._openedAt = _clock()
+
+
+def _decompress(chunks, encoding):
+    '''
+    Decompress a gzip or deflate encoded body, given as an iterable of byte
+    chunks, into pieces of at most _CHUNK_SIZE bytes.
+    '''
+    if encoding in ('gzip', 'x-gzip'):
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == 'deflate':
+        wbits = None
+    else:
+        raise OEmbedError('Unsupported content encoding - %s' % encoding)
+
+    decompressor = None
+    try:
+        for chunk in chunks:
+            if decompressor is None:
+                if wbits is None:
+                    # Some servers send raw deflate data without the zlib
+                    # header.
+                    head = bytearray(chunk[:2])
+                    if len(head) == 2 and head[0] & 0x0f == 8 and \
+                       (head[0] << 8 | head[1]) % 31 == 0:
+                        wbits = zlib.MAX_WBITS
+                    else:
+                        wbits = -zlib.MAX_WBITS
+                decompressor = zlib.decompressobj(wbits)
+            data = decompressor.decompress(chunk, _CHUNK_SIZE)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail,
+                                               _CHUNK_SIZE)
+        if decompressor is not None:
+            data = decompressor.flush()
+            if data:
+                yield data
+    except zlib.error as e:
+        raise OEmbedError('Invalid %s encoded response - %s' % (encoding, e))
+
+
+# Decoders by media type.
+_mediaTypes = {
+    'application/json': OEmbedResponse._decodeJSON,
+    'text/json': OEmbedResponse._decodeJSON,
+    'text/javascript': OEmbedResponse._decodeJSON,
+    'application/json+oembed': OEmbedResponse._decodeJSON,
+    'application/xml': OEmbedResponse._decodeXML,
+    'text/xml': OEmbedResponse._decodeXML,
+    'text/xml+oembed': OEmbedResponse._decodeXML,
+    'application/xml+oembed': OEmbedResponse._decodeXML,
+}
+
+# Decoders by Content-Type header, filled as headers are seen.
+_decoders = {}
+
+
+def _decoderFor(contentType):
+    '''Get the decoder of a Content-Type header and remember it.'''
+    mediaType = contentType.split(';', 1)[0].strip().lower()
+    decode = _mediaTypes.get(mediaType)
+    if decode is None:
+        # Unusual types naming a known one, e.g. application/json-p.
+        for known in ('application/xml', 'text/xml', 'application/json',
+                      'text/javascript', 'text/json'):
+            if known in mediaType:
+                decode = _mediaTypes[known]
+                break
+        else:
+            raise OEmbedError('Invalid mime-type in response - %s' % \
+                              contentType)
+    if len(_decoders) >= 256:
+        _decoders.clear()
+    _decoders[contentType] = decode
+    return decode
+
+
 class OEmbedEndpoint(object):
     '''
     A class representing an OEmbed Endpoint exposed by a provider.
 
     This class handles a number of URL schemes and manage resource retrieval.
+    Its url schemes are replaced, never changed in place, so they can be
+    read from any thread while they are updated.
     '''
 
     def __init__(self, url, urlSchemes=None):
@@ -224,8 +983,20 @@ class OEmbedEndpoint(object):
         '''
         self._urlApi = url
         self._urlSchemes = {}
+        self._listeners = ()
+        self._lock = threading.Lock()
         self._initRequestHeaders()
-        self._urllib = urllib2
+        self._urllib = None
+        self._pool = None
+        self._maxResponseSize = 1024 * 1024
+        self._timeout = None
+        self._retries = 0
+        self._backoff = 0.1
+        self._maxBackoff = 2
+        self._breaker = None
+        self._latencies = None
+        self._rateLimit = None
+        self._canonicalRules = ()
 
         if urlSchemes is not None:
             for urlScheme in urlSchemes:
@@ -234,7 +1005,7 @@ class OEmbedEndpoint(object):
         self._implicitFormat = self._urlApi.find('{format}') != -1
 
     def _initRequestHeaders(self):
-        self._requestHeaders = {}
+        self._requestHeaders = {'Accept-Encoding': 'gzip, deflate'}
         self.setUserAgent('python-oembed')
 
     def addUrlScheme(self, url):
@@ -250,8 +1021,13 @@ class OEmbedEndpoint(object):
         if not isinstance(url, str):
             raise TypeError('url must be a string value')
 
-        if not url in self._urlSchemes:
-            self._urlSchemes[url] = OEmbedUrlScheme(url)
+        with self._lock:
+            if url in self._urlSchemes:
+                return
+            urlSchemes = dict(self._urlSchemes)
+            urlSchemes[url] = OEmbedUrlScheme(url)
+            self._urlSchemes = urlSchemes
+        self._notifyChanged()
 
     def delUrlScheme(self, url):
         '''
@@ -260,12 +1036,46 @@ class OEmbedEndpoint(object):
         Args:
            url: The url used as key for the urlSchems dict.
         '''
-        if url in self._urlSchemes:
-            del self._urlSchemes[url]
+        with self._lock:
+            if url not in self._urlSchemes:
+                return
+            urlSchemes = dict(self._urlSchemes)
+            del urlSchemes[url]
+            self._urlSchemes = urlSchemes
+        self._notifyChanged()
 
     def clearUrlSchemes(self):
         '''Clear the schemes in this endpoint.'''
-        self._urlSchemes.clear()
+        with self._lock:
+            self._urlSchemes = {}
+        self._notifyChanged()
+
+    def addListener(self, listener):
+        '''
+        Register a callable to be invoked whenever the url schemes of this
+        endpoint change.
+
+        Args:
+            listener: A callable taking the endpoint as its only argument.
+        '''
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners += (listener,)
+
+    def delListener(self, listener):
+        '''
+        Unregister a callable added with addListener.
+
+        Args:
+            listener: The callable to remove.
+        '''
+        with self._lock:
+            self._listeners = tuple([l for l in self._listeners
+                                     if l != listener])
+
+    def _notifyChanged(self):
+        for listener in self._listeners:
+            listener(self)
 
     def getUrlSchemes(self):
         '''
@@ -273,6 +1083,8 @@ class OEmbedEndpoint(object):
 
         Returns:
             A dict of OEmbedUrlScheme objects. k => url, v => OEmbedUrlScheme
+            It is a snapshot that must not be modified; use addUrlScheme and
+            delUrlScheme instead.
         '''
         return self._urlSchemes
 
@@ -309,7 +1121,7 @@ class OEmbedEndpoint(object):
         Returns:
             The complete url of the endpoint and resource.
         '''
-        params = opt
+        params = dict(opt)
         params['url'] = url
         urlApi = self._urlApi
 
@@ -336,47 +1148,497 @@ class OEmbedEndpoint(object):
         '''
         return self.fetch(self.request(url, **opt))
 
-    def fetch(self, url):
+    def fetch(self, url, timing=None, previous=None, deadline=None):
         '''
         Fetch url and create a response object according to the mime-type.
 
         Args:
             url: The url to fetch data from
+            timing: An optional OEmbedTiming to record the phases in.
+            previous: An OEmbedResponse previously fetched from url. It is
+                      revalidated with its ETag or Last-Modified header, and
+                      returned as is if the provider answers 304 Not
+                      Modified.
+            deadline: Maximum number of seconds the fetch may take, retries
+                      included, None for no limit. The timeouts of the
+                      requests are cut to the time left, and OEmbedTimeout
+                      is raised once it has passed.
 
         Returns:
             OEmbedResponse object according to data fetched
         '''
-        opener = self._urllib.build_opener()
-        opener.addheaders = self._requestHeaders.items()
-        response = opener.open(url)
+        if deadline is not None:
+            deadline = _Deadline(deadline)
+        return self._fetchWithin(url, timing, previous, deadline)
+
+    def _fetchWithin(self, url, timing=None, previous=None, deadline=None):
+        self._checkAvailable()
+        attempt = 0
+        while True:
+            try:
+                if self._latencies is None:
+                    response = self._fetch(url, timing, previous, deadline)
+                else:
+                    response = self._fetchHedged(url, timing, previous,
+                                                 deadline)
+            except Exception as e:
+                delay = self._onFailure(attempt, e)
+                if delay is None:
+                    raise
+                if deadline is not None and deadline.end is not None and \
+                   _clock() + delay >= deadline.end:
+                    # No time is left for another attempt.
+                    self._recordResult(e)
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._recordResult(None)
+            return response
+
+    def _fetch(self, url, timing=None, previous=None, deadline=None):
+        if self._rateLimit is not None:
+            left = deadline.left() if deadline is not None else None
+            # Checked before reserving a turn, which would hold back the
+            # following requests though this one is not sent.
+            if left is not None and self._rateLimit.delay() >= left:
+                raise OEmbedTimeout('Deadline exceeded waiting for the '
+                                    'rate limit of %s' % self._urlApi)
+            wait = self._rateLimit.reserve(left)
+            if wait > 0:
+                time.sleep(wait)
+                if timing is not None:
+                    timing.addPhase('queue', wait)
+        headers = self._conditionalHeaders(previous)
+        try:
+            if timing is None:
+                response = self._open(url, headers, deadline)
+            else:
+                start = _clock()
+                response = self._open(url, headers, deadline)
+                timing.addPhase('network', _clock() - start)
+        except urllib2.HTTPError as e:
+            # urllib2 openers raise on 304.
+            if headers is None or e.code != 304:
+                raise
+            return self.notModified(previous, e.info())
+        try:
+            if response.getcode() == 304 and headers is not None:
+                response.read()
+                return self.notModified(previous, response.info())
+            return self.parse(response.info(),
+                              self._readChunks(response, timing, deadline),
+                              timing)
+        finally:
+            response.close()
+
+    def _measuredFetch(self, url, timing, previous, deadline=None):
+        start = _clock()
+        response = self._fetch(url, timing, previous, deadline)
+        if deadline is None or not deadline.cancelled:
+            self._recordLatency(_clock() - start)
+        return response
+
+    def _fetchHedged(self, url, timing, previous, deadline=None):
+        delay = self._hedgeDelay()
+        if delay is None:
+            return self._measuredFetch(url, timing, previous, deadline)
+
+        results = Queue.Queue()
+        attempts = []
+        end = deadline.end if deadline is not None else None
+
+        def attempt(attemptDeadline):
+            attemptTiming = None if timing is None else OEmbedTiming(url)
+            try:
+                results.put((self._measuredFetch(url, attemptTiming, previous,
+                                                 attemptDeadline),
+                             None, attemptTiming))
+            except Exception as e:
+                results.put((None, e, attemptTiming))
+
+        def start():
+            # Each attempt has the time left to the deadline, and is
+            # cancelled once the other one has won.
+            attemptDeadline = _Deadline(end=end)
+            attempts.append(attemptDeadline)
+            thread = threading.Thread(target=attempt, args=(attemptDeadline,))
+            thread.daemon = True
+            thread.start()
+
+        def get(wait=None):
+            if deadline is not None and deadline.end is not None:
+                left = deadline.left()
+                wait = left if wait is None else min(wait, left)
+            return results.get(timeout=wait)
+
+        start()
+        hedged = False
+        try:
+            try:
+                response, error, attemptTiming = get(delay)
+            except Queue.Empty:
+                if deadline is not None:
+                    deadline.left()
+                # Slower than usual: race a second request against the
+                # first.
+                hedged = True
+                start()
+                response, error, attemptTiming = get()
+                if error is not None:
+                    response, error, attemptTiming = get()
+        except Queue.Empty:
+            raise OEmbedTimeout('Deadline exceeded')
+        finally:
+            for attemptDeadline in attempts:
+                attemptDeadline.cancelled = True
+
+        if timing is not None:
+            timing.merge(attemptTiming)
+            timing.tags['hedged'] = hedged
+        if error is not None:
+            raise error
+        return response
+
+    def _recordLatency(self, seconds):
+        with self._latencyLock:
+            self._latencies.append(seconds)
+
+    def _hedgeDelay(self):
+        # Seconds to wait before hedging, None until enough latencies are
+        # known.
+        with self._latencyLock:
+            if len(self._latencies) < self._hedgeMinSamples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * self._hedgePercentile / 100.0))]
+
+    @staticmethod
+    def _isTransient(error):
+        if isinstance(error, urllib2.HTTPError):
+            return _isTransientCode(error.code)
+        if isinstance(error, urllib2.URLError):
+            error = error.reason
+        return _isTransientReason(error)
+
+    def _checkAvailable(self):
+        if self._breaker is not None and not self._breaker.allow():
+            raise OEmbedProviderUnavailable(
+                'Provider %s is unavailable' % self._urlApi)
+
+    def _onFailure(self, attempt, error):
+        # Record a failed request, and return the seconds to wait before
+        # retrying it, or None to give up.
+        retryAfter = _retryAfter(error)
+        if retryAfter is not None and self._rateLimit is not None:
+            self._rateLimit.block(retryAfter)
+        delay = self._retryDelay(attempt, error, retryAfter)
+        if delay is None:
+            self._recordResult(error)
+        return delay
+
+    def _retryDelay(self, attempt, error, retryAfter=None):
+        if attempt >= self._retries:
+            return None
+        if retryAfter is not None:
+            # Throttled: wait as asked, unless that is longer than a backoff.
+            return retryAfter if retryAfter <= self._maxBackoff else None
+        if not self._isTransient(error):
+            return None
+        return random.uniform(0, min(self._maxBackoff,
+                                     self._backoff * 2 ** attempt))
+
+    def _recordResult(self, error):
+        if self._breaker is not None:
+            # A throttled provider is up, it only asks to slow down.
+            if error is not None and self._isTransient(error) and \
+               getattr(error, 'code', None) != 429:
+                self._breaker.failure()
+            else:
+                self._breaker.success()
+
+    def _conditionalHeaders(self, previous):
+        if previous is None:
+            return None
+        headers = {}
+        if previous._etag is not None:
+            headers['If-None-Match'] = previous._etag
+        if previous._lastModified is not None:
+            headers['If-Modified-Since'] = previous._lastModified
+        return headers or None
+
+    def notModified(self, previous, headers):
+        '''
+        Refresh a revalidated response with the validators of a 304 Not
+        Modified answer.
+
+        Args:
+            previous: The OEmbedResponse that was revalidated.
+            headers: The headers of the 304 response.
+
+        Returns:
+            The previous response.
+        '''
+        if headers is not None:
+            previous._etag = headers.get('ETag') or previous._etag
+            previous._lastModified = headers.get('Last-Modified') or \
+                                     previous._lastModified
+        return previous
+
+    def _readChunks(self, response, timing=None, deadline=None):
+        limit = self._maxResponseSize
         headers = response.info()
-        raw = response.read()
-        raw = raw.decode('utf8')
+        if limit is not None and not headers.get('Content-Encoding'):
+            length = headers.get('Content-Length')
+            if length is not None and length.isdigit() and int(length) > limit:
+                raise OEmbedResponseTooLarge(
+                    'Response of %s bytes exceeds the limit of %d bytes' % \
+                    (length, limit))
+        return self._inflate(headers,
+                             self._readRaw(response, timing, deadline))
+
+    def _readRaw(self, response, timing=None, deadline=None):
+        while True:
+            if deadline is not None:
+                deadline.left()
+            if timing is None:
+                chunk = response.read(_CHUNK_SIZE)
+            else:
+                start = _clock()
+                chunk = response.read(_CHUNK_SIZE)
+                timing.addPhase('network', _clock() - start)
+                timing.bytesRead += len(chunk)
+            if not chunk:
+                return
+            yield chunk
+
+    def _inflate(self, headers, chunks):
+        # Decompress the body according to its Content-Encoding, and check
+        # the decompressed size against the limit.
+        encoding = (headers.get('Content-Encoding') or '').strip().lower()
+        if encoding not in ('', 'identity'):
+            chunks = _decompress(chunks, encoding)
+        limit = self._maxResponseSize
+        if limit is None:
+            return chunks
+        return self._limit(chunks, limit)
+
+    @staticmethod
+    def _limit(chunks, limit):
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            if total > limit:
+                raise OEmbedResponseTooLarge(
+                    'Response exceeds the limit of %d bytes' % limit)
+            yield chunk
+
+    def parse(self, headers, raw, timing=None):
+        '''
+        Create a response object from a fetched body according to its
+        mime-type.
 
-        if not 'Content-Type' in headers:
+        Args:
+            headers: The response headers.
+            raw: The response body, as bytes or as an iterable of byte chunks.
+            timing: An optional OEmbedTiming to record the phases in.
+
+        Returns:
+            OEmbedResponse object according to data fetched
+        '''
+        contentType = headers.get('Content-Type')
+        if contentType is None:
             raise OEmbedError('Missing mime-type in response')
 
-        if headers['Content-Type'].find('application/xml') != -1 or \
-           headers['Content-Type'].find('text/xml') != -1:
-            response = OEmbedResponse.newFromXML(raw)
-        elif headers['Content-Type'].find('application/json') != -1 or \
-             headers['Content-Type'].find('text/javascript') != -1 or \
-             headers['Content-Type'].find('text/json') != -1:
-            response = OEmbedResponse.newFromJSON(raw)
-        else:
-            raise OEmbedError('Invalid mime-type in response - %s' % headers['Content-Type'])
+        decode = _decoders.get(contentType)
+        if decode is None:
+            decode = _decoderFor(contentType)
 
+        if timing is None:
+            response = OEmbedResponse.createLoad(decode(raw))
+        else:
+            timing.tags['mimeType'] = contentType
+            network = timing.phases.get('network', 0)
+            start = _clock()
+            data = decode(raw)
+            decoded = _clock()
+            response = OEmbedResponse.createLoad(data)
+            # Streamed bodies are read while decoding, that time is network
+            # time.
+            timing.addPhase('decode', decoded - start -
+                            (timing.phases.get('network', 0) - network))
+            timing.addPhase('parse', _clock() - decoded)
+        response._etag = headers.get('ETag')
+        response._lastModified = headers.get('Last-Modified')
         return response
 
+    def _open(self, url, headers=None, deadline=None):
+        if headers:
+            headers = dict(self._requestHeaders, **headers)
+        else:
+            headers = self._requestHeaders
+        pool = self._pool or defaultConnectionPool
+        timeout = self._timeout
+        if deadline is not None:
+            timeout = deadline.timeout(
+                timeout, None if self._urllib is not None else pool._timeout)
+        if self._urllib is not None:
+            opener = self._urllib.build_opener()
+            opener.addheaders = list(headers.items())
+            if timeout is None:
+                return opener.open(url)
+            return opener.open(url, timeout=max(timeout))
+        return pool.open(url, headers, timeout, self._maxResponseSize)
+
     def setUrllib(self, urllib):
         '''
-        Override the default urllib implementation.
+        Override the default urllib implementation. Requests are then sent
+        with a new opener of this module instead of the connection pool.
 
         Args:
             urllib: an instance that supports the same API as the urllib2 module
         '''
         self._urllib = urllib
 
+    def setMaxResponseSize(self, size):
+        '''
+        Override the maximum size of a response body. Larger responses are
+        rejected with OEmbedResponseTooLarge as soon as the limit is crossed.
+
+        Args:
+            size: The limit in bytes, or None for no limit. Defaults to 1MB.
+        '''
+        self._maxResponseSize = size
+
+    def setTimeout(self, connect, read):
+        '''
+        Set the timeouts of the requests to this endpoint. They override the
+        timeout of the connection pool. With setUrllib, the larger of both
+        is used as the timeout of the opener.
+
+        Args:
+            connect: Seconds allowed to connect to the provider.
+            read: Seconds allowed to wait for each read from the provider.
+
+        The asyncio consumer uses the timeout of its transport instead.
+        '''
+        self._timeout = (connect, read)
+
+    def setRetries(self, retries, backoff=0.1, maxBackoff=2):
+        '''
+        Retry the requests that fail transiently: refused and reset
+        connections, timeouts, and 429 and 5xx responses except 501. Other
+        errors, such as an unknown host, are raised at once. Requests are
+        GETs, so they are safe to send again. Retries wait a random delay of
+        up to backoff * 2 ** attempt seconds, and never more than maxBackoff.
+
+        Args:
+            retries: Maximum number of retries of a request, 0 to disable.
+            backoff: Base delay in seconds.
+            maxBackoff: Maximum delay in seconds.
+        '''
+        self._retries = retries
+        self._backoff = backoff
+        self._maxBackoff = maxBackoff
+
+    def setCircuitBreaker(self, breaker):
+        '''
+        Fail fast with OEmbedProviderUnavailable while the provider is
+        unhealthy.
+
+        Args:
+            breaker: An OEmbedCircuitBreaker, or None to disable it.
+        '''
+        self._breaker = breaker
+
+    def getCircuitBreaker(self):
+        '''
+        Get the circuit breaker of this endpoint.
+
+        Returns:
+            The OEmbedCircuitBreaker of this endpoint, or None.
+        '''
+        return self._breaker
+
+    def addCanonicalRule(self, rule):
+        '''
+        Add a rule rewriting the urls of this endpoint to their canonical
+        form. Rules run after the url has been matched to this endpoint, in
+        the order they were added. See OEmbedCanonicalizer for ready-made
+        rules.
+
+        Args:
+            rule: A callable taking a url and returning it rewritten.
+        '''
+        self._canonicalRules += (rule,)
+
+    def canonicalize(self, url):
+        '''
+        Apply the canonical rules of this endpoint to a url.
+
+        Args:
+            url: The url of an OEmbed resource.
+
+        Returns:
+            The rewritten url.
+        '''
+        for rule in self._canonicalRules:
+            url = rule(url)
+        return url
+
+    def setRateLimit(self, limit):
+        '''
+        Limit the rate of requests sent to this endpoint. The limit is also
+        blocked for the time given in the Retry-After header of 429 and 503
+        responses.
+
+        Args:
+            limit: An OEmbedRateLimit, or None for no limit.
+        '''
+        self._rateLimit = limit
+
+    def getRateLimit(self):
+        '''
+        Get the rate limit of this endpoint.
+
+        Returns:
+            The OEmbedRateLimit of this endpoint, or None.
+        '''
+        return self._rateLimit
+
+    def setHedging(self, percentile=95, minSamples=20, maxSamples=200):
+        '''
+        Send a second identical request when the provider has not answered
+        within a percentile of its recent latencies, and use the first
+        response to arrive. While hedging is enabled, each request runs in a
+        new thread.
+
+        Args:
+            percentile: The percentile of the latency after which to hedge,
+                        or None to disable hedging.
+            minSamples: Number of latencies to observe before hedging.
+            maxSamples: Number of recent latencies kept.
+        '''
+        if percentile is None:
+            self._latencies = None
+            return
+        self._hedgePercentile = percentile
+        self._hedgeMinSamples = minSamples
+        self._latencyLock = threading.Lock()
+        self._latencies = deque(maxlen=maxSamples)
+
+    def setConnectionPool(self, pool):
+        '''
+        Override the connection pool used to fetch resources. By default all
+        the endpoints share defaultConnectionPool.
+
+        Args:
+            pool: An OEmbedConnectionPool instance, or None for the default.
+        '''
+        self._pool = pool
+        self._urllib = None
+
     def setUserAgent(self, user_agent):
         '''
         Override the default user agent
@@ -396,15 +1658,19 @@ class OEmbedUrlScheme(object):
         '''
         Create a new OEmbedUrlScheme instance.
 
+        The regular expression of the scheme is compiled the first time it
+        is matched.
+
         Args;
             url: The url scheme. It also takes the wildcard character (*).
         '''
         self._url = url
         if url.startswith('regex:'):
-            self._regex = re.compile(url[6:])
+            self._pattern = url[6:]
         else:
-            self._regex = re.compile(url.replace('.', '\.')\
-                                     .replace('*', '.*'))
+            self._pattern = url.replace('.', '\\.').replace('*', '.*')
+        self._regex = None
+        self._indexKey = _missing
 
     def getUrl(self):
         '''
@@ -425,22 +1691,1222 @@ class OEmbedUrlScheme(object):
         Returns:
             True if a match was found for the url, False otherwise
         '''
-        return self._regex.match(url) is not None
+        regex = self._regex
+        if regex is None:
+            regex = self._regex = re.compile(self._pattern)
+        return regex.match(url) is not None
 
-    def __repr__(self):
-        return "%s - %s" % (object.__repr__(self), self._url)
+    def isLiteral(self):
+        '''
+        Check if this scheme is made only of literal text and wildcards.
 
+        Returns:
+            True if the scheme can be matched without a regular expression.
+        '''
+        if self._url.startswith('regex:'):
+            return False
+        for c in self._url:
+            if c in _REGEX_SPECIAL:
+                return False
+        return True
+
+    def getIndexKey(self):
+        '''
+        Get the key used to index this scheme by host.
 
-class OEmbedConsumer(object):
-    '''
+        Schemes are keyed by their literal text, up to the first special
+        character of regular expressions; regex: schemes are not indexed.
+        A scheme that spells out its whole host is keyed by scheme and host
+        ('host', 'http://flickr.com'). A scheme with a wildcard host is
+        keyed by the literal domain following the first wildcard ('suffix',
+        '.flickr.com'). Any url matching the scheme is guaranteed to
+        produce the same key.
+
+        Returns:
+            A (kind, key) tuple, or None if the scheme can not be indexed.
+        '''
+        if self._indexKey is _missing:
+            self._indexKey = self._findIndexKey()
+        return self._indexKey
+
+    def _findIndexKey(self):
+        if self._url.startswith('regex:') or '|' in self._url:
+            return None
+        literal = self._url
+        for i, c in enumerate(literal):
+            if c in _REGEX_SPECIAL:
+                if c in _QUANTIFIERS:
+                    i = max(i - 1, 0)
+                literal = literal[:i]
+                break
+        pieces = literal.split('*')
+        m = _SCHEME_HOST_END.match(pieces[0])
+        if m is not None:
+            return ('host', m.group(1))
+        if len(pieces) > 1:
+            m = _HOST_SUFFIX_END.match(pieces[1])
+            if m is not None:
+                return ('suffix', m.group(1))
+        return None
+
+    def __repr__(self):
+        return "%s - %s" % (object.__repr__(self), self._url)
+
+
+_percentRe = re.compile('%([0-9A-Fa-f]{2})')
+
+# Characters that never need percent-encoding in urls.
+_unreserved = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                        '0123456789-._~')
+
+
+def _normalizePercent(value):
+    # Decode escaped unreserved characters and uppercase the other escapes.
+    if '%' not in value:
+        return value
+
+    def replace(m):
+        char = chr(int(m.group(1), 16))
+        if char in _unreserved:
+            return char
+        return '%' + m.group(1).upper()
+    return _percentRe.sub(replace, value)
+
+
+class OEmbedCanonicalizer(object):
+    '''
+    Rewrites the urls of resources to a canonical form before they are
+    matched, cached and requested, so that the forms of the same url share
+    their request and their cache entry.
+
+    The built-in rules lower the case of the scheme and host, remove default
+    ports, normalize percent-encoding, use / for an empty path and remove
+    tracking parameters from the query. Other rules are callables taking a
+    url and returning it rewritten; the static methods of this class make
+    common ones. Rules that only suit some providers, like https or
+    stripWww, are best added to their endpoint with
+    OEmbedEndpoint.addCanonicalRule.
+    '''
+
+    trackingParams = frozenset(['fbclid', 'gclid', 'dclid', 'msclkid',
+                                'yclid', 'igshid', 'mc_cid', 'mc_eid',
+                                '_ga', '_hsenc', '_hsmi'])
+    trackingPrefixes = ('utm_',)
+
+    def __init__(self, rules=None, trackingParams=None, trackStats=False,
+                 maxTracked=100000):
+        '''
+        Create a new OEmbedCanonicalizer object.
+
+        Args:
+            rules: A list of callables run after the built-in rules.
+            trackingParams: Names of the query parameters to remove, by
+                            default trackingParams and the utm_ parameters.
+            trackStats: True to count the distinct urls merged, see
+                        getStats.
+            maxTracked: Maximum number of distinct urls counted.
+        '''
+        self._rules = tuple(rules or ())
+        if trackingParams is not None:
+            self.trackingParams = frozenset(trackingParams)
+            self.trackingPrefixes = ()
+        self._trackStats = trackStats
+        self._maxTracked = maxTracked
+        self._lock = threading.Lock()
+        self.resetStats()
+
+    def addRule(self, rule):
+        '''
+        Add a rule run after the built-in rules and the previous ones.
+
+        Args:
+            rule: A callable taking a url and returning it rewritten.
+        '''
+        self._rules += (rule,)
+
+    def _isTracking(self, param):
+        name = param.split('=', 1)[0].lower()
+        return name in self.trackingParams or \
+               name.startswith(self.trackingPrefixes)
+
+    def canonicalize(self, url):
+        '''
+        Rewrite a url to its canonical form.
+
+        Args:
+            url: The url of an OEmbed resource.
+
+        Returns:
+            The canonical url.
+        '''
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme in ('http', 'https') and parts.hostname:
+            try:
+                port = parts.port
+            except ValueError:
+                port = None
+            host = parts.hostname
+            if ':' in host:
+                host = '[%s]' % host
+            if port is not None and port != (443 if scheme == 'https' else 80):
+                host = '%s:%d' % (host, port)
+            if '@' in parts.netloc:
+                host = parts.netloc.rsplit('@', 1)[0] + '@' + host
+            query = parts.query
+            if query:
+                query = '&'.join([param for param in
+                                  _normalizePercent(query).split('&')
+                                  if param and not self._isTracking(param)])
+            url = urlunsplit((scheme, host, _normalizePercent(parts.path) or '/',
+                              query, parts.fragment))
+        for rule in self._rules:
+            url = rule(url)
+        return url
+
+    def record(self, url, canonical):
+        '''
+        Count a url and its canonical form in the stats.
+
+        Args:
+            url: The url as given.
+            canonical: Its canonical form.
+        '''
+        if not self._trackStats:
+            return
+        with self._lock:
+            self._calls += 1
+            if canonical != url:
+                self._changed += 1
+            if len(self._inputs) < self._maxTracked:
+                self._inputs.add(url)
+                self._outputs.add(canonical)
+
+    def getStats(self):
+        '''
+        Get the canonicalization stats, if trackStats is enabled.
+
+        Returns:
+            A dict with the number of urls canonicalized ('calls'), of urls
+            rewritten ('changed'), of distinct urls ('inputs'), of distinct
+            canonical urls ('canonical'), and of distinct urls merged into
+            another one ('merged').
+        '''
+        with self._lock:
+            return {'calls': self._calls,
+                    'changed': self._changed,
+                    'inputs': len(self._inputs),
+                    'canonical': len(self._outputs),
+                    'merged': len(self._inputs) - len(self._outputs)}
+
+    def resetStats(self):
+        '''Reset the canonicalization stats.'''
+        with self._lock:
+            self._calls = 0
+            self._changed = 0
+            self._inputs = set()
+            self._outputs = set()
+
+    @staticmethod
+    def https(url):
+        '''A rule using https instead of http.'''
+        if url.startswith('http://'):
+            return 'https://' + url[7:]
+        return url
+
+    @staticmethod
+    def stripWww(url):
+        '''A rule removing the www. prefix of the host.'''
+        parts = urlsplit(url)
+        if parts.netloc.startswith('www.'):
+            return urlunsplit(parts[:1] + (parts.netloc[4:],) + parts[2:])
+        return url
+
+    @staticmethod
+    def stripTrailingSlash(url):
+        '''A rule removing the trailing slash of the path.'''
+        parts = urlsplit(url)
+        if len(parts.path) > 1 and parts.path.endswith('/'):
+            return urlunsplit(parts[:2] + (parts.path.rstrip('/') or '/',) +
+                              parts[3:])
+        return url
+
+    @staticmethod
+    def rewrite(pattern, replacement):
+        '''
+        Make a rule replacing the first match of a regular expression, e.g.
+        to expand short links.
+
+        Args:
+            pattern: The regular expression.
+            replacement: The replacement, as for re.sub.
+
+        Returns:
+            The rule.
+        '''
+        regex = re.compile(pattern)
+        return lambda url: regex.sub(replacement, url, 1)
+
+
+class OEmbedUrlIndex(object):
+    '''
+    A dispatch index mapping urls to the endpoint that handles them.
+
+    Schemes are bucketed by the key returned by OEmbedUrlScheme.getIndexKey,
+    so a lookup only runs the regular expressions of the schemes sharing the
+    host of the url. Schemes that can not be keyed are matched with a single
+    combined regular expression, except the few whose pattern would change
+    meaning in it (group references, global flags), matched one by one.
+    The result is the same as scanning the endpoints in order: the first
+    endpoint with a matching scheme wins.
+    '''
+
+    def __init__(self, endpoints):
+        '''
+        Build the index.
+
+        Args:
+            endpoints: A sequence of OEmbedEndpoint objects, in priority order.
+        '''
+        self._hosts = {}
+        self._suffixes = {}
+        self._unkeyed = []
+        self._others = []
+        self._combined = None
+
+        for order, endpoint in enumerate(endpoints):
+            for urlScheme in list(endpoint.getUrlSchemes().values()):
+                entry = (order, urlScheme, endpoint)
+                key = urlScheme.getIndexKey()
+                if key is None:
+                    if self._combinable(urlScheme):
+                        self._unkeyed.append(entry)
+                    else:
+                        self._others.append(entry)
+                elif key[0] == 'host':
+                    self._hosts.setdefault(key[1], []).append(entry)
+                else:
+                    self._suffixes.setdefault(key[1], []).append(entry)
+
+        if self._unkeyed:
+            # Each scheme ends with an empty named group, found back from
+            # lastgroup whatever the groups of its own pattern. Unlike an
+            # outer group, it is only entered once the scheme has matched,
+            # so the other alternatives do not save and restore it.
+            self._combined = re.compile('|'.join(
+                ['(?:%s)(?P<s%d>)' % (e[1]._pattern, i)
+                 for i, e in enumerate(self._unkeyed)]))
+
+    @staticmethod
+    def _combinable(urlScheme):
+        # Whether the pattern of a scheme keeps its meaning as one of the
+        # alternatives of a larger regular expression.
+        if urlScheme.isLiteral():
+            return True
+        try:
+            regex = re.compile(urlScheme._pattern)
+        except re.error:
+            return False
+        return not regex.groupindex and regex.flags == _DEFAULT_FLAGS and \
+            _GROUP_REFERENCE.search(urlScheme._pattern) is None
+
+    def _candidates(self, url):
+        m = _SCHEME_HOST.match(url)
+        if m is not None:
+            bucket = self._hosts.get(m.group(0))
+            if bucket is not None:
+                yield bucket
+        if self._suffixes:
+            for run in _HOST_RUN.findall(url):
+                i = run.find('.')
+                while i != -1:
+                    bucket = self._suffixes.get(run[i:])
+                    if bucket is not None:
+                        yield bucket
+                    i = run.find('.', i + 1)
+
+    def lookup(self, url):
+        '''
+        Find the endpoint for a url.
+
+        Args:
+            url: The url of an OEmbed resource.
+
+        Returns:
+            The first matching OEmbedEndpoint, or None if no scheme matches.
+        '''
+        best = None
+        bestOrder = None
+
+        for bucket in self._candidates(url):
+            for order, urlScheme, endpoint in bucket:
+                if bestOrder is not None and order >= bestOrder:
+                    break
+                if urlScheme.match(url):
+                    best, bestOrder = endpoint, order
+                    break
+
+        if self._combined is not None and \
+           (bestOrder is None or self._unkeyed[0][0] < bestOrder):
+            m = self._combined.match(url)
+            if m is not None:
+                order, urlScheme, endpoint = \
+                    self._unkeyed[int(m.lastgroup[1:])]
+                if bestOrder is None or order < bestOrder:
+                    best, bestOrder = endpoint, order
+
+        for order, urlScheme, endpoint in self._others:
+            if bestOrder is not None and order >= bestOrder:
+                break
+            if urlScheme.match(url):
+                best, bestOrder = endpoint, order
+                break
+
+        return best
+
+
+class OEmbedCache(object):
+    '''
+    Base class for response caches.
+
+    A cache maps string keys to values that expire after a number of
+    seconds. Subclasses implement the storage; OEmbedConsumer decides what
+    is cached and for how long.
+    '''
+
+    def get(self, key):
+        '''
+        Get a value from the cache.
+
+        Args:
+            key: The string key of the value.
+
+        Returns:
+            The cached value, or None if it is missing or expired.
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        '''
+        Store a value in the cache.
+
+        Args:
+            key: The string key of the value.
+            value: The value to store.
+            ttl: Number of seconds the value stays valid.
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        '''
+        Remove a value from the cache.
+
+        Args:
+            key: The string key of the value.
+        '''
+        raise NotImplementedError
+
+    def clear(self):
+        '''Remove all the values from the cache.'''
+        raise NotImplementedError
+
+
+def _estimateSize(value):
+    if isinstance(value, _CacheEntry):
+        value = value.response
+    if isinstance(value, OEmbedResponse):
+        value = value.getData()
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+    return size
+
+
+class _CacheEntry(object):
+    '''A cached response and the time until which it is fresh.'''
+    __slots__ = ('response', 'expires')
+
+    def __init__(self, response, expires):
+        self.response = response
+        self.expires = expires
+
+
+class OEmbedMemoryCache(OEmbedCache):
+    '''
+    An in-process cache with least recently used eviction.
+
+    The cache is bounded by a number of entries and, optionally, by the
+    estimated memory used by the cached values. It is safe to share between
+    threads.
+    '''
+
+    def __init__(self, maxEntries=1000, maxBytes=None, sizeOf=_estimateSize):
+        '''
+        Create a new OEmbedMemoryCache object.
+
+        Args:
+            maxEntries: Maximum number of values to keep.
+            maxBytes: Maximum estimated size of all the values, in bytes.
+            sizeOf: A callable returning the estimated size of a value.
+        '''
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+        self._sizeOf = sizeOf
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[1] <= _clock():
+                self._bytes -= entry[2]
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        size = self._sizeOf(value) if self._maxBytes is not None else 0
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, _clock() + ttl, size)
+            self._bytes += size
+            while self._entries and \
+                  (len(self._entries) > self._maxEntries or
+                   (self._maxBytes is not None and
+                    self._bytes > self._maxBytes)):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class OEmbedSQLiteCache(OEmbedCache):
+    '''
+    A cache stored in an SQLite database file, shared by all the processes
+    that open it and kept across restarts.
+
+    The database is in WAL mode, so readers do not block each other nor the
+    writer. Responses are stored as JSON with their expiry time. When the
+    database grows over maxBytes, expired values are removed first, then
+    the values closest to expiring. Each process and thread uses its own
+    connection, so the cache is safe to use before and after forking.
+
+    Values must be responses cached by OEmbedConsumer, or JSON serializable.
+    '''
+
+    _evictEvery = 64
+
+    def __init__(self, path, maxBytes=100 * 1024 * 1024, timeout=5):
+        '''
+        Create a new OEmbedSQLiteCache object.
+
+        Args:
+            path: The path of the database file, created if missing.
+            maxBytes: Maximum size of all the stored values, in bytes.
+            timeout: Seconds to wait for a lock held by another process.
+                     Values that can not be read or written in that time are
+                     treated as missing.
+        '''
+        if sqlite3 is None:
+            raise OEmbedError('OEmbedSQLiteCache requires the sqlite3 module')
+        self._path = path
+        self._maxBytes = maxBytes
+        self._timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS oembed_cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'expires REAL NOT NULL, size INTEGER NOT NULL)')
+        self._connect().execute(
+            'CREATE INDEX IF NOT EXISTS oembed_cache_expires '
+            'ON oembed_cache (expires)')
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # Connections must not be shared with a forked child.
+            local.conn = sqlite3.connect(self._path, timeout=self._timeout,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+
+    @staticmethod
+    def _dumps(value):
+        if isinstance(value, _CacheEntry):
+            response = value.response
+            value = {'response': response.getData(),
+                     'expires': value.expires,
+                     'etag': response._etag,
+                     'lastModified': response._lastModified}
+        else:
+            value = {'value': value}
+        return json_encode(value)
+
+    @staticmethod
+    def _loads(raw):
+        value = json_decode(raw)
+        if 'response' not in value:
+            return value['value']
+        response = OEmbedResponse.createLoad(value['response'])
+        response._etag = value['etag']
+        response._lastModified = value['lastModified']
+        return _CacheEntry(response, value['expires'])
+
+    def get(self, key):
+        try:
+            row = self._connect().execute(
+                'SELECT value, expires FROM oembed_cache WHERE key = ?',
+                (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        return self._loads(row[0])
+
+    def set(self, key, value, ttl):
+        raw = self._dumps(value)
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO oembed_cache (key, value, expires, '
+                'size) VALUES (?, ?, ?, ?)',
+                (key, raw, time.time() + ttl, len(key) + len(raw)))
+        except sqlite3.OperationalError:
+            return
+        self._writes += 1
+        if self._writes % self._evictEvery == 0:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove the expired values, then the values closest to expiring
+        while the cache is larger than maxBytes. It runs every few writes.
+        '''
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM oembed_cache WHERE expires <= ?',
+                             (time.time(),))
+                total = conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM oembed_cache'
+                    ).fetchone()[0]
+                if total > self._maxBytes:
+                    # Evict down to 90% of the limit, not to run again at
+                    # the next write.
+                    excess = total - self._maxBytes * 0.9
+                    rows = conn.execute(
+                        'SELECT key, size FROM oembed_cache ORDER BY expires')
+                    keys = []
+                    for key, size in rows:
+                        keys.append((key,))
+                        excess -= size
+                        if excess <= 0:
+                            break
+                    conn.executemany('DELETE FROM oembed_cache WHERE key = ?',
+                                     keys)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.OperationalError:
+            pass
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM oembed_cache WHERE key = ?',
+                                (key,))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM oembed_cache')
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM oembed_cache WHERE expires > ?',
+            (time.time(),)).fetchone()[0]
+
+
+class OEmbedRefresher(object):
+    '''
+    Refreshes cached responses in the background.
+
+    A response that expired less than grace seconds ago is returned at once
+    while it is fetched again, so that no embed waits on the provider for
+    it. A response read at least hotHits times is also fetched again when
+    less than refreshAhead of its time to live remains, before it expires.
+    At most maxConcurrent refreshes run at a time; the others are skipped
+    and tried again on a later access.
+    '''
+
+    def __init__(self, grace=300, refreshAhead=0.1, hotHits=3,
+                 maxConcurrent=4, maxTracked=100000):
+        '''
+        Create a new OEmbedRefresher object.
+
+        Args:
+            grace: Seconds after their expiry during which responses are
+                   still returned while they are refreshed.
+            refreshAhead: Fraction of the time to live of a response before
+                          its expiry when hot responses are refreshed, 0 to
+                          disable refreshing ahead.
+            hotHits: Number of reads making a response hot.
+            maxConcurrent: Maximum number of refreshes running at a time.
+            maxTracked: Maximum number of responses whose reads are counted.
+        '''
+        self._grace = grace
+        self._refreshAhead = refreshAhead
+        self._hotHits = hotHits
+        self._maxConcurrent = maxConcurrent
+        self._maxTracked = maxTracked
+        self._hits = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def getGrace(self):
+        '''
+        Get the grace period.
+
+        Returns:
+            The seconds during which expired responses are still returned.
+        '''
+        return self._grace
+
+    def _due(self, key, remaining, ttl):
+        # Count a read of a fresh response, and tell whether it is hot and
+        # close enough to its expiry to be refreshed.
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                if len(self._hits) >= self._maxTracked:
+                    self._hits.clear()
+                hits = 0
+            hits = self._hits[key] = hits + 1
+        return hits >= self._hotHits and \
+            remaining <= self._refreshAhead * ttl
+
+    def _begin(self, key):
+        with self._lock:
+            if key in self._running or \
+               len(self._running) >= self._maxConcurrent:
+                return False
+            self._running.add(key)
+            self._hits.pop(key, None)
+            return True
+
+    def _end(self, key):
+        with self._lock:
+            self._running.discard(key)
+
+
+class OEmbedSizeBuckets(object):
+    '''
+    Rounds the maxwidth and maxheight of requests down to a few sizes, so
+    that clients asking for every possible size share a few provider
+    requests and cache entries.
+
+    Photo and video responses can also be scaled down from a cached response
+    of a larger size instead of fetching the smaller one.
+    '''
+
+    defaultSizes = (160, 240, 320, 480, 640, 800, 1024, 1280, 1600, 1920)
+
+    _widthAttr = re.compile(r'(\bwidth=["\']?)(\d+)')
+    _heightAttr = re.compile(r'(\bheight=["\']?)(\d+)')
+
+    def __init__(self, widths=defaultSizes, heights=None, scale=True,
+                 maxVariants=4):
+        '''
+        Create a new OEmbedSizeBuckets object.
+
+        Args:
+            widths: The maxwidth values sent to providers. A maxwidth is
+                    rounded down to the nearest of them, and left as it is
+                    when smaller than all of them.
+            heights: The maxheight values sent to providers, by default the
+                     same as widths.
+            scale: Whether to scale photo and video responses cached for a
+                   larger size.
+            maxVariants: Maximum number of larger sizes looked up in the
+                         cache for a request, closest first.
+        '''
+        self._widths = tuple(sorted(widths))
+        self._heights = tuple(sorted(heights)) if heights is not None \
+            else self._widths
+        self._scale = scale
+        self._maxVariants = maxVariants
+
+    @staticmethod
+    def _bucket(value, sizes):
+        bucket = value
+        for size in sizes:
+            if size > value:
+                break
+            bucket = size
+        return bucket
+
+    def round(self, opt):
+        '''
+        Round the size of a request.
+
+        Args:
+            opt: The optional parameters of the request.
+
+        Returns:
+            A copy of opt with maxwidth and maxheight rounded down to their
+            bucket.
+        '''
+        opt = dict(opt)
+        for name, sizes in (('maxwidth', self._widths),
+                            ('maxheight', self._heights)):
+            if name in opt:
+                try:
+                    opt[name] = self._bucket(int(opt[name]), sizes)
+                except (TypeError, ValueError):
+                    pass
+        return opt
+
+    def variants(self, opt):
+        '''
+        Get the larger requests whose photo and video responses can be
+        scaled down for a request.
+
+        Args:
+            opt: The optional parameters of the request, already rounded.
+
+        Returns:
+            A list of at most maxVariants copies of opt with a larger
+            maxwidth or maxheight, closest first. Empty if scaling is
+            disabled or the request has no size.
+        '''
+        if not self._scale or not self._maxVariants:
+            return []
+        candidates = []
+        for name, sizes in (('maxwidth', self._widths),
+                            ('maxheight', self._heights)):
+            value = opt.get(name)
+            if isinstance(value, int):
+                # Sorted by the sum of the sizes, a combination with the
+                # n-th larger size comes after n - 1 others at least, so
+                # the sizes past maxVariants are never reached.
+                larger = [(name, size) for size in sizes if size > value]
+                candidates.append([(name, value)] +
+                                  larger[:self._maxVariants])
+        if not candidates:
+            return []
+        combinations = [[]]
+        for choices in candidates:
+            combinations = [c + [choice] for c in combinations
+                            for choice in choices]
+        combinations.sort(key=lambda c: sum([size for name, size in c]))
+        return [dict(opt, **dict(c))
+                for c in combinations[1:self._maxVariants + 1]]
+
+    def scale(self, response, opt):
+        '''
+        Scale a photo or video response down to the size of a request.
+
+        The width and height fields keep their aspect ratio, and so do the
+        width and height attributes of the html of videos.
+
+        Args:
+            response: An OEmbedResponse of a larger request.
+            opt: The optional parameters of the request.
+
+        Returns:
+            A new OEmbedResponse, or None if the response is not a photo or
+            a video with a numeric size.
+        '''
+        if not isinstance(response, (OEmbedPhotoResponse,
+                                     OEmbedVideoResponse)):
+            return None
+        try:
+            width = int(float(response['width']))
+            height = int(float(response['height']))
+        except (TypeError, ValueError):
+            return None
+        factor = 1.0
+        if opt.get('maxwidth') and width > opt['maxwidth']:
+            factor = float(opt['maxwidth']) / width
+        if opt.get('maxheight') and height > opt['maxheight']:
+            factor = min(factor, float(opt['maxheight']) / height)
+        if factor == 1.0:
+            return response
+
+        data = response.getData()
+        data['width'] = max(1, int(round(width * factor)))
+        data['height'] = max(1, int(round(height * factor)))
+        if isinstance(response, OEmbedVideoResponse) and data['html']:
+            html = self._widthAttr.sub(
+                lambda m: m.group(1) + str(data['width']) \
+                if int(m.group(2)) == width else m.group(0), data['html'])
+            data['html'] = self._heightAttr.sub(
+                lambda m: m.group(1) + str(data['height']) \
+                if int(m.group(2)) == height else m.group(0), html)
+        return OEmbedResponse.createLoad(data)
+
+
+class _LinkParser(HTMLParser):
+    '''Collects the oEmbed <link> tags of the head of an HTML page.'''
+
+    _types = ('application/json+oembed', 'text/xml+oembed',
+              'application/xml+oembed')
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = {}
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'link':
+            attrs = dict(attrs)
+            rel = (attrs.get('rel') or '').lower().split()
+            linkType = (attrs.get('type') or '').lower()
+            if 'alternate' in rel and linkType in self._types and \
+               attrs.get('href'):
+                self.links.setdefault(linkType, attrs['href'])
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+    def getLink(self):
+        for linkType in self._types:
+            if linkType in self.links:
+                return self.links[linkType]
+        return None
+
+
+class OEmbedDiscovery(object):
+    '''
+    Finds the endpoint of a url from the oEmbed <link> tags of its page.
+
+    Pages are streamed and parsing stops at the end of the head, or after a
+    number of bytes. The api url of each discovered endpoint is cached per
+    host, so the following urls of the same site go straight to the
+    provider.
+    '''
+
+    def __init__(self, maxBytes=64 * 1024, ttl=86400, cache=None, pool=None,
+                 endpointFactory=OEmbedEndpoint, maxEndpoints=1000):
+        '''
+        Create a new OEmbedDiscovery object.
+
+        Args:
+            maxBytes: Maximum number of bytes of a page to read.
+            ttl: Seconds to keep the endpoint discovered for a host.
+            cache: An OEmbedCache for the discovered api urls, by default an
+                   OEmbedMemoryCache of 1000 hosts.
+            pool: The OEmbedConnectionPool used to fetch pages, by default
+                  defaultConnectionPool.
+            endpointFactory: A callable creating the OEmbedEndpoint of a
+                             discovered api url, to set its timeouts or
+                             retries for instance.
+            maxEndpoints: Maximum number of discovered endpoints kept, the
+                          least recently used are dropped.
+        '''
+        self._maxBytes = maxBytes
+        self._ttl = ttl
+        self._cache = cache if cache is not None else OEmbedMemoryCache(1000)
+        self._pool = pool
+        self._endpointFactory = endpointFactory
+        self._maxEndpoints = maxEndpoints
+        self._endpoints = OrderedDict()
+        self._lock = threading.Lock()
+        self._requestHeaders = {'User-Agent': 'python-oembed',
+                                'Accept': 'text/html,application/xhtml+xml'}
+
+    def _key(self, url):
+        parts = urlsplit(url)
+        return 'discovery %s://%s' % (parts.scheme.lower(),
+                                      parts.netloc.lower())
+
+    def _endpoint(self, apiUrl):
+        with self._lock:
+            endpoint = self._endpoints.pop(apiUrl, None)
+            if endpoint is None:
+                endpoint = self._endpointFactory(apiUrl)
+                while len(self._endpoints) >= self._maxEndpoints:
+                    self._endpoints.popitem(last=False)
+            self._endpoints[apiUrl] = endpoint
+            return endpoint
+
+    def lookup(self, url, discover=True, timeout=None):
+        '''
+        Get the endpoint of a url.
+
+        Args:
+            url: The url of an OEmbed resource.
+            discover: False to only use the endpoints already discovered.
+            timeout: Seconds allowed to connect and for each read of the
+                     page, None for the timeout of the pool.
+
+        Returns:
+            An OEmbedEndpoint, or None if the page has no oEmbed link.
+        '''
+        key = self._key(url)
+        apiUrl = self._cache.get(key)
+        if apiUrl is None and discover:
+            apiUrl = self.discover(url, timeout)
+            if apiUrl is not None:
+                self._cache.set(key, apiUrl, self._ttl)
+        if apiUrl is None:
+            return None
+        return self._endpoint(apiUrl)
+
+    def discover(self, url, timeout=None):
+        '''
+        Fetch the page of a url and find its oEmbed endpoint.
+
+        Args:
+            url: The url of the page.
+            timeout: Seconds allowed to connect and for each read of the
+                     page, None for the timeout of the pool.
+
+        Returns:
+            The api url of the endpoint, without the url and format
+            parameters, or None if the page has no oEmbed link.
+        '''
+        href = self.findLink(url, timeout)
+        if href is None:
+            return None
+        parts = urlsplit(urljoin(url, href))
+        params = [(k, v) for k, v in parse_qsl(parts.query, True) \
+                  if k not in ('url', 'format')]
+        return urlunsplit((parts.scheme, parts.netloc, parts.path,
+                           urllib.urlencode(params), ''))
+
+    def findLink(self, url, timeout=None):
+        '''
+        Fetch the page of a url and get the href of its oEmbed <link> tag,
+        preferring JSON over XML.
+
+        Args:
+            url: The url of the page.
+            timeout: Seconds allowed to connect and for each read of the
+                     page, None for the timeout of the pool.
+
+        Returns:
+            The href of the link, or None if there is none or the page can
+            not be fetched.
+        '''
+        try:
+            response = (self._pool or defaultConnectionPool).open(
+                url, self._requestHeaders,
+                (timeout, timeout) if timeout is not None else None,
+                self._maxBytes)
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            return None
+
+        try:
+            contentType = response.info().get('Content-Type') or ''
+            m = re.search(r'charset=["\']?([\w.:-]+)', contentType)
+            try:
+                decoder = codecs.getincrementaldecoder(
+                    m.group(1) if m else 'utf-8')('replace')
+            except LookupError:
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+            parser = _LinkParser()
+            total = 0
+            while not parser.done and total < self._maxBytes:
+                chunk = response.read(min(_CHUNK_SIZE, self._maxBytes - total))
+                if not chunk:
+                    break
+                total += len(chunk)
+                parser.feed(decoder.decode(chunk))
+            return parser.getLink()
+        except (socket.error, httplib.HTTPException):
+            return None
+        finally:
+            response.close()
+
+
+class OEmbedTiming(object):
+    '''
+    The durations of the phases of an embed, as reported to the observers of
+    an OEmbedConsumer.
+
+    Attributes:
+        url: The url of the resource.
+        phases: A dict of durations in seconds. The phases are 'match'
+                (finding the endpoint), 'request' (building the request url),
+                'queue' (waiting for the rate limit of the endpoint),
+                'network' (connecting and reading), 'decode' (JSON or XML
+                decoding) and 'parse' (creating and validating the response).
+                Phases that did not run are missing.
+        total: The duration of the whole embed in seconds.
+        bytesRead: Number of bytes of response body read.
+        tags: A dict describing the embed: 'endpoint' (the api url),
+              'outcome' ('fetch', 'hit' for a cached response, 'stale'
+              for an expired response being refreshed, 'scaled' for a
+              response scaled from a larger cached one, 'negative' for a
+              cached error, 'coalesced' for a shared fetch, or
+              'error'), 'error' (the exception class name), 'mimeType' and
+              'hedged' (whether a second request was sent, for endpoints
+              with hedging).
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.phases = {}
+        self.total = None
+        self.bytesRead = 0
+        self.tags = {}
+        self._start = _clock()
+
+    def addPhase(self, phase, seconds):
+        '''
+        Add time to a phase.
+
+        Args:
+            phase: The name of the phase.
+            seconds: The duration to add.
+        '''
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def merge(self, other):
+        '''
+        Add the phases, bytes and tags of another timing to this one.
+
+        Args:
+            other: An OEmbedTiming.
+        '''
+        for phase, seconds in other.phases.items():
+            self.addPhase(phase, seconds)
+        self.bytesRead += other.bytesRead
+        self.tags.update(other.tags)
+
+    def finish(self):
+        '''Record the total duration.'''
+        self.total = _clock() - self._start
+
+    def __repr__(self):
+        return '<OEmbedTiming %s %s %s>' % (self.url, self.tags, self.phases)
+
+
+class _Call(object):
+    def __init__(self, deadline=None):
+        self.done = threading.Event()
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+
+
+class _SingleFlight(object):
+    '''
+    Runs at most one call per key at a time. Callers arriving while a call
+    is in flight wait for it and get its result or exception.
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, deadline, fn, *args):
+        # A caller with a deadline waits for the call in flight until then.
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call(deadline)
+
+            if leader:
+                break
+            if deadline is None:
+                call.done.wait()
+            elif not call.done.wait(deadline.left()):
+                raise OEmbedTimeout('Deadline exceeded')
+            if call.error is None:
+                return call.result
+            if not (call.deadline is not None and call.deadline.passed() and
+                    _isTimeout(call.error)):
+                raise call.error
+            # The call ran out of the time of its own caller, make another.
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Registry(object):
+    '''
+    An immutable snapshot of the endpoints of an OEmbedConsumer, with the
+    index of their url schemes built on first use.
+    '''
+    __slots__ = ('endpoints', 'generation', 'index')
+
+    def __init__(self, endpoints, generation):
+        self.endpoints = endpoints
+        # Negative results of a previous registry no longer apply.
+        self.generation = generation
+        self.index = None
+
+    def lookup(self, url):
+        index = self.index
+        if index is None:
+            # Threads racing here build equal indexes; any of them will do.
+            index = self.index = OEmbedUrlIndex(self.endpoints)
+        return index.lookup(url)
+
+
+class OEmbedConsumer(object):
+    '''
     A class representing an OEmbed consumer.
 
     This class manages a number of endpoints, selects the corresponding one
     according to the resource url passed to the embed function and fetches
     the data.
+
+    Endpoints can be added, removed or replaced while other threads embed:
+    each change swaps in a new snapshot of the endpoints, and embeds use the
+    snapshot current when they start, without locking.
     '''
     def __init__(self):
-        self._endpoints = []
+        self._registry = _Registry((), 0)
+        self._registryLock = threading.Lock()
+        self._cache = None
+        self._defaultTtl = 3600
+        self._maxTtl = 86400
+        self._revalidateTtl = 86400
+        self._flight = _SingleFlight()
+        self._negativeCache = None
+        self._noEndpointTtl = 60
+        self._errorTtl = 300
+        self._errorCodes = (401, 403, 404, 410, 501)
+        self._observers = ()
+        self._discovery = None
+        self._canonicalizer = None
+        self._refresher = None
+        self._sizeBuckets = None
 
     def addEndpoint(self, endpoint):
         '''
@@ -449,7 +2915,7 @@ class OEmbedConsumer(object):
         Args:
             endpoint: An instance of an OEmbedEndpoint class.
         '''
-        self._endpoints.append(endpoint)
+        self._addEndpoints([endpoint])
 
     def delEndpoint(self, endpoint):
         '''
@@ -458,34 +2924,536 @@ class OEmbedConsumer(object):
         Args:
             endpoint: An instance of an OEmbedEndpoint class.
         '''
-        self._endpoints.remove(endpoint)
+        with self._registryLock:
+            endpoints = list(self._registry.endpoints)
+            endpoints.remove(endpoint)
+            self._swap(endpoints)
 
     def clearEndpoints(self):
         '''Clear all the endpoints managed by this consumer.'''
-        del self._endpoints[:]
+        self.setEndpoints([])
+
+    def setEndpoints(self, endpoints):
+        '''
+        Replace all the endpoints managed by this consumer at once. Embeds
+        running meanwhile use either the previous endpoints or the new ones,
+        never a mix or none.
+
+        Args:
+            endpoints: A list of OEmbedEndpoint instances.
+        '''
+        with self._registryLock:
+            self._swap(list(endpoints))
 
     def getEndpoints(self):
         '''
         Get the list of endpoints.
 
         Returns:
-            The list of endpoints in this consumer.
+            A copy of the list of endpoints in this consumer.
         '''
-        return self._endpoints
+        return list(self._registry.endpoints)
+
+    def _addEndpoints(self, endpoints, replace=False):
+        with self._registryLock:
+            if replace:
+                self._swap(endpoints)
+            else:
+                endpoints = list(endpoints)
+                self._swap(list(self._registry.endpoints) + endpoints,
+                           endpoints)
+
+    def _swap(self, endpoints, added=None):
+        # Install a new registry. Called with the registry lock held; added
+        # are the endpoints appended to the current ones, if that is all.
+        # Only the endpoints added or removed change their listeners.
+        old = self._registry.endpoints
+        if added is None:
+            oldIds = set(id(endpoint) for endpoint in old)
+            newIds = set(id(endpoint) for endpoint in endpoints)
+            for endpoint in old:
+                if id(endpoint) not in newIds:
+                    endpoint.delListener(self._invalidateIndex)
+            added = [endpoint for endpoint in endpoints
+                     if id(endpoint) not in oldIds]
+        for endpoint in added:
+            endpoint.addListener(self._invalidateIndex)
+        self._registry = _Registry(tuple(endpoints),
+                                   self._registry.generation + 1)
+
+    def loadProviders(self, providers, replace=False):
+        '''
+        Add the endpoints of a list of providers, in the format of the
+        providers.json file published at http://oembed.com/providers.json
 
-    def _endpointFor(self, url):
-        for endpoint in self._endpoints:
-            if endpoint.match(url):
-                return endpoint
-        return None
+        Args:
+            providers: A list of provider dicts, each with a list of endpoints
+                       holding the api url and its url schemes.
+            replace: Whether to replace the current endpoints, at once,
+                     instead of adding to them.
+
+        Returns:
+            The list of endpoints added.
+        '''
+        endpoints = []
+        for provider in providers:
+            for spec in provider.get('endpoints', []):
+                endpoint = OEmbedEndpoint(spec['url'])
+                for urlScheme in spec.get('schemes', []):
+                    endpoint.addUrlScheme(str(urlScheme))
+                endpoints.append(endpoint)
+        self._addEndpoints(endpoints, replace)
+        return endpoints
+
+    def loadProvidersFile(self, path, replace=False):
+        '''
+        Add the endpoints of a providers.json file.
+
+        Args:
+            path: Path of the file.
+            replace: Whether to replace the current endpoints, at once,
+                     instead of adding to them.
+
+        Returns:
+            The list of endpoints added.
+        '''
+        with open(path, 'rb') as f:
+            return self.loadProviders(json_decode(f.read().decode('utf8')),
+                                      replace)
+
+    def saveIndex(self, path):
+        '''
+        Save the endpoints of this consumer, with their url schemes already
+        analyzed, to a file that loadIndex reads back quickly.
+
+        Args:
+            path: Path of the file.
+        '''
+        endpoints = []
+        for endpoint in self._registry.endpoints:
+            schemes = []
+            for url, urlScheme in sorted(endpoint.getUrlSchemes().items()):
+                schemes.append([url, urlScheme.getIndexKey()])
+            endpoints.append({'url': endpoint._urlApi, 'schemes': schemes})
+        data = json_encode({'version': 1, 'endpoints': endpoints})
+        with open(path, 'wb') as f:
+            f.write(data.encode('utf8'))
+
+    def loadIndex(self, path, replace=False):
+        '''
+        Add the endpoints saved with saveIndex.
+
+        Args:
+            path: Path of the file.
+            replace: Whether to replace the current endpoints, at once,
+                     instead of adding to them.
+
+        Returns:
+            The list of endpoints added.
+        '''
+        with open(path, 'rb') as f:
+            data = json_decode(f.read().decode('utf8'))
+        if data.get('version') != 1:
+            raise OEmbedError('Unsupported index file version: %s' % \
+                              data.get('version'))
+
+        endpoints = []
+        for spec in data['endpoints']:
+            endpoint = OEmbedEndpoint(spec['url'])
+            urlSchemes = {}
+            for url, key in spec['schemes']:
+                url = str(url)
+                urlScheme = urlSchemes[url] = OEmbedUrlScheme(url)
+                urlScheme._indexKey = tuple(key) if key else None
+            endpoint._urlSchemes = urlSchemes
+            endpoints.append(endpoint)
+        self._addEndpoints(endpoints, replace)
+        return endpoints
+
+    def setCache(self, cache, defaultTtl=3600, maxTtl=86400,
+                 revalidateTtl=86400):
+        '''
+        Cache the responses fetched by this consumer.
+
+        Responses are fresh for the number of seconds given in their
+        cache_age field, or defaultTtl if they have none, and never longer
+        than maxTtl. Expired responses sent with an ETag or Last-Modified
+        header are kept revalidateTtl seconds more, and refreshed with a
+        conditional request that reuses them when the provider answers
+        304 Not Modified.
+
+        Args:
+            cache: An OEmbedCache instance, or None to disable caching.
+            defaultTtl: Seconds to keep responses without a cache_age.
+            maxTtl: Maximum number of seconds to keep any response.
+            revalidateTtl: Seconds to keep expired responses that can be
+                           revalidated, 0 to disable revalidation.
+        '''
+        self._cache = cache
+        self._defaultTtl = defaultTtl
+        self._maxTtl = maxTtl
+        self._revalidateTtl = revalidateTtl
+
+    def getCache(self):
+        '''
+        Get the response cache.
+
+        Returns:
+            The OEmbedCache used by this consumer, or None.
+        '''
+        return self._cache
+
+    def addObserver(self, observer):
+        '''
+        Register a callable to be invoked after each embed with the
+        OEmbedTiming of its phases. Embeds are not timed while no observer
+        is registered.
+
+        Args:
+            observer: A callable taking an OEmbedTiming as its only argument.
+        '''
+        if observer not in self._observers:
+            self._observers += (observer,)
+
+    def delObserver(self, observer):
+        '''
+        Unregister a callable added with addObserver.
+
+        Args:
+            observer: The callable to remove.
+        '''
+        self._observers = tuple([o for o in self._observers if o != observer])
+
+    def setCanonicalizer(self, canonicalizer):
+        '''
+        Rewrite the urls of resources to a canonical form before matching
+        them, so that the forms of a url share their request and cache
+        entry.
+
+        Args:
+            canonicalizer: An OEmbedCanonicalizer, or None to use urls as
+                           they are given.
+        '''
+        self._canonicalizer = canonicalizer
+        # Urls recorded as missing were not canonical.
+        self._invalidateIndex()
+
+    def getCanonicalizer(self):
+        '''
+        Get the url canonicalizer.
+
+        Returns:
+            The OEmbedCanonicalizer used by this consumer, or None.
+        '''
+        return self._canonicalizer
+
+    def setRefresher(self, refresher):
+        '''
+        Refresh cached responses in the background: return expired responses
+        during a grace period while they are fetched again, and refresh
+        frequently read responses before they expire. Requires a cache.
+
+        Args:
+            refresher: An OEmbedRefresher instance, or None to fetch expired
+                       responses in the embed that finds them.
+        '''
+        self._refresher = refresher
+
+    def getRefresher(self):
+        '''
+        Get the background refresher.
+
+        Returns:
+            The OEmbedRefresher used by this consumer, or None.
+        '''
+        return self._refresher
 
-    def _request(self, url, **opt):
-        endpoint = self._endpointFor(url)
+    def setSizeBuckets(self, sizeBuckets):
+        '''
+        Round the maxwidth and maxheight of requests to a few sizes, and
+        scale photos and videos cached for a larger size.
+
+        Args:
+            sizeBuckets: An OEmbedSizeBuckets instance, or None to send sizes
+                         as they are given.
+        '''
+        self._sizeBuckets = sizeBuckets
+
+    def getSizeBuckets(self):
+        '''
+        Get the size buckets.
+
+        Returns:
+            The OEmbedSizeBuckets used by this consumer, or None.
+        '''
+        return self._sizeBuckets
+
+    def setDiscovery(self, discovery):
+        '''
+        Look for the endpoint of urls that match no url scheme in the
+        <link> tags of their page, as described in http://oembed.com/
+
+        Args:
+            discovery: An OEmbedDiscovery instance, or None to disable
+                       discovery.
+        '''
+        self._discovery = discovery
+        self._invalidateIndex()
+
+    def getDiscovery(self):
+        '''
+        Get the endpoint discovery.
+
+        Returns:
+            The OEmbedDiscovery used by this consumer, or None.
+        '''
+        return self._discovery
+
+    def setNegativeCache(self, cache, noEndpointTtl=60, errorTtl=300,
+                         errorCodes=(401, 403, 404, 410, 501)):
+        '''
+        Cache negative results: urls without an endpoint and provider errors
+        for a resource, such as a private or deleted video. Urls without an
+        endpoint are looked up again as soon as endpoints or url schemes
+        change.
+
+        Args:
+            cache: An OEmbedCache instance, or None to disable negative caching.
+            noEndpointTtl: Seconds to remember that a url has no endpoint.
+            errorTtl: Seconds to remember a provider error.
+            errorCodes: HTTP status codes of the provider errors to remember.
+        '''
+        self._negativeCache = cache
+        self._noEndpointTtl = noEndpointTtl
+        self._errorTtl = errorTtl
+        self._errorCodes = tuple(errorCodes)
+
+    def _cacheKey(self, endpoint, url, opt):
+        params = sorted([(k, '%s' % v) for k, v in opt.items()])
+        return '%s %s %s' % (endpoint._urlApi, url, urllib.urlencode(params))
+
+    def _cacheTtl(self, response):
+        try:
+            ttl = int(float(response['cache_age']))
+        except (TypeError, ValueError):
+            ttl = self._defaultTtl
+        return min(ttl, self._maxTtl)
+
+    def _invalidateIndex(self, endpoint=None):
+        # The url schemes of an endpoint changed.
+        with self._registryLock:
+            self._registry = _Registry(self._registry.endpoints,
+                                       self._registry.generation + 1)
+
+    def _endpointFor(self, url):
+        return self._registry.lookup(url)
+
+    def _lookup(self, url, discover=True, deadline=None):
+        # With discover False, urls that need discovery through the network
+        # return None instead of raising OEmbedNoEndpoint.
+        registry = self._registry
+        negativeCache = self._negativeCache
+        if negativeCache is not None:
+            missKey = 'noendpoint %d %s' % (registry.generation, url)
+            if negativeCache.get(missKey) is not None:
+                raise OEmbedNoEndpoint('There are no endpoints available for %s' % url)
+
+        endpoint = registry.lookup(url)
+        if endpoint is None and self._discovery is not None:
+            if deadline is None:
+                endpoint = self._discovery.lookup(url, discover)
+            else:
+                endpoint = self._discovery.lookup(url, discover,
+                                                  deadline.left())
+                # A page cut short is not a url without an endpoint.
+                deadline.left()
+            if endpoint is None and not discover:
+                return None
         if endpoint is None:
+            if negativeCache is not None:
+                negativeCache.set(missKey, True, self._noEndpointTtl)
             raise OEmbedNoEndpoint('There are no endpoints available for %s' % url)
-        return endpoint.get(url, **opt)
+        return endpoint
+
+    def _resolve(self, url, discover=True, deadline=None):
+        # Find the endpoint of url and the canonical form of url.
+        canonical = url
+        if self._canonicalizer is not None:
+            canonical = self._canonicalizer.canonicalize(url)
+        endpoint = self._lookup(canonical, discover, deadline)
+        if endpoint is not None and endpoint._canonicalRules:
+            canonical = endpoint.canonicalize(canonical)
+        if self._canonicalizer is not None:
+            self._canonicalizer.record(url, canonical)
+        return endpoint, canonical
+
+    def _request(self, url, opt, timing=None, deadline=None):
+        if timing is None:
+            endpoint, url = self._resolve(url, deadline=deadline)
+            return self._get(endpoint, url, opt, deadline=deadline)
+
+        start = _clock()
+        endpoint, url = self._resolve(url, deadline=deadline)
+        timing.addPhase('match', _clock() - start)
+        timing.tags['endpoint'] = endpoint._urlApi
+        return self._get(endpoint, url, opt, timing, deadline)
+
+    def _timed(self, url, fn, *args):
+        # Run fn with a new OEmbedTiming and report it to the observers.
+        timing = OEmbedTiming(url)
+        try:
+            return fn(*(args + (timing,)))
+        except Exception as e:
+            timing.tags['outcome'] = 'error'
+            timing.tags['error'] = e.__class__.__name__
+            raise
+        finally:
+            timing.finish()
+            for observer in self._observers:
+                observer(timing)
+
+    def _cached(self, key, timing=None, refresh=None):
+        if self._cache is not None:
+            entry = self._cache.get(key)
+            if entry is not None:
+                now = time.time()
+                if entry.expires > now:
+                    if refresh is not None and self._refresher._due(
+                            key, entry.expires - now,
+                            self._cacheTtl(entry.response)):
+                        refresh()
+                    if timing is not None:
+                        timing.tags['outcome'] = 'hit'
+                    return entry.response
+                if refresh is not None and \
+                   now < entry.expires + self._refresher._grace:
+                    refresh()
+                    if timing is not None:
+                        timing.tags['outcome'] = 'stale'
+                    return entry.response
+        if self._negativeCache is not None:
+            error = self._negativeCache.get('error ' + key)
+            if error is not None:
+                if timing is not None:
+                    timing.tags['outcome'] = 'negative'
+                url, code, msg = error
+                raise urllib2.HTTPError(url, code, msg, None, None)
+        return None
 
-    def embed(self, url, format='json', **opt):
+    def _scaled(self, endpoint, url, opt, timing=None):
+        # A photo or video cached for a larger size, scaled down.
+        if self._sizeBuckets is None or self._cache is None:
+            return None
+        now = time.time()
+        for variant in self._sizeBuckets.variants(opt):
+            entry = self._cache.get(self._cacheKey(endpoint, url, variant))
+            if entry is None or entry.expires <= now:
+                continue
+            response = self._sizeBuckets.scale(entry.response, opt)
+            if response is not None:
+                if timing is not None:
+                    timing.tags['outcome'] = 'scaled'
+                return response
+        return None
+
+    def _stale(self, key):
+        # An expired response that can be revalidated.
+        if key is not None and self._cache is not None and \
+           self._revalidateTtl > 0:
+            entry = self._cache.get(key)
+            if entry is not None:
+                return entry.response
+        return None
+
+    def _store(self, key, response):
+        if key is not None and self._cache is not None:
+            ttl = self._cacheTtl(response)
+            extra = 0
+            if self._refresher is not None:
+                extra = self._refresher._grace
+            if response._etag is not None or \
+               response._lastModified is not None:
+                extra = max(extra, self._revalidateTtl)
+            keep = ttl + extra
+            if keep > 0:
+                self._cache.set(key, _CacheEntry(response, time.time() + ttl),
+                                keep)
+
+    def _storeError(self, key, error):
+        if key is not None and self._negativeCache is not None and \
+           error.code in self._errorCodes:
+            self._negativeCache.set('error ' + key,
+                                    (error.filename, error.code, error.msg),
+                                    self._errorTtl)
+
+    def _get(self, endpoint, url, opt, timing=None, deadline=None):
+        if self._sizeBuckets is not None:
+            opt = self._sizeBuckets.round(opt)
+        key = None
+        if self._cache is not None or self._negativeCache is not None:
+            key = self._cacheKey(endpoint, url, opt)
+            refresh = None
+            if self._refresher is not None and self._cache is not None:
+                refresh = lambda: self._refresh(endpoint, url, opt, key)
+            response = self._cached(key, timing, refresh)
+            if response is None:
+                response = self._scaled(endpoint, url, opt, timing)
+            if response is not None:
+                return response
+
+        if timing is None:
+            requestUrl = endpoint.request(url, **opt)
+        else:
+            start = _clock()
+            requestUrl = endpoint.request(url, **opt)
+            timing.addPhase('request', _clock() - start)
+            timing.tags['outcome'] = 'coalesced'
+
+        # Concurrent requests for the same resource share a single fetch.
+        return self._flight.do(requestUrl, deadline, self._fetch, endpoint,
+                               requestUrl, key, timing, deadline)
+
+    def _fetch(self, endpoint, requestUrl, key, timing=None, deadline=None):
+        previous = self._stale(key)
+        try:
+            if timing is None:
+                response = endpoint._fetchWithin(requestUrl, None, previous,
+                                                 deadline)
+            else:
+                timing.tags['outcome'] = 'fetch'
+                response = endpoint._fetchWithin(requestUrl, timing, previous,
+                                                 deadline)
+                if previous is not None and response is previous:
+                    timing.tags['outcome'] = 'revalidated'
+        except urllib2.HTTPError as e:
+            self._storeError(key, e)
+            raise
+        self._store(key, response)
+        return response
+
+    def _refresh(self, endpoint, url, opt, key):
+        # Fetch a cached response again in a new thread.
+        refresher = self._refresher
+        if not refresher._begin(key):
+            return
+
+        def run():
+            try:
+                requestUrl = endpoint.request(url, **opt)
+                self._flight.do(requestUrl, None, self._fetch, endpoint,
+                                requestUrl, key)
+            except Exception:
+                # The cached response is still returned until its grace
+                # period ends, and the refresh tried again meanwhile.
+                pass
+            finally:
+                refresher._end(key)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def embed(self, url, format='json', deadline=None, **opt):
         '''
         Get an OEmbedResponse from one of the providers configured in this
         consumer according to the resource url.
@@ -493,6 +3461,10 @@ class OEmbedConsumer(object):
         Args:
             url: The url of the resource to get.
             format: Desired response format.
+            deadline: Maximum number of seconds the embed may take, None for
+                      no limit. The timeouts of its requests are cut to the
+                      time left, and OEmbedTimeout is raised once the
+                      deadline has passed.
             **opt: Optional parameters to pass in the url to the provider.
 
         Returns:
@@ -501,7 +3473,208 @@ class OEmbedConsumer(object):
         if format not in ['json', 'xml']:
             raise OEmbedInvalidRequest('Format must be json or xml')
         opt['format'] = format
-        return self._request(url, **opt)
+        if deadline is not None:
+            if self._observers:
+                return self._timed(url, self._requestWithin, deadline, url,
+                                   opt)
+            return self._requestWithin(deadline, url, opt)
+        if self._observers:
+            return self._timed(url, self._request, url, opt)
+        return self._request(url, opt)
+
+    def _requestWithin(self, deadline, url, opt, timing=None):
+        limit = _Deadline(deadline)
+        try:
+            return self._request(url, opt, timing, limit)
+        except Exception as e:
+            # Timeouts cut to the deadline end with it.
+            if not (isinstance(e, OEmbedTimeout) or
+                    (_isTimeout(e) and limit.passed())):
+                raise
+        raise OEmbedTimeout('Embed of %s exceeded its deadline of %s '
+                            'seconds' % (url, deadline))
+
+    def embedMany(self, urls, format='json', workers=8, maxPerEndpoint=4,
+                  **opt):
+        '''
+        Get the OEmbedResponse of many resources, fetching them in parallel.
+
+        Args:
+            urls: A sequence of resource urls.
+            format: Desired response format.
+            workers: Number of threads fetching resources.
+            maxPerEndpoint: Maximum number of concurrent requests per endpoint.
+            **opt: Optional parameters to pass in the url to the provider.
+
+        Returns:
+            A list with an item per url, in the same order: the OEmbedResponse
+            of the url, or the exception raised while embedding it.
+        '''
+        urls = list(urls)
+        results = dict(self.iterEmbedMany(urls, format, workers,
+                                          maxPerEndpoint, **opt))
+        return [results[url] for url in urls]
+
+    def iterEmbedMany(self, urls, format='json', workers=8, maxPerEndpoint=4,
+                      window=None, **opt):
+        '''
+        Fetch many resources in parallel, yielding them as they complete.
+
+        Duplicated urls are fetched once. Endpoints are served round-robin so
+        that a provider with many urls does not delay the others.
+
+        Args:
+            urls: An iterable of resource urls.
+            format: Desired response format.
+            workers: Number of threads fetching resources.
+            maxPerEndpoint: Maximum number of concurrent requests per endpoint.
+            window: Maximum number of urls read ahead of the results, None
+                    to read them all first. With a window, urls are read as
+                    results are yielded, and duplicates are only fetched
+                    once while in the window.
+            **opt: Optional parameters to pass in the url to the provider.
+
+        Returns:
+            A generator of (url, result) tuples, where result is the
+            OEmbedResponse of the url or the exception raised embedding it.
+        '''
+        if format not in ['json', 'xml']:
+            raise OEmbedInvalidRequest('Format must be json or xml')
+        opt['format'] = format
+
+        urls = iter(urls)
+        batch = _Batch(maxPerEndpoint)
+        done = Queue.Queue()
+        # Urls read and not yielded yet, and by canonical url the other urls
+        # of the same canonical url, fetched once for all of them.
+        waiting = set()
+        aliases = {}
+        started = 0
+
+        def work():
+            while True:
+                job = batch.next()
+                if job is None:
+                    return
+                endpoint, (url, canonical) = job
+                try:
+                    if endpoint is None:
+                        args = (self._request, url, opt)
+                    else:
+                        args = (self._get, endpoint, canonical, opt)
+                    if self._observers:
+                        result = self._timed(url, *args)
+                    else:
+                        result = args[0](*args[1:])
+                except Exception as e:
+                    result = e
+                batch.finish(endpoint)
+                done.put((url, canonical, result))
+
+        reading = True
+        try:
+            while True:
+                while reading and (window is None or len(waiting) < window):
+                    url = next(urls, _missing)
+                    if url is _missing:
+                        reading = False
+                        batch.close()
+                        break
+                    if url in waiting:
+                        continue
+                    try:
+                        # Urls needing discovery are grouped under None and
+                        # looked up by the workers.
+                        endpoint, canonical = self._resolve(url, discover=False)
+                    except OEmbedNoEndpoint as e:
+                        yield url, e
+                        continue
+                    waiting.add(url)
+                    if canonical in aliases:
+                        aliases[canonical].append(url)
+                        continue
+                    aliases[canonical] = []
+                    batch.add(endpoint, (url, canonical))
+                    if started < workers:
+                        thread = threading.Thread(target=work)
+                        thread.daemon = True
+                        thread.start()
+                        started += 1
+
+                if not aliases:
+                    return
+                url, canonical, result = done.get()
+                for url in [url] + aliases.pop(canonical):
+                    waiting.discard(url)
+                    yield url, result
+        finally:
+            batch.stop()
+
+
+class _Batch(object):
+    '''
+    Hands out the jobs of OEmbedConsumer.iterEmbedMany to its workers,
+    round-robin between endpoints and within their concurrency and rate
+    limits.
+    '''
+
+    def __init__(self, maxPerEndpoint):
+        self._pending = OrderedDict()
+        self._maxPerEndpoint = maxPerEndpoint
+        self._active = {}
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def add(self, endpoint, job):
+        with self._cond:
+            self._pending.setdefault(endpoint, deque()).append(job)
+            self._cond.notify()
+
+    def close(self):
+        # No more jobs: idle workers return.
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def next(self):
+        with self._cond:
+            while self._pending or not self._closed:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                # Rate limited endpoints are skipped until their turn comes,
+                # so that they do not hold workers the others could use.
+                wait = None
+                for endpoint, urls in self._pending.items():
+                    if self._active.get(endpoint, 0) >= self._maxPerEndpoint:
+                        continue
+                    limit = endpoint and endpoint._rateLimit
+                    delay = limit.delay() if limit else 0
+                    if delay <= 0:
+                        break
+                    wait = delay if wait is None else min(wait, delay)
+                else:
+                    self._cond.wait(wait)
+                    continue
+                url = urls.popleft()
+                # Move the endpoint to the end of the line.
+                del self._pending[endpoint]
+                if urls:
+                    self._pending[endpoint] = urls
+                self._active[endpoint] = self._active.get(endpoint, 0) + 1
+                return endpoint, url
+            return None
+
+    def finish(self, endpoint):
+        with self._cond:
+            self._active[endpoint] -= 1
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._pending.clear()
+            self._closed = True
+            self._cond.notify_all()
 
 def _unicode(value):
     if isinstance(value, str):
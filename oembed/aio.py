@@ -0,0 +1,591 @@
+'''Asyncio support for python-oembed.
+
+AsyncOEmbedConsumer fetches resources with non-blocking sockets on the
+running event loop. It manages endpoints exactly like OEmbedConsumer and
+parses responses with the same code, so both consumers can share the same
+OEmbedEndpoint objects.
+
+Simple usage:
+
+    import asyncio
+    import oembed
+    from oembed.aio import AsyncOEmbedConsumer
+
+    consumer = AsyncOEmbedConsumer()
+    consumer.addEndpoint(oembed.OEmbedEndpoint(
+        'http://www.flickr.com/services/oembed', ['http://*.flickr.com/*']))
+
+    async def main():
+        response = await consumer.embed(
+            'http://www.flickr.com/photos/wizardbt/2584979382/')
+        print(response['url'])
+
+    asyncio.run(main())
+
+Python 3.5 or later is required.
+'''
+import asyncio
+import http.client
+import socket
+import ssl
+import urllib.error
+from io import BytesIO
+from urllib.parse import urlsplit, urljoin
+
+import oembed
+
+
+class AsyncOEmbedTransport(object):
+    '''
+    A non-blocking HTTP/1.1 client with per-host keep-alive connections and
+    concurrency limits.
+
+    Errors are raised as urllib.error.URLError and urllib.error.HTTPError,
+    like OEmbedConnectionPool does.
+    '''
+
+    _redirects = (301, 302, 303, 307, 308)
+
+    def __init__(self, maxPerHost=10, timeout=30, idleTimeout=60,
+                 maxRedirects=5):
+        '''
+        Create a new AsyncOEmbedTransport object.
+
+        Args:
+            maxPerHost: Maximum number of concurrent requests per host.
+            timeout: Seconds allowed for a whole request, None for no limit.
+            idleTimeout: Seconds an idle connection is kept before closing it.
+            maxRedirects: Maximum number of redirects followed per request.
+        '''
+        self._maxPerHost = maxPerHost
+        self._timeout = timeout
+        self._idleTimeout = idleTimeout
+        self._maxRedirects = maxRedirects
+        self._limits = {}
+        self._idle = {}
+        self._loop = None
+        self._sslContext = None
+
+    def _limit(self, key):
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(self._maxPerHost)
+        return limit
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        idle = self._idle.get(key)
+        now = oembed._clock()
+        while idle:
+            reader, writer, lastUsed = idle.pop()
+            if now - lastUsed < self._idleTimeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        if scheme == 'https':
+            if self._sslContext is None:
+                self._sslContext = ssl.create_default_context()
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=self._sslContext)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        self._idle.setdefault(key, []).append(
+            (reader, writer, oembed._clock()))
+
+    @staticmethod
+    def _checkSize(size, maxSize):
+        if maxSize is not None and size > maxSize:
+            raise oembed.OEmbedResponseTooLarge(
+                'Response exceeds the limit of %d bytes' % maxSize)
+
+    @staticmethod
+    async def _readHead(reader):
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionResetError('Connection closed by the server')
+        version, status, reason = (statusLine.decode('latin-1').rstrip('\r\n')
+                                   .split(' ', 2) + [''])[:3]
+        head = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            head.append(line)
+        message = http.client.parse_headers(BytesIO(b''.join(head) + b'\r\n'))
+        return version, int(status), reason, message
+
+    async def _exchange(self, reader, writer, host, path, headers, maxSize,
+                        method='GET'):
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        version, status, reason, message = await self._readHead(reader)
+        while 100 <= status < 200:
+            # Interim responses have no body and precede the final one.
+            version, status, reason, message = await self._readHead(reader)
+
+        if method == 'HEAD' or status in (204, 304):
+            # Never followed by a body, whatever the headers say.
+            body = b''
+            reusable = True
+        elif message.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            total = 0
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                total += size
+                self._checkSize(total, maxSize)
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+            reusable = True
+        elif 'Content-Length' in message:
+            length = int(message['Content-Length'])
+            self._checkSize(length, maxSize)
+            body = await reader.readexactly(length)
+            reusable = True
+        else:
+            chunks = []
+            total = 0
+            while True:
+                chunk = await reader.read(oembed._CHUNK_SIZE)
+                if not chunk:
+                    break
+                total += len(chunk)
+                self._checkSize(total, maxSize)
+                chunks.append(chunk)
+            body = b''.join(chunks)
+            reusable = False
+
+        if version == 'HTTP/1.0' or \
+           message.get('Connection', '').lower() == 'close':
+            reusable = False
+        return status, reason, message, body, reusable
+
+    async def _send(self, key, path, headers, maxSize, method='GET'):
+        host = key[1] if key[2] in (80, 443) else '%s:%d' % key[1:]
+        while True:
+            try:
+                reader, writer, reused = await self._connect(key)
+            except OSError as e:
+                # Refused connections and unknown hosts, as urllib raises
+                # them.
+                raise urllib.error.URLError(e)
+            try:
+                result = await self._exchange(reader, writer, host, path,
+                                              headers, maxSize, method)
+            except (OSError, ValueError, asyncio.IncompleteReadError,
+                    http.client.HTTPException) as e:
+                writer.close()
+                if not reused:
+                    raise urllib.error.URLError(e)
+                continue
+            except BaseException:
+                writer.close()
+                raise
+            if result[4]:
+                self._release(key, reader, writer)
+            else:
+                writer.close()
+            return result[:4]
+
+    async def _open(self, url, headers, maxSize, method='GET'):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # Connections and semaphores belong to the loop that created them.
+            self._limits = {}
+            self._idle = {}
+            self._loop = loop
+        for redirect in range(self._maxRedirects + 1):
+            parts = urlsplit(url)
+            scheme = parts.scheme.lower()
+            if scheme not in ('http', 'https') or not parts.hostname:
+                raise urllib.error.URLError('unknown url type: %s' % url)
+            port = parts.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            async with self._limit(key):
+                status, reason, message, body = await self._send(
+                    key, path, headers, maxSize, method)
+            location = message.get('Location')
+            if status in self._redirects and location:
+                url = urljoin(url, location)
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, message,
+                                             BytesIO(body))
+            return status, message, body
+
+        raise urllib.error.HTTPError(url, status, 'Too many redirects',
+                                     message, None)
+
+    async def request(self, url, headers=None, maxSize=None, method='GET'):
+        '''
+        Send a request, following redirects.
+
+        Args:
+            url: The url to fetch.
+            headers: A dict of request headers.
+            maxSize: Maximum size of the response body in bytes, None for no
+                     limit. Larger bodies raise OEmbedResponseTooLarge.
+            method: The request method, GET or HEAD.
+
+        Returns:
+            A (status, headers, body) tuple. The body of HEAD requests and
+            of 204 and 304 responses is empty.
+        '''
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'identity')
+        try:
+            return await asyncio.wait_for(
+                self._open(url, headers, maxSize, method), self._timeout)
+        except asyncio.TimeoutError:
+            raise urllib.error.URLError(socket.timeout('timed out'))
+
+    async def open(self, url, headers=None, maxSize=None):
+        '''
+        Send a GET request, following redirects.
+
+        Args:
+            url: The url to fetch.
+            headers: A dict of request headers.
+            maxSize: Maximum size of the response body in bytes, None for no
+                     limit. Larger bodies raise OEmbedResponseTooLarge.
+
+        Returns:
+            A (headers, body) tuple.
+        '''
+        status, headers, body = await self.request(url, headers, maxSize)
+        return headers, body
+
+    async def close(self):
+        '''Close all the idle connections.'''
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for reader, writer, lastUsed in conns:
+                writer.close()
+
+
+class AsyncOEmbedConsumer(oembed.OEmbedConsumer):
+    '''
+    An OEmbed consumer whose embed method is a coroutine.
+
+    Endpoints, url matching and response caching work as in OEmbedConsumer;
+    only the network I/O differs.
+    '''
+
+    def __init__(self, transport=None):
+        '''
+        Create a new AsyncOEmbedConsumer object.
+
+        Args:
+            transport: An AsyncOEmbedTransport, a new one by default.
+        '''
+        oembed.OEmbedConsumer.__init__(self)
+        self._transport = transport or AsyncOEmbedTransport()
+        self._inflight = {}
+
+    def getTransport(self):
+        '''
+        Get the transport used to fetch resources.
+
+        Returns:
+            The AsyncOEmbedTransport of this consumer.
+        '''
+        return self._transport
+
+    async def _fetch(self, endpoint, requestUrl, key, timing):
+        # Same retries, circuit breaker, hedging and rate limit as
+        # OEmbedEndpoint.fetch.
+        endpoint._checkAvailable()
+        previous = self._stale(key)
+        attempt = 0
+        while True:
+            try:
+                if endpoint._latencies is None:
+                    response = await self._fetchOnce(endpoint, requestUrl,
+                                                     previous, timing)
+                else:
+                    response = await self._fetchHedged(endpoint, requestUrl,
+                                                       previous, timing)
+            except Exception as e:
+                delay = endpoint._onFailure(attempt, e)
+                if delay is None:
+                    if isinstance(e, urllib.error.HTTPError):
+                        self._storeError(key, e)
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            endpoint._recordResult(None)
+            self._store(key, response)
+            return response
+
+    async def _fetchHedged(self, endpoint, requestUrl, previous, timing):
+        async def attempt(attemptTiming):
+            start = oembed._clock()
+            response = await self._fetchOnce(endpoint, requestUrl, previous,
+                                             attemptTiming)
+            endpoint._recordLatency(oembed._clock() - start)
+            return response, attemptTiming
+
+        delay = endpoint._hedgeDelay()
+        if delay is None:
+            return (await attempt(timing))[0]
+
+        def start():
+            return asyncio.ensure_future(attempt(
+                None if timing is None else oembed.OEmbedTiming(requestUrl)))
+
+        tasks = [start()]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Slower than usual: race a second request against the first.
+                tasks.append(start())
+                done, pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = done.pop()
+                if winner.exception() is not None and pending:
+                    done, pending = await asyncio.wait(pending)
+                    winner = done.pop()
+            else:
+                winner = done.pop()
+            response, attemptTiming = winner.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+        if timing is not None:
+            timing.merge(attemptTiming)
+            timing.tags['hedged'] = len(tasks) > 1
+        return response
+
+    async def _fetchOnce(self, endpoint, requestUrl, previous, timing):
+        if endpoint._rateLimit is not None:
+            wait = endpoint._rateLimit.reserve()
+            if wait > 0:
+                try:
+                    await asyncio.sleep(wait)
+                except asyncio.CancelledError:
+                    # Past its deadline: the request is not sent.
+                    endpoint._rateLimit.cancel()
+                    raise
+                if timing is not None:
+                    timing.addPhase('queue', wait)
+        requestHeaders = endpoint._requestHeaders
+        conditional = endpoint._conditionalHeaders(previous)
+        if conditional is not None:
+            requestHeaders = dict(requestHeaders, **conditional)
+        if timing is None:
+            status, headers, raw = await self._transport.request(
+                requestUrl, requestHeaders, endpoint._maxResponseSize)
+        else:
+            timing.tags['outcome'] = 'fetch'
+            start = oembed._clock()
+            status, headers, raw = await self._transport.request(
+                requestUrl, requestHeaders, endpoint._maxResponseSize)
+            timing.addPhase('network', oembed._clock() - start)
+            timing.bytesRead += len(raw)
+        if status == 304 and conditional is not None:
+            if timing is not None:
+                timing.tags['outcome'] = 'revalidated'
+            return endpoint.notModified(previous, headers)
+        if headers.get('Content-Encoding'):
+            raw = endpoint._inflate(headers, (raw,))
+        return endpoint.parse(headers, raw, timing)
+
+    async def _request(self, url, opt, timing=None):
+        start = oembed._clock()
+        # Discovery fetches pages with blocking sockets, so only the
+        # endpoints it already found are used here.
+        endpoint, url = self._resolve(url, discover=False)
+        if endpoint is None:
+            raise oembed.OEmbedNoEndpoint(
+                'There are no endpoints available for %s' % url)
+        if timing is not None:
+            timing.addPhase('match', oembed._clock() - start)
+            timing.tags['endpoint'] = endpoint._urlApi
+
+        if self._sizeBuckets is not None:
+            opt = self._sizeBuckets.round(opt)
+        key = None
+        if self._cache is not None or self._negativeCache is not None:
+            key = self._cacheKey(endpoint, url, opt)
+            refresh = None
+            if self._refresher is not None and self._cache is not None:
+                refresh = lambda: self._refresh(endpoint, url, opt, key)
+            response = self._cached(key, timing, refresh)
+            if response is None:
+                response = self._scaled(endpoint, url, opt, timing)
+            if response is not None:
+                return response
+
+        start = oembed._clock()
+        requestUrl = endpoint.request(url, **opt)
+        if timing is not None:
+            timing.addPhase('request', oembed._clock() - start)
+            timing.tags['outcome'] = 'coalesced'
+
+        # Concurrent requests for the same resource share a single fetch,
+        # cancelled once none of them waits for it any more.
+        flight = self._inflight.get(requestUrl)
+        if flight is None:
+            task = asyncio.ensure_future(self._fetch(endpoint, requestUrl,
+                                                     key, timing))
+            flight = self._inflight[requestUrl] = [task, 0]
+            task.add_done_callback(
+                lambda task: self._land(requestUrl, flight))
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        except asyncio.CancelledError:
+            if flight[1] == 1:
+                self._land(requestUrl, flight)
+                flight[0].cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    def _land(self, requestUrl, flight):
+        if self._inflight.get(requestUrl) is flight:
+            del self._inflight[requestUrl]
+
+    def _refresh(self, endpoint, url, opt, key):
+        # Fetch a cached response again in a new task.
+        refresher = self._refresher
+        if not refresher._begin(key):
+            return
+
+        async def run():
+            try:
+                await self._fetch(endpoint, endpoint.request(url, **opt), key,
+                                  None)
+            except Exception:
+                pass
+            finally:
+                refresher._end(key)
+
+        asyncio.ensure_future(run())
+
+    async def _requestWithin(self, deadline, url, opt, timing=None):
+        if deadline is None:
+            return await self._request(url, opt, timing)
+        try:
+            return await asyncio.wait_for(self._request(url, opt, timing),
+                                          deadline)
+        except asyncio.TimeoutError:
+            raise oembed.OEmbedTimeout(
+                'Embed of %s exceeded its deadline of %s seconds' % \
+                (url, deadline))
+
+    async def embed(self, url, format='json', deadline=None, **opt):
+        '''
+        Get an OEmbedResponse from one of the providers configured in this
+        consumer according to the resource url.
+
+        Args:
+            url: The url of the resource to get.
+            format: Desired response format.
+            deadline: Maximum number of seconds the embed may take, None for
+                      no limit. The embed is cancelled and OEmbedTimeout is
+                      raised once the deadline has passed.
+            **opt: Optional parameters to pass in the url to the provider.
+
+        Returns:
+            OEmbedResponse object.
+        '''
+        if format not in ['json', 'xml']:
+            raise oembed.OEmbedInvalidRequest('Format must be json or xml')
+        opt['format'] = format
+        if not self._observers:
+            return await self._requestWithin(deadline, url, opt)
+
+        timing = oembed.OEmbedTiming(url)
+        try:
+            return await self._requestWithin(deadline, url, opt, timing)
+        except Exception as e:
+            timing.tags['outcome'] = 'error'
+            timing.tags['error'] = e.__class__.__name__
+            raise
+        finally:
+            timing.finish()
+            for observer in self._observers:
+                observer(timing)
+
+    def iterEmbedMany(self, urls, format='json', workers=8, maxPerEndpoint=4,
+                      **opt):
+        '''
+        Fetch many resources concurrently. Must be called from a coroutine.
+
+        Duplicated urls are fetched once.
+
+        Args:
+            urls: An iterable of resource urls.
+            format: Desired response format.
+            workers: Maximum number of concurrent requests.
+            maxPerEndpoint: Maximum number of concurrent requests per endpoint.
+            **opt: Optional parameters to pass in the url to the provider.
+
+        Returns:
+            An iterator of awaitables in the order they complete, as
+            asyncio.as_completed, each giving a (url, result) tuple, where
+            result is the OEmbedResponse of the url or the exception raised
+            embedding it.
+        '''
+        if format not in ['json', 'xml']:
+            raise oembed.OEmbedInvalidRequest('Format must be json or xml')
+        limit = asyncio.Semaphore(workers)
+        endpointLimits = {}
+
+        async def embed(url):
+            try:
+                endpoint = self._resolve(url, discover=False)[0]
+                endpointLimit = endpointLimits.get(endpoint)
+                if endpointLimit is None:
+                    endpointLimit = endpointLimits[endpoint] = \
+                        asyncio.Semaphore(maxPerEndpoint)
+                async with endpointLimit, limit:
+                    return url, await self.embed(url, format, **opt)
+            except Exception as e:
+                return url, e
+
+        seen = set()
+        return asyncio.as_completed([embed(url) for url in urls
+                                     if not (url in seen or seen.add(url))])
+
+    async def embedMany(self, urls, format='json', workers=8, maxPerEndpoint=4,
+                        **opt):
+        '''
+        Get the OEmbedResponse of many resources, fetching them concurrently.
+
+        Args:
+            urls: A sequence of resource urls.
+            format: Desired response format.
+            workers: Maximum number of concurrent requests.
+            maxPerEndpoint: Maximum number of concurrent requests per endpoint.
+            **opt: Optional parameters to pass in the url to the provider.
+
+        Returns:
+            A list with an item per url, in the same order: the OEmbedResponse
+            of the url, or the exception raised while embedding it.
+        '''
+        urls = list(urls)
+        results = {}
+        for result in self.iterEmbedMany(urls, format, workers,
+                                         maxPerEndpoint, **opt):
+            url, response = await result
+            results[url] = response
+        return [results[url] for url in urls]
@@ -0,0 +1,271 @@
+'''
+Command line tool embedding many resource urls.
+
+Urls are read one per line from a file or the standard input, and a JSON
+line is written per url as soon as it is embedded, with its response or
+its error. Only a window of urls is read ahead of the results, so memory
+stays bounded however large the input is. With a checkpoint file, an
+interrupted run started again with the same arguments continues with the
+urls whose results were not written yet.
+
+Usage:
+
+    oembed --providers providers.json [--workers 8] [--output out.jsonl]
+           [--checkpoint run.checkpoint] [urls.txt]
+'''
+import argparse
+import io
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import oembed
+
+
+def readUrls(lines, skip=0, done=()):
+    '''
+    Get the urls of the input lines.
+
+    Args:
+        lines: An iterable of lines.
+        skip: Number of lines already processed.
+        done: Numbers of the following lines already processed.
+
+    Returns:
+        A generator of (line number, url) tuples, skipping blank lines.
+    '''
+    for number, line in enumerate(lines, 1):
+        if number <= skip or number in done:
+            continue
+        url = line.strip()
+        if url:
+            yield number, url
+
+
+class Progress(object):
+    '''
+    Tracks the input lines whose results are written, in whatever order
+    they complete, to checkpoint them in input order.
+    '''
+
+    def __init__(self, line=0, done=()):
+        '''
+        Create a new Progress object.
+
+        Args:
+            line: The line up to which all results are written.
+            done: Numbers of the following lines whose results are written.
+        '''
+        self.line = line
+        self._done = set(done)
+        self._read = line
+        self._unwritten = OrderedDict()
+
+    def read(self, number):
+        '''Record a line read, its result to be written.'''
+        self._unwritten[number] = None
+        self._read = number
+
+    def written(self, number):
+        '''Record the result of a line written.'''
+        del self._unwritten[number]
+        self._done.add(number)
+        for first in self._unwritten:
+            self.line = first - 1
+            break
+        else:
+            self.line = max(self.line, self._read)
+
+    def done(self):
+        '''Get the numbers of the lines after line whose results are written.'''
+        self._done = set(n for n in self._done if n > self.line)
+        return sorted(self._done)
+
+
+def record(number, url, result):
+    '''
+    Format the result of a url as a JSON line.
+
+    Args:
+        number: The input line number of the url.
+        url: The url.
+        result: Its OEmbedResponse, or the exception raised while embedding
+                it.
+
+    Returns:
+        The line, ending with a newline.
+    '''
+    data = {'line': number, 'url': url}
+    if isinstance(result, Exception):
+        data['error'] = '%s: %s' % (result.__class__.__name__, result)
+    else:
+        data['response'] = result.getData()
+    return oembed.json_encode(data) + '\n'
+
+
+def loadCheckpoint(path):
+    '''
+    Read a checkpoint file.
+
+    Returns:
+        A (line, offset, done) tuple: the input line up to which all lines
+        are processed, the size of the output at that point, and the
+        numbers of the following lines processed too. (0, 0, []) if there
+        is no checkpoint.
+    '''
+    if path is None or not os.path.exists(path):
+        return 0, 0, []
+    with open(path, 'rb') as f:
+        data = oembed.json_decode(f.read().decode('utf8'))
+    return data['line'], data['offset'], data.get('done', [])
+
+
+def saveCheckpoint(path, line, offset, done=()):
+    '''Write a checkpoint file, atomically.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(oembed.json_encode({'line': line, 'offset': offset,
+                                    'done': list(done)}).encode('utf8'))
+    getattr(os, 'replace', os.rename)(tmp, path)
+
+
+def configureEndpoint(endpoint, args):
+    '''Apply the timeout and retries of the command line to an endpoint.'''
+    if args.timeout is not None:
+        endpoint.setTimeout(args.timeout, args.timeout)
+    if args.retries:
+        endpoint.setRetries(args.retries)
+    return endpoint
+
+
+def buildConsumer(args):
+    consumer = oembed.OEmbedConsumer()
+    for path in args.providers:
+        consumer.loadProvidersFile(path)
+    for path in args.index:
+        consumer.loadIndex(path)
+    if args.discovery:
+        consumer.setDiscovery(oembed.OEmbedDiscovery(
+            pool=oembed.OEmbedConnectionPool(timeout=args.timeout),
+            endpointFactory=lambda apiUrl: configureEndpoint(
+                oembed.OEmbedEndpoint(apiUrl), args)))
+    if args.cache:
+        consumer.setCache(oembed.OEmbedSQLiteCache(args.cache))
+    for endpoint in consumer.getEndpoints():
+        configureEndpoint(endpoint, args)
+    return consumer
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        prog='oembed',
+        description='Embed the urls read from a file or the standard '
+                    'input, writing a JSON line per url.')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of urls, one per line (default: stdin)')
+    parser.add_argument('--providers', action='append', default=[],
+                        metavar='FILE', help='providers.json file to load')
+    parser.add_argument('--index', action='append', default=[],
+                        metavar='FILE', help='index file saved by saveIndex')
+    parser.add_argument('--discovery', action='store_true',
+                        help='discover the endpoints of unknown urls')
+    parser.add_argument('--output', metavar='FILE',
+                        help='file to write the results to (default: stdout)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='file recording the progress, to resume from')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of concurrent requests (default: 8)')
+    parser.add_argument('--max-per-endpoint', type=int, default=4,
+                        help='concurrent requests per endpoint (default: 4)')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='urls read ahead of the results, and results '
+                             'written between checkpoints (default: 1000)')
+    parser.add_argument('--format', choices=['json', 'xml'], default='json',
+                        help='format requested to providers')
+    parser.add_argument('--maxwidth', type=int)
+    parser.add_argument('--maxheight', type=int)
+    parser.add_argument('--timeout', type=float,
+                        help='connect and read timeout in seconds')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='retries of transient failures')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='SQLite response cache file')
+    args = parser.parse_args(argv)
+    if not (args.providers or args.index or args.discovery):
+        parser.error('one of --providers, --index or --discovery is required')
+    if args.checkpoint and not args.output:
+        parser.error('--checkpoint requires --output')
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    consumer = buildConsumer(args)
+    opt = {}
+    for name in ('maxwidth', 'maxheight'):
+        if getattr(args, name) is not None:
+            opt[name] = getattr(args, name)
+
+    skip, offset, done = loadCheckpoint(args.checkpoint)
+    if args.output:
+        # Drop the results written after the checkpoint, they are redone.
+        output = open(args.output, 'ab')
+        output.truncate(offset)
+        output.seek(offset)
+        write = lambda line: output.write(line.encode('utf8'))
+    else:
+        output = sys.stdout
+        write = output.write
+    if args.input == '-':
+        lines = sys.stdin
+    else:
+        lines = io.open(args.input, encoding='utf-8')
+
+    progress = Progress(skip, done)
+    # Line numbers of the urls read and not written yet.
+    numbers = {}
+
+    def feed():
+        for number, url in readUrls(lines, skip, set(done)):
+            progress.read(number)
+            if url in numbers:
+                # Already in the window, its result is written for both.
+                numbers[url].append(number)
+            else:
+                numbers[url] = [number]
+                yield url
+
+    def checkpoint():
+        output.flush()
+        if args.checkpoint:
+            saveCheckpoint(args.checkpoint, progress.line, output.tell(),
+                           progress.done())
+
+    count = errors = 0
+    start = time.time()
+    try:
+        for url, result in consumer.iterEmbedMany(
+                feed(), args.format, args.workers, args.max_per_endpoint,
+                args.batch, **opt):
+            for number in numbers.pop(url):
+                write(record(number, url, result))
+                progress.written(number)
+                count += 1
+                errors += isinstance(result, Exception)
+                if count % args.batch == 0:
+                    checkpoint()
+        checkpoint()
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+
+    sys.stderr.write('%d urls embedded, %d errors, in %.1f seconds\n' % \
+                     (count, errors, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
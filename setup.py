@@ -27,6 +27,9 @@ setup(
     author_email='abarmat@gmail.com',
     url='http://github.com/abarmat/python-oembed',
     packages=['oembed'],
+    entry_points={
+        'console_scripts': ['oembed = oembed.cli:main'],
+    },
     license='MIT',
     classifiers = (
         "Development Status :: 4 - Beta",
@@ -0,0 +1,132 @@
+'''A local OEmbed provider used by the tests.'''
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer # Python 3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer # Python 2
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+
+def photo(query):
+    '''Default responder: a photo response for the requested url.'''
+    data = {'type': 'photo', 'version': '1.0', 'url': query.get('url'),
+            'width': 300, 'height': 200}
+    if 'maxwidth' in query:
+        data['width'] = int(query['maxwidth'])
+    return 200, {'Content-Type': 'application/json'}, json.dumps(data)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which would otherwise stall
+    # every keep-alive response on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        query = dict(parse_qsl(urlparse(self.path).query))
+        with server.lock:
+            server.requests.append(self.path)
+        page = server.pages.get(urlparse(self.path).path)
+        if server.etag is not None and \
+           self.headers.get('If-None-Match') == server.etag:
+            status, headers, body = 304, {'ETag': server.etag}, b''
+        elif page is not None:
+            status, headers, body = 200, {'Content-Type': page[1]}, page[0]
+        else:
+            status, headers, body = server.responder(query)
+        if not isinstance(body, bytes):
+            body = body.encode('utf8')
+        if server.etag is not None and status == 200:
+            headers = dict(headers, ETag=server.etag)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if server.contentLength or self.command == 'HEAD':
+            self.send_header('Content-Length', str(len(body)))
+        elif body or status not in (204, 304):
+            # Without a length, the end of the body is the end of the
+            # connection.
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request = HTTPServer.get_request(self)
+        with self.lock:
+            self.connections += 1
+        return request
+
+
+class StubProvider(object):
+    '''
+    An HTTP server answering every GET with the result of a responder.
+
+    The responder takes the parsed query string and returns a
+    (status, headers, body) tuple.
+    '''
+
+    def __init__(self, responder=photo):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.responder = responder
+        self._server.requests = []
+        self._server.pages = {}
+        self._server.contentLength = True
+        self._server.etag = None
+        self._server.connections = 0
+        self._server.lock = threading.Lock()
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/oembed' % self._server.server_address[1]
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    @property
+    def connections(self):
+        return self._server.connections
+
+    def setResponder(self, responder):
+        self._server.responder = responder
+
+    def setPage(self, path, body, contentType='text/html; charset=utf-8'):
+        self._server.pages[path] = (body, contentType)
+
+    def setETag(self, etag):
+        self._server.etag = etag
+
+    def setContentLength(self, enabled):
+        '''
+        Whether to send Content-Length. Without it, bodies are delimited by
+        closing the connection, and 204 and 304 responses keep it open.
+        '''
+        self._server.contentLength = enabled
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
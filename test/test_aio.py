@@ -0,0 +1,222 @@
+import asyncio
+import threading
+import time
+import unittest
+import urllib.error
+import zlib
+
+import oembed
+from oembed.aio import AsyncOEmbedConsumer, AsyncOEmbedTransport
+from stubserver import StubProvider, photo
+
+
+class AsyncConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = AsyncOEmbedConsumer(AsyncOEmbedTransport(maxPerHost=4))
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://example.com/*']))
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testEmbed(self):
+        async def main():
+            return await asyncio.gather(*[
+                self.consumer.embed('http://example.com/%d' % i)
+                for i in range(20)]) + [
+                await self.consumer.getTransport().close()]
+        responses = asyncio.run(main())
+        self.assertEqual([r['url'] for r in responses[:-1]],
+                         ['http://example.com/%d' % i for i in range(20)])
+        self.assertTrue(self.provider.connections <= 4)
+
+    def testErrors(self):
+        async def main(url):
+            return await self.consumer.embed(url)
+        self.assertRaises(oembed.OEmbedNoEndpoint, asyncio.run,
+                          main('http://google.com/'))
+        self.provider.setResponder(lambda query: (404, {}, 'Not Found'))
+        self.assertRaises(urllib.error.HTTPError, asyncio.run,
+                          main('http://example.com/missing'))
+
+        # Refused connections and unknown hosts too raise URLError.
+        for url in ('http://127.0.0.1:1/oembed',
+                    'http://unknown.invalid/oembed'):
+            self.consumer.addEndpoint(oembed.OEmbedEndpoint(
+                url, ['http://down.com/*']))
+            self.assertRaises(urllib.error.URLError, asyncio.run,
+                              main('http://down.com/1'))
+            self.consumer.clearEndpoints()
+
+    def testEmbedMany(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'max': 0}
+
+        def responder(query):
+            with lock:
+                state['active'] += 1
+                state['max'] = max(state['max'], state['active'])
+            time.sleep(0.02)
+            with lock:
+                state['active'] -= 1
+            return photo(query)
+        self.provider.setResponder(responder)
+
+        async def main():
+            results = await self.consumer.embedMany(
+                ['http://example.com/%d' % (i % 6) for i in range(8)] +
+                ['http://google.com/'], maxPerEndpoint=2, maxwidth=100)
+            await self.consumer.getTransport().close()
+            return results
+        results = asyncio.run(main())
+        self.assertEqual([r['url'] for r in results[:8]],
+                         ['http://example.com/%d' % (i % 6) for i in range(8)])
+        self.assertEqual(results[0]['width'], 100)
+        self.assertTrue(results[6] is results[0])
+        self.assertTrue(isinstance(results[8], oembed.OEmbedNoEndpoint))
+        self.assertEqual(len(self.provider.requests), 6)
+        self.assertEqual(state['max'], 2)
+
+    def testCache(self):
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+
+        async def main():
+            first = await self.consumer.embed('http://example.com/1')
+            second = await self.consumer.embed('http://example.com/1')
+            return first, second
+        first, second = asyncio.run(main())
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.provider.requests), 1)
+
+    def testRevalidate(self):
+        def responder(query):
+            return 200, {'Content-Type': 'application/json'}, \
+                '{"type": "link", "version": "1.0", "cache_age": 0}'
+        self.provider.setResponder(responder)
+        self.provider.setETag('"v1"')
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+
+        async def main():
+            first = await self.consumer.embed('http://example.com/1')
+            second = await self.consumer.embed('http://example.com/1')
+            await self.consumer.getTransport().close()
+            return first, second
+        first, second = asyncio.run(main())
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testStale(self):
+        calls = []
+
+        def responder(query):
+            calls.append(query['url'])
+            return 200, {'Content-Type': 'application/json'}, \
+                '{"type": "link", "version": "1.0", "cache_age": 0, ' \
+                '"title": "v%d"}' % len(calls)
+        self.provider.setResponder(responder)
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+        self.consumer.setRefresher(oembed.OEmbedRefresher(grace=60))
+
+        async def main():
+            titles = []
+            for i in range(2):
+                response = await self.consumer.embed('http://example.com/1')
+                titles.append(response['title'])
+            while len(calls) < 2:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.05)
+            response = await self.consumer.embed('http://example.com/1')
+            titles.append(response['title'])
+            await self.consumer.getTransport().close()
+            return titles
+        self.assertEqual(asyncio.run(main()), ['v1', 'v1', 'v2'])
+
+    def testNotModifiedWithoutLength(self):
+        def responder(query):
+            return 200, {'Content-Type': 'application/json'}, \
+                '{"type": "link", "version": "1.0", "cache_age": 0}'
+        self.provider.setResponder(responder)
+        self.provider.setETag('"v1"')
+        self.provider.setContentLength(False)
+        transport = AsyncOEmbedTransport(timeout=2)
+        self.consumer = AsyncOEmbedConsumer(transport)
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://example.com/*']))
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+
+        async def main():
+            # The 200 is read up to the end of its connection, the 304s
+            # leave theirs open.
+            first = await self.consumer.embed('http://example.com/1')
+            start = time.time()
+            second = await self.consumer.embed('http://example.com/1')
+            third = await self.consumer.embed('http://example.com/1')
+            elapsed = time.time() - start
+            head = await transport.request(self.provider.url, method='HEAD')
+            await transport.close()
+            return first, second, third, elapsed, head
+        first, second, third, elapsed, head = asyncio.run(main())
+        self.assertTrue(first is second and second is third)
+        self.assertTrue(elapsed < 1)
+        self.assertEqual(head[0], 200)
+        self.assertEqual(head[2], b'')
+        self.assertEqual(len(self.provider.requests), 4)
+        self.assertEqual(self.provider.connections, 2)
+
+    def testGzip(self):
+        gzip = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = gzip.compress(b'{"type": "link", "version": "1.0"}') + \
+            gzip.flush()
+        self.provider.setResponder(
+            lambda query: (200, {'Content-Type': 'application/json',
+                                 'Content-Encoding': 'gzip'}, body))
+
+        async def main():
+            return await self.consumer.embed('http://example.com/1')
+        self.assertEqual(asyncio.run(main())['type'], 'link')
+
+    def testDeadline(self):
+        def slow(query):
+            time.sleep(0.5)
+            return photo(query)
+        self.provider.setResponder(slow)
+
+        async def main():
+            return await self.consumer.embed('http://example.com/1',
+                                             deadline=0.1)
+        self.assertRaises(oembed.OEmbedTimeout, asyncio.run, main())
+
+    def testDeadlineRateLimit(self):
+        limit = oembed.OEmbedRateLimit(10, burst=1)
+        self.consumer.getEndpoints()[0].setRateLimit(limit)
+
+        async def main():
+            end = time.time() + 0.5
+            i = 0
+            while time.time() < end:
+                try:
+                    await self.consumer.embed('http://example.com/%d' % i,
+                                              deadline=0.05)
+                except oembed.OEmbedTimeout:
+                    pass
+                i += 1
+            self.assertTrue(limit.delay() <= 0.1)
+            start = time.time()
+            await self.consumer.embed('http://example.com/last', deadline=1)
+            self.assertTrue(time.time() - start < 0.2)
+            await self.consumer.getTransport().close()
+        asyncio.run(main())
+
+    def testCoalescing(self):
+        async def main():
+            return await asyncio.gather(*[
+                self.consumer.embed('http://example.com/1')
+                for i in range(10)])
+        responses = asyncio.run(main())
+        self.assertEqual(len(set([id(r) for r in responses])), 1)
+        self.assertEqual(len(self.provider.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
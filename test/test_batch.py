@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+
+import oembed
+from stubserver import StubProvider, photo
+
+
+class EmbedManyTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://example.com/*']))
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://other.com/*']))
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testOrderedResults(self):
+        urls = ['http://example.com/1', 'http://google.com/',
+                'http://other.com/2', 'http://example.com/1']
+        results = self.consumer.embedMany(urls, maxwidth=100)
+        self.assertEqual(results[0]['url'], 'http://example.com/1')
+        self.assertTrue(isinstance(results[1], oembed.OEmbedNoEndpoint))
+        self.assertEqual(results[2]['width'], 100)
+        self.assertTrue(results[3] is results[0])
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testInlineErrors(self):
+        def responder(query):
+            if query['url'].endswith('/missing'):
+                return 404, {}, 'Not Found'
+            return photo(query)
+        self.provider.setResponder(responder)
+        results = dict(self.consumer.iterEmbedMany(
+            ['http://example.com/missing', 'http://example.com/1']))
+        self.assertEqual(results['http://example.com/1']['url'],
+                         'http://example.com/1')
+        self.assertEqual(results['http://example.com/missing'].code, 404)
+
+    def testConcurrencyLimit(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'max': 0}
+
+        def responder(query):
+            with lock:
+                state['active'] += 1
+                state['max'] = max(state['max'], state['active'])
+            time.sleep(0.02)
+            with lock:
+                state['active'] -= 1
+            return photo(query)
+        self.provider.setResponder(responder)
+
+        urls = ['http://example.com/%d' % i for i in range(12)]
+        results = self.consumer.embedMany(urls, workers=8, maxPerEndpoint=3)
+        self.assertEqual([r['url'] for r in results], urls)
+        self.assertEqual(state['max'], 3)
+
+    def testWindow(self):
+        read = []
+
+        def urls():
+            for i in range(10):
+                read.append(i)
+                yield 'http://example.com/%d' % (i % 4)
+
+        results = self.consumer.iterEmbedMany(urls(), window=3)
+        url, response = next(results)
+        self.assertTrue(len(read) <= 4)
+        results = [url] + [url for url, response in results]
+        # Duplicates are fetched again once out of the window.
+        self.assertEqual(len(results), len(self.provider.requests))
+        self.assertEqual(len(read), 10)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://example.com/*']))
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def embedConcurrently(self, url, count=10):
+        results = []
+
+        def run():
+            try:
+                results.append(self.consumer.embed(url))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def testCoalescing(self):
+        def responder(query):
+            time.sleep(0.2)
+            return photo(query)
+        self.provider.setResponder(responder)
+
+        results = self.embedConcurrently('http://example.com/1')
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertEqual(len(set([id(r) for r in results])), 1)
+
+        self.consumer.embed('http://example.com/1')
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testSharedError(self):
+        def responder(query):
+            time.sleep(0.2)
+            return 404, {}, 'Not Found'
+        self.provider.setResponder(responder)
+
+        results = self.embedConcurrently('http://example.com/missing')
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertEqual([getattr(r, 'code', None) for r in results],
+                         [404] * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
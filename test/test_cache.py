@@ -0,0 +1,343 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import oembed
+from stubserver import StubProvider, photo
+
+try:
+    import urllib.request as urllib2 # Python 3
+except ImportError:
+    import urllib2 # Python 2
+
+
+class MemoryCacheTest(unittest.TestCase):
+    def testLru(self):
+        cache = oembed.OEmbedMemoryCache(maxEntries=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def testExpiry(self):
+        cache = oembed.OEmbedMemoryCache()
+        cache.set('a', 1, 0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def testMaxBytes(self):
+        cache = oembed.OEmbedMemoryCache(maxBytes=100, sizeOf=len)
+        cache.set('a', 'x' * 60, 60)
+        cache.set('b', 'y' * 60, 60)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'y' * 60)
+
+    def testMaxBytesOfResponses(self):
+        provider = StubProvider(lambda query: (
+            200, {'Content-Type': 'application/json'},
+            json.dumps({'type': 'rich', 'version': '1.0',
+                        'html': 'x' * 5000, 'width': 100,
+                        'height': 100})))
+        try:
+            cache = oembed.OEmbedMemoryCache(maxBytes=12000)
+            consumer = oembed.OEmbedConsumer()
+            consumer.addEndpoint(oembed.OEmbedEndpoint(
+                provider.url, ['http://example.com/*']))
+            consumer.setCache(cache)
+            for i in range(3):
+                consumer.embed('http://example.com/%d' % i)
+            self.assertEqual(len(cache), 2)
+            self.assertTrue(cache._bytes > 10000)
+        finally:
+            provider.stop()
+
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+        self.cache = oembed.OEmbedSQLiteCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testGetSet(self):
+        self.cache.set('a', 'x', 60)
+        self.cache.set('b', ['url', 404, 'Not Found'], 60)
+        self.cache.set('c', 1, -1)
+        self.assertEqual(self.cache.get('a'), 'x')
+        self.assertEqual(self.cache.get('b'), ['url', 404, 'Not Found'])
+        self.assertEqual(self.cache.get('c'), None)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.delete('a')
+        self.assertEqual(self.cache.get('a'), None)
+
+        # Values survive a restart.
+        cache = oembed.OEmbedSQLiteCache(self.path)
+        self.assertEqual(cache.get('b'), ['url', 404, 'Not Found'])
+        cache.clear()
+        self.assertEqual(self.cache.get('b'), None)
+
+    def testEviction(self):
+        cache = oembed.OEmbedSQLiteCache(self.path, maxBytes=10000)
+        for i in range(200):
+            cache.set('key%d' % i, 'x' * 100, 60 + i)
+        cache.evict()
+        self.assertTrue(len(cache) < 100)
+        self.assertEqual(cache.get('key0'), None)
+        self.assertEqual(cache.get('key199'), 'x' * 100)
+
+    def testSharedBetweenConsumers(self):
+        provider = StubProvider()
+        try:
+            for i in range(2):
+                consumer = oembed.OEmbedConsumer()
+                consumer.addEndpoint(oembed.OEmbedEndpoint(
+                    provider.url, ['http://example.com/*']))
+                consumer.setCache(oembed.OEmbedSQLiteCache(self.path))
+                response = consumer.embed('http://example.com/1', maxwidth=50)
+                self.assertEqual(response['width'], 50)
+                self.assertEqual(response['url'], 'http://example.com/1')
+            self.assertEqual(len(provider.requests), 1)
+        finally:
+            provider.stop()
+
+    def testFork(self):
+        if not hasattr(os, 'fork'):
+            return
+        self.cache.get('a')
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.cache.set('a', 'child', 60)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.cache.get('a'), 'child')
+
+
+class ConsumerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://example.com/*']))
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testCacheHit(self):
+        url = 'http://example.com/photo/1'
+        first = self.consumer.embed(url, maxwidth=100)
+        second = self.consumer.embed(url, maxwidth='100')
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.provider.requests), 1)
+
+        self.consumer.embed(url, maxwidth=200)
+        self.consumer.embed(url, format='xml', maxwidth=100)
+        self.assertEqual(len(self.provider.requests), 3)
+
+    def testCacheAge(self):
+        def responder(query):
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                {'type': 'link', 'version': '1.0', 'cache_age': '0'})
+        self.provider.setResponder(responder)
+
+        self.consumer.embed('http://example.com/link')
+        self.consumer.embed('http://example.com/link')
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testTtl(self):
+        self.consumer.setCache(oembed.OEmbedMemoryCache(), defaultTtl=60,
+                               maxTtl=120)
+        response = oembed.OEmbedResponse.createLoad(
+            {'type': 'link', 'version': '1.0'})
+        self.assertEqual(self.consumer._cacheTtl(response), 60)
+        response = oembed.OEmbedResponse.createLoad(
+            {'type': 'link', 'version': '1.0', 'cache_age': 3600})
+        self.assertEqual(self.consumer._cacheTtl(response), 120)
+
+
+class RevalidateTest(unittest.TestCase):
+    def setUp(self):
+        def responder(query):
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                {'type': 'link', 'version': '1.0', 'cache_age': '0',
+                 'title': query.get('url')})
+        self.provider = StubProvider(responder)
+        self.provider.setETag('"v1"')
+        self.endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                              ['http://example.com/*'])
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(self.endpoint)
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+        self.outcomes = []
+        self.consumer.addObserver(
+            lambda timing: self.outcomes.append(timing.tags['outcome']))
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testNotModified(self):
+        url = 'http://example.com/link'
+        first = self.consumer.embed(url)
+        second = self.consumer.embed(url)
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.provider.requests), 2)
+        self.assertEqual(self.outcomes, ['fetch', 'revalidated'])
+
+        self.provider.setETag('"v2"')
+        third = self.consumer.embed(url)
+        self.assertFalse(third is first)
+        self.assertEqual(third['title'], url)
+        self.assertEqual(self.outcomes[-1], 'fetch')
+
+    def testUrllib(self):
+        self.endpoint.setUrllib(urllib2)
+        url = 'http://example.com/link'
+        first = self.consumer.embed(url)
+        self.assertTrue(self.consumer.embed(url) is first)
+        self.assertEqual(self.outcomes, ['fetch', 'revalidated'])
+
+    def testDisabled(self):
+        self.consumer.setCache(oembed.OEmbedMemoryCache(), revalidateTtl=0)
+        url = 'http://example.com/link'
+        first = self.consumer.embed(url)
+        self.assertFalse(self.consumer.embed(url) is first)
+        self.assertEqual(self.outcomes, ['fetch', 'fetch'])
+
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.cacheAge = '0'
+
+        def responder(query):
+            self.calls.append(query['url'])
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                {'type': 'link', 'version': '1.0',
+                 'cache_age': self.cacheAge,
+                 'title': 'v%d' % len(self.calls)})
+        self.provider = StubProvider(responder)
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(
+            self.provider.url, ['http://example.com/*']))
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+        self.outcomes = []
+        self.consumer.addObserver(
+            lambda timing: self.outcomes.append(timing.tags['outcome']))
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def waitForCalls(self, count):
+        for i in range(500):
+            if len(self.calls) >= count:
+                break
+            time.sleep(0.01)
+        # Let the refreshed response reach the cache.
+        time.sleep(0.05)
+        self.assertEqual(len(self.calls), count)
+
+    def testStale(self):
+        self.consumer.setRefresher(oembed.OEmbedRefresher(grace=60))
+        url = 'http://example.com/link'
+        self.assertEqual(self.consumer.embed(url)['title'], 'v1')
+        self.assertEqual(self.consumer.embed(url)['title'], 'v1')
+        self.waitForCalls(2)
+        self.assertEqual(self.consumer.embed(url)['title'], 'v2')
+        self.assertEqual(self.outcomes, ['fetch', 'stale', 'stale'])
+
+    def testGraceEnded(self):
+        self.consumer.setRefresher(oembed.OEmbedRefresher(grace=0))
+        url = 'http://example.com/link'
+        self.consumer.embed(url)
+        self.assertEqual(self.consumer.embed(url)['title'], 'v2')
+        self.assertEqual(self.outcomes, ['fetch', 'fetch'])
+
+    def testRefreshAhead(self):
+        self.cacheAge = '100'
+        self.consumer.setRefresher(oembed.OEmbedRefresher(refreshAhead=1,
+                                                          hotHits=3))
+        url = 'http://example.com/link'
+        for i in range(3):
+            self.assertEqual(self.consumer.embed(url)['title'], 'v1')
+        self.assertEqual(len(self.calls), 1)
+        self.consumer.embed(url)
+        self.waitForCalls(2)
+        self.assertEqual(self.consumer.embed(url)['title'], 'v2')
+        self.assertEqual(self.outcomes, ['fetch'] + ['hit'] * 4)
+
+    def testMaxConcurrent(self):
+        self.consumer.setRefresher(oembed.OEmbedRefresher(maxConcurrent=1))
+        urls = ['http://example.com/%d' % i for i in range(3)]
+        for url in urls:
+            self.consumer.embed(url)
+        release = threading.Event()
+
+        def responder(query):
+            release.wait(5)
+            self.calls.append(query['url'])
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                {'type': 'link', 'version': '1.0', 'cache_age': '0'})
+        self.provider.setResponder(responder)
+        for url in urls:
+            self.consumer.embed(url)
+        release.set()
+        self.waitForCalls(4)
+        self.assertEqual(self.calls[-1], urls[0])
+        self.assertEqual(self.outcomes, ['fetch'] * 3 + ['stale'] * 3)
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider(lambda query: (404, {}, 'Not Found'))
+        self.consumer = oembed.OEmbedConsumer()
+        self.endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                              ['http://example.com/*'])
+        self.consumer.addEndpoint(self.endpoint)
+        self.negative = oembed.OEmbedMemoryCache(maxEntries=100)
+        self.consumer.setNegativeCache(self.negative, errorTtl=60)
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testProviderError(self):
+        for i in range(3):
+            self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                              'http://example.com/private')
+        self.assertEqual(len(self.provider.requests), 1)
+
+        self.provider.setResponder(photo)
+        self.consumer.embed('http://example.com/private', maxwidth=10)
+        self.assertEqual(len(self.provider.requests), 2)
+
+        self.provider.setResponder(lambda query: (500, {}, 'Error'))
+        for i in range(2):
+            self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                              'http://example.com/broken')
+        self.assertEqual(len(self.provider.requests), 4)
+
+    def testNoEndpoint(self):
+        url = 'http://other.com/1'
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed, url)
+        self.assertEqual(len(self.negative), 1)
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed, url)
+        self.assertEqual(len(self.negative), 1)
+
+        self.endpoint.addUrlScheme('http://other.com/*')
+        self.provider.setResponder(photo)
+        self.assertEqual(self.consumer.embed(url)['url'], url)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+import oembed
+from stubserver import StubProvider
+
+
+class CanonicalizerTest(unittest.TestCase):
+    def setUp(self):
+        self.canonicalizer = oembed.OEmbedCanonicalizer()
+
+    def testBuiltinRules(self):
+        canonicalize = self.canonicalizer.canonicalize
+        tests = [
+            ('HTTP://Example.COM:80/Photo/1', 'http://example.com/Photo/1'),
+            ('https://example.com:443/a', 'https://example.com/a'),
+            ('http://example.com:8080/a', 'http://example.com:8080/a'),
+            ('http://example.com', 'http://example.com/'),
+            ('http://example.com/%7euser/%2fa%2F', 'http://example.com/~user/%2Fa%2F'),
+            ('http://example.com/v?id=1&utm_source=x&UTM_MEDIUM=y&fbclid=z',
+             'http://example.com/v?id=1'),
+            ('http://example.com/v?utm_source=x', 'http://example.com/v'),
+            ('http://example.com/v?b=2&a=1#t=30', 'http://example.com/v?b=2&a=1#t=30'),
+            ('http://User@Example.com/a', 'http://User@example.com/a'),
+            ('http://[::1]:80/a', 'http://[::1]/a'),
+            ('mailto:Someone@Example.com', 'mailto:Someone@Example.com'),
+        ]
+        for url, expected in tests:
+            self.assertEqual(canonicalize(url), expected)
+            self.assertEqual(canonicalize(expected), expected)
+
+    def testRules(self):
+        self.canonicalizer.addRule(oembed.OEmbedCanonicalizer.https)
+        self.canonicalizer.addRule(oembed.OEmbedCanonicalizer.stripWww)
+        self.canonicalizer.addRule(oembed.OEmbedCanonicalizer.stripTrailingSlash)
+        self.canonicalizer.addRule(oembed.OEmbedCanonicalizer.rewrite(
+            r'^https://youtu\.be/([\w-]+)', r'https://youtube.com/watch?v=\1'))
+        canonicalize = self.canonicalizer.canonicalize
+        self.assertEqual(canonicalize('http://www.example.com/a/'),
+                         'https://example.com/a')
+        self.assertEqual(canonicalize('http://www.example.com/'),
+                         'https://example.com/')
+        self.assertEqual(canonicalize('https://youtu.be/abc?utm_source=x'),
+                         'https://youtube.com/watch?v=abc')
+
+    def testStats(self):
+        canonicalizer = oembed.OEmbedCanonicalizer(trackStats=True)
+        for url in ['http://example.com/a', 'HTTP://EXAMPLE.com/a',
+                    'http://example.com/a?utm_source=x', 'http://example.com/b',
+                    'http://example.com/a']:
+            canonicalizer.record(url, canonicalizer.canonicalize(url))
+        self.assertEqual(canonicalizer.getStats(),
+                         {'calls': 5, 'changed': 2, 'inputs': 4,
+                          'canonical': 2, 'merged': 2})
+
+
+class ConsumerCanonicalTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                              ['http://*.example.com/*',
+                                               'http://example.com/*'])
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(self.endpoint)
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+        self.canonicalizer = oembed.OEmbedCanonicalizer(trackStats=True)
+        self.consumer.setCanonicalizer(self.canonicalizer)
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testMerge(self):
+        self.endpoint.addCanonicalRule(oembed.OEmbedCanonicalizer.stripWww)
+        urls = ['http://example.com/1', 'HTTP://Example.com:80/1',
+                'http://www.example.com/1?utm_campaign=x',
+                'http://example.com/1?fbclid=abc']
+        for url in urls:
+            response = self.consumer.embed(url)
+            self.assertEqual(response['url'], 'http://example.com/1')
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertEqual(self.canonicalizer.getStats()['merged'], 3)
+
+    def testBatch(self):
+        urls = ['http://example.com/%d?utm_source=%d' % (i % 2, i)
+                for i in range(6)]
+        responses = self.consumer.embedMany(urls)
+        self.assertEqual([r['url'] for r in responses],
+                         ['http://example.com/%d' % (i % 2) for i in range(6)])
+        self.assertEqual(len(self.provider.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from oembed import cli
+from stubserver import StubProvider, photo
+
+
+class CommandLineTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.dir = tempfile.mkdtemp()
+        self.providers = self.path('providers.json')
+        with open(self.providers, 'w') as f:
+            json.dump([{'provider_name': 'Stub',
+                        'endpoints': [{'url': self.provider.url,
+                                       'schemes': ['http://example.com/*']}]}],
+                      f)
+        self.stderr = sys.stderr
+        sys.stderr = io.StringIO() if sys.version_info[0] > 2 else \
+            io.BytesIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        self.provider.stop()
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def writeInput(self, urls):
+        with open(self.path('urls.txt'), 'w') as f:
+            f.write('\n'.join(urls) + '\n')
+        return self.path('urls.txt')
+
+    def readOutput(self):
+        with open(self.path('out.jsonl')) as f:
+            return [json.loads(line) for line in f]
+
+    def run_(self, *args):
+        return cli.main(['--providers', self.providers,
+                         '--output', self.path('out.jsonl')] + list(args))
+
+    def testStream(self):
+        def responder(query):
+            if query['url'].endswith('/missing'):
+                return 404, {}, 'Not Found'
+            return photo(query)
+        self.provider.setResponder(responder)
+        urls = self.writeInput(['http://example.com/1', '',
+                                'http://example.com/missing',
+                                'http://other.com/2', 'http://example.com/1'])
+        self.assertEqual(self.run_('--batch', '2', '--maxwidth', '100',
+                                   urls), 0)
+
+        results = sorted(self.readOutput(), key=lambda r: r['line'])
+        self.assertEqual([r['line'] for r in results], [1, 3, 4, 5])
+        self.assertEqual(results[0]['response']['url'],
+                         'http://example.com/1')
+        self.assertEqual(results[0]['response']['width'], 100)
+        self.assertTrue(results[1]['error'].startswith('HTTPError'))
+        self.assertTrue(results[2]['error'].startswith('OEmbedNoEndpoint'))
+        self.assertEqual(results[3]['response'], results[0]['response'])
+        self.assertTrue('4 urls embedded, 2 errors' in sys.stderr.getvalue())
+
+    def testWindow(self):
+        def responder(query):
+            if query['url'].endswith('/1'):
+                time.sleep(0.5)
+            return photo(query)
+        self.provider.setResponder(responder)
+        urls = self.writeInput(['http://example.com/%d' % i
+                                for i in range(1, 7)])
+        checkpoint = self.path('run.checkpoint')
+        self.run_('--batch', '2', '--workers', '2', '--checkpoint',
+                  checkpoint, urls)
+        # The slow url did not hold back the urls after it.
+        lines = [r['line'] for r in self.readOutput()]
+        self.assertEqual(sorted(lines), [1, 2, 3, 4, 5, 6])
+        self.assertTrue(lines.index(3) < lines.index(1))
+        self.assertEqual(json.load(open(checkpoint))['line'], 6)
+
+    def testProgress(self):
+        progress = cli.Progress()
+        # Line 3 is blank.
+        for number in (1, 2, 4, 5):
+            progress.read(number)
+        progress.written(2)
+        progress.written(4)
+        self.assertEqual((progress.line, progress.done()), (0, [2, 4]))
+        progress.written(1)
+        self.assertEqual((progress.line, progress.done()), (4, []))
+        progress.written(5)
+        self.assertEqual((progress.line, progress.done()), (5, []))
+
+    def testResume(self):
+        urls = self.writeInput(['http://example.com/%d' % i
+                                for i in range(1, 7)])
+        checkpoint = self.path('run.checkpoint')
+        self.run_('--batch', '4', '--checkpoint', checkpoint, urls)
+        self.assertEqual(len(self.provider.requests), 6)
+
+        # A run interrupted after writing lines 1, 2 and 4: the checkpoint
+        # is at line 2 with line 4 done, and a partial line follows it.
+        output = self.readOutput()
+        first = [json.dumps(r) for r in output if r['line'] in (1, 2, 4)]
+        with open(self.path('out.jsonl'), 'w') as f:
+            f.write('\n'.join(first) + '\n{"line": 5, "url"')
+            offset = len('\n'.join(first)) + 1
+        with open(checkpoint, 'w') as f:
+            json.dump({'line': 2, 'offset': offset, 'done': [4]}, f)
+
+        self.run_('--batch', '4', '--checkpoint', checkpoint, urls)
+        self.assertEqual(len(self.provider.requests), 9)
+        results = self.readOutput()
+        self.assertEqual(sorted(r['line'] for r in results),
+                         [1, 2, 3, 4, 5, 6])
+        self.assertEqual(json.load(open(checkpoint)),
+                         {'line': 6, 'offset': os.path.getsize(
+                             self.path('out.jsonl')), 'done': []})
+
+    def testDiscoveredEndpoints(self):
+        consumer = cli.buildConsumer(cli.parseArgs(
+            ['--discovery', '--timeout', '2', '--retries', '3']))
+        endpoint = consumer._discovery._endpoint(self.provider.url)
+        self.assertEqual(endpoint._timeout, (2, 2))
+        self.assertEqual(endpoint._retries, 3)
+
+    def testRequiresProviders(self):
+        self.assertRaises(SystemExit, cli.main, ['urls.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+
+import oembed
+from stubserver import StubProvider, photo
+
+
+class Slow(object):
+    '''A responder answering the given requests after a delay.'''
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.lock = threading.Lock()
+
+    def __call__(self, query):
+        with self.lock:
+            delay = self.delays.pop(0) if self.delays else 0
+        time.sleep(delay)
+        return photo(query)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                              ['http://example.com/*'])
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(self.endpoint)
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testDeadline(self):
+        self.assertEqual(self.consumer.embed('http://example.com/1',
+                                             deadline=5)['url'],
+                         'http://example.com/1')
+
+        self.provider.setResponder(Slow([0.5]))
+        start = time.time()
+        self.assertRaises(oembed.OEmbedTimeout, self.consumer.embed,
+                          'http://example.com/2', deadline=0.1)
+        self.assertTrue(time.time() - start < 0.4)
+
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed,
+                          'http://other.com/1', deadline=5)
+
+    def testNothingLeftRunning(self):
+        pool = oembed.OEmbedConnectionPool()
+        self.endpoint.setConnectionPool(pool)
+        # The idle connections of the one host of the pool.
+        idle = lambda: list(pool._idle.values())[0]
+        self.consumer.embed('http://example.com/1')
+        self.consumer.embed('http://example.com/2', deadline=0.2)
+        # The connection does not keep the timeout cut to the deadline.
+        self.provider.setResponder(Slow([0.3]))
+        self.consumer.embed('http://example.com/3')
+        self.assertEqual(len(idle()), 1)
+
+        self.provider.setResponder(Slow([0.5]))
+        threads = threading.active_count()
+        start = time.time()
+        self.assertRaises(oembed.OEmbedTimeout, self.consumer.embed,
+                          'http://example.com/4', deadline=0.1)
+        self.assertTrue(time.time() - start < 0.4)
+        # The embed ran in this thread, and its connection was closed
+        # rather than left waiting for the response.
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(idle(), [])
+        self.assertEqual(len(self.provider.requests), 4)
+
+    def testObserver(self):
+        timings = []
+        self.consumer.addObserver(timings.append)
+        self.provider.setResponder(Slow([0.5]))
+        self.assertRaises(oembed.OEmbedTimeout, self.consumer.embed,
+                          'http://example.com/1', deadline=0.1)
+        self.assertEqual(timings[0].tags['error'], 'OEmbedTimeout')
+
+    def testHedging(self):
+        self.endpoint.setHedging(percentile=50, minSamples=5)
+        # Latencies well above that of a new connection, so that only the
+        # slow request is hedged.
+        self.provider.setResponder(Slow([0.05] * 5))
+        for i in range(5):
+            self.consumer.embed('http://example.com/%d' % i)
+        self.assertTrue(self.endpoint._hedgeDelay() is not None)
+
+        timings = []
+        self.consumer.addObserver(timings.append)
+        self.provider.setResponder(Slow([1]))
+        start = time.time()
+        response = self.consumer.embed('http://example.com/slow')
+        self.assertEqual(response['url'], 'http://example.com/slow')
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(len(self.provider.requests), 7)
+        self.assertTrue(timings[-1].tags['hedged'])
+
+        self.consumer.embed('http://example.com/fast')
+        self.assertFalse(timings[-1].tags['hedged'])
+        self.assertEqual(len(self.provider.requests), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+
+import oembed
+from stubserver import StubProvider
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head>
+<title>A photo</title>
+<link rel="alternate" type="text/xml+oembed" href="%(api)s?format=xml&amp;url=x">
+<link rel="alternate" type="application/json+oembed"
+      href="%(api)s?url=%(base)s/photo/1&amp;format=json&amp;key=abc">
+</head><body>%(body)s</body></html>'''
+
+
+class CountingPool(oembed.OEmbedConnectionPool):
+    '''A connection pool counting the bytes of response bodies read.'''
+
+    bytesRead = 0
+
+    def open(self, url, headers=None, timeout=None, maxSize=None):
+        response = oembed.OEmbedConnectionPool.open(self, url, headers,
+                                                    timeout, maxSize)
+        read = response.read
+
+        def counted(amt=None):
+            data = read(amt)
+            self.bytesRead += len(data)
+            return data
+        response.read = counted
+        return response
+
+
+class DiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.setDiscovery(oembed.OEmbedDiscovery())
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def setPage(self, path, body=''):
+        self.provider.setPage(path, PAGE % {'api': self.provider.url,
+                                            'base': self.provider.base,
+                                            'body': body})
+
+    def testDiscover(self):
+        self.setPage('/photo/1')
+        url = self.provider.base + '/photo/1'
+        response = self.consumer.embed(url)
+        self.assertEqual(response['url'], url)
+        self.assertEqual(len(self.provider.requests), 2)
+        # The api url keeps its own parameters only.
+        self.assertTrue('key=abc' in self.provider.requests[1])
+        self.assertEqual(self.provider.requests[1].count('format='), 1)
+
+    def testHostCache(self):
+        self.setPage('/photo/1')
+        self.consumer.embed(self.provider.base + '/photo/1')
+        response = self.consumer.embed(self.provider.base + '/photo/2')
+        self.assertEqual(response['url'], self.provider.base + '/photo/2')
+        self.assertEqual(len([r for r in self.provider.requests
+                              if r.startswith('/photo/')]), 1)
+
+    def testNoLink(self):
+        self.provider.setPage('/plain', '<html><head></head><body></body></html>')
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed,
+                          self.provider.base + '/plain')
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed,
+                          'http://127.0.0.1:1/unreachable')
+
+    def testStopsAtHead(self):
+        pool = CountingPool()
+        discovery = oembed.OEmbedDiscovery(maxBytes=4 * 1024 * 1024,
+                                           pool=pool)
+        self.setPage('/photo/1', 'x' * 1024 * 1024)
+        apiUrl = discovery.discover(self.provider.base + '/photo/1')
+        self.assertEqual(apiUrl, self.provider.url + '?key=abc')
+        # The body after </head> is not read.
+        self.assertTrue(0 < pool.bytesRead <= oembed._CHUNK_SIZE)
+
+        # Links past the byte limit are not seen.
+        discovery = oembed.OEmbedDiscovery(maxBytes=1024)
+        self.provider.setPage('/late', '<html><head>%s</head></html>' % (
+            '<meta name="x">' * 100 +
+            '<link rel="alternate" type="application/json+oembed" href="/o">'))
+        self.assertEqual(discovery.discover(self.provider.base + '/late'), None)
+
+    def testEndpointsBounded(self):
+        discovery = oembed.OEmbedDiscovery(maxEndpoints=2)
+        first = discovery._endpoint('http://a.com/oembed')
+        second = discovery._endpoint('http://b.com/oembed')
+        self.assertTrue(discovery._endpoint('http://a.com/oembed') is first)
+        discovery._endpoint('http://c.com/oembed')
+        # The least recently used endpoint is dropped.
+        self.assertEqual(len(discovery._endpoints), 2)
+        self.assertTrue(discovery._endpoint('http://a.com/oembed') is first)
+        self.assertFalse(discovery._endpoint('http://b.com/oembed') is second)
+
+    def testBatch(self):
+        for i in range(4):
+            self.setPage('/photo/%d' % i)
+        urls = [self.provider.base + '/photo/%d' % i for i in range(4)]
+        responses = self.consumer.embedMany(urls)
+        self.assertEqual([r['url'] for r in responses], urls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import shutil
+import tempfile
+import unittest
+import oembed
+
+PROVIDERS = [
+    {'provider_name': 'Flickr', 'provider_url': 'https://www.flickr.com/',
+     'endpoints': [{'schemes': ['http://*.flickr.com/photos/*',
+                                'http://flic.kr/p/*'],
+                    'url': 'https://www.flickr.com/services/oembed/',
+                    'discovery': True}]},
+    {'provider_name': 'Vimeo', 'provider_url': 'https://vimeo.com/',
+     'endpoints': [{'schemes': ['https://vimeo.com/*',
+                                'https://vimeo.com/album/*/video/*'],
+                    'url': 'https://vimeo.com/api/oembed.{format}'}]},
+    {'provider_name': 'Discovery only', 'provider_url': 'https://a.com/',
+     'endpoints': [{'url': 'https://a.com/oembed', 'discovery': True}]},
+]
+
+
+def linearLookup(endpoints, url):
+    for endpoint in endpoints:
+        if endpoint.match(url):
+            return endpoint
+    return None
+
+
+class UrlIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.consumer = oembed.OEmbedConsumer()
+        self.endpoints = [
+            oembed.OEmbedEndpoint('http://www.flickr.com/services/oembed',
+                                  ['http://*.flickr.com/*',
+                                   'http://flickr.com/*']),
+            oembed.OEmbedEndpoint('http://www.youtube.com/oembed',
+                                  ['http://www.youtube.com/watch*',
+                                   'http://youtu.be/*']),
+            oembed.OEmbedEndpoint('http://example.com/oembed',
+                                  ['http://*example*',
+                                   'regex:https?://(www\\.)?vimeo\\.com/\\d+']),
+            oembed.OEmbedEndpoint('http://catchall.com/oembed',
+                                  ['http://*']),
+        ]
+        for endpoint in self.endpoints:
+            self.consumer.addEndpoint(endpoint)
+
+    def testSameResultAsLinearScan(self):
+        urls = ['http://www.flickr.com/photos/wizardbt/2584979382/',
+                'http://flickr.com/photos/wizardbt/',
+                'http://evil.com/x.flickr.com/',
+                'http://www.youtube.com/watch?v=abc',
+                'http://www.youtube.com.evil.com/watch',
+                'http://youtu.be/abc',
+                'http://vimeo.com/1234',
+                'https://www.vimeo.com/1234',
+                'https://vimeo.com/abc',
+                'http://myexample.org/',
+                'http://google.com/123456',
+                'https://google.com/123456',
+                'flickr.com/photos/']
+        for url in urls:
+            self.assertTrue(self.consumer._endpointFor(url) is
+                            linearLookup(self.endpoints, url), url)
+
+    def testFirstMatchWins(self):
+        self.assertTrue(self.consumer._endpointFor('http://flickr.com/a') is
+                        self.endpoints[0])
+        self.assertTrue(self.consumer._endpointFor('http://google.com/') is
+                        self.endpoints[3])
+        self.assertEqual(self.consumer._endpointFor('https://google.com/'),
+                         None)
+
+    def testInvalidation(self):
+        url = 'https://www.flickr.com/photos/wizardbt/'
+        self.assertEqual(self.consumer._endpointFor(url), None)
+
+        self.endpoints[1].addUrlScheme('https://*.flickr.com/*')
+        self.assertTrue(self.consumer._endpointFor(url) is self.endpoints[1])
+
+        self.endpoints[0].addUrlScheme('https://*.flickr.com/*')
+        self.assertTrue(self.consumer._endpointFor(url) is self.endpoints[0])
+
+        self.consumer.delEndpoint(self.endpoints[0])
+        self.assertTrue(self.consumer._endpointFor(url) is self.endpoints[1])
+
+        self.endpoints[1].clearUrlSchemes()
+        self.assertEqual(self.consumer._endpointFor(url), None)
+
+    def testIndexKey(self):
+        self.assertEqual(oembed.OEmbedUrlScheme('http://flickr.com/*')
+                         .getIndexKey(), ('host', 'http://flickr.com'))
+        self.assertEqual(oembed.OEmbedUrlScheme('http://*.flickr.com/*')
+                         .getIndexKey(), ('suffix', '.flickr.com'))
+        self.assertEqual(oembed.OEmbedUrlScheme('http://*flickr*')
+                         .getIndexKey(), None)
+        # Only the text before the first special character is literal.
+        self.assertEqual(oembed.OEmbedUrlScheme('http://a.com/watch?v=*')
+                         .getIndexKey(), ('host', 'http://a.com'))
+        self.assertEqual(oembed.OEmbedUrlScheme('http://*.a.com/(x+)')
+                         .getIndexKey(), ('suffix', '.a.com'))
+        self.assertEqual(oembed.OEmbedUrlScheme('http://a.com/?x')
+                         .getIndexKey(), None)
+        self.assertEqual(oembed.OEmbedUrlScheme('http://a.com/|http://b.com/')
+                         .getIndexKey(), None)
+        self.assertEqual(oembed.OEmbedUrlScheme('regex:http://a\\.com/')
+                         .getIndexKey(), None)
+
+    def testSpecialSchemes(self):
+        endpoints = [
+            oembed.OEmbedEndpoint('http://a.com/oembed',
+                                  ['http://a.com/watch?v=*',
+                                   'http://a.com/?x',
+                                   'regex:https?://(www\\.)?b\\.com/(\\d+)']),
+            oembed.OEmbedEndpoint('http://c.com/oembed',
+                                  ['regex:http://(c)\\1\\.com/',
+                                   'regex:http://(?P<name>d)\\.com/',
+                                   'regex:(?i)http://E\\.com/',
+                                   'http://f.com/x|http://g.com/']),
+            oembed.OEmbedEndpoint('http://other.com/oembed',
+                                  ['http://*', 'regex:https://.*']),
+        ]
+        consumer = oembed.OEmbedConsumer()
+        for endpoint in endpoints:
+            consumer.addEndpoint(endpoint)
+        urls = ['http://a.com/watch?v=1', 'http://a.com/wat', 'http://a.comx',
+                'http://a.com/x', 'https://www.b.com/12', 'http://b.com/x',
+                'http://cc.com/', 'http://c.com/', 'http://d.com/',
+                'http://e.com/', 'http://g.com/', 'https://h.com/']
+        for url in urls:
+            self.assertTrue(consumer._endpointFor(url) is
+                            linearLookup(endpoints, url), url)
+        index = consumer._registry.index
+        # The group references and the global flag stay out of the combined
+        # regular expression.
+        self.assertEqual(len(index._others), 3)
+
+
+class ProviderLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLoadProviders(self):
+        consumer = oembed.OEmbedConsumer()
+        endpoints = consumer.loadProviders(PROVIDERS)
+        self.assertEqual(len(consumer.getEndpoints()), 3)
+        self.assertTrue(consumer._endpointFor('http://flic.kr/p/abc') is
+                        endpoints[0])
+        self.assertTrue(consumer._endpointFor('https://vimeo.com/123') is
+                        endpoints[1])
+        self.assertEqual(endpoints[1].request('https://vimeo.com/123',
+                                              format='xml'),
+                         'https://vimeo.com/api/oembed.xml?'
+                         'url=https%3A%2F%2Fvimeo.com%2F123')
+
+    def testLazyCompile(self):
+        scheme = oembed.OEmbedUrlScheme('http://*.flickr.com/*')
+        self.assertEqual(scheme._regex, None)
+        self.assertTrue(scheme.match('http://www.flickr.com/photos/1'))
+        self.assertNotEqual(scheme._regex, None)
+
+    def testIndexFile(self):
+        path = os.path.join(self.dir, 'index.json')
+        consumer = oembed.OEmbedConsumer()
+        consumer.loadProviders(PROVIDERS)
+        consumer.saveIndex(path)
+
+        loaded = oembed.OEmbedConsumer()
+        loaded.loadIndex(path)
+        self.assertEqual(
+            [(e._urlApi, sorted(e.getUrlSchemes())) for e in loaded.getEndpoints()],
+            [(e._urlApi, sorted(e.getUrlSchemes())) for e in consumer.getEndpoints()])
+        for url in ['http://www.flickr.com/photos/1', 'https://vimeo.com/1',
+                    'https://vimeo.com/album/1/video/2', 'http://a.com/']:
+            found = loaded._endpointFor(url)
+            expected = consumer._endpointFor(url)
+            self.assertEqual(found and found._urlApi,
+                             expected and expected._urlApi)
+
+
+if __name__ == '__main__':
+    unittest.main()
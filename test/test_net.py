@@ -134,11 +134,83 @@ class ConsumerTest(unittest.TestCase):
                           'http://localhost/test')
 
 
+class ResponseTest(unittest.TestCase):
+    def testNewFromXML(self):
+        chunks = [b'<?xml version="1.0" encoding="utf-8"?><oembed><type>ph',
+                  b'oto</type><version>1.0</version><url>http://a.com/1.jpg',
+                  b'</url><width>300</width><height>200</height></oembed>']
+        resp = oembed.OEmbedResponse.newFromXML(chunks)
+        self.assertTrue(isinstance(resp, oembed.OEmbedPhotoResponse))
+        self.assertEqual(resp['url'], 'http://a.com/1.jpg')
+        self.assertEqual(resp['width'], '300')
+        self.assertEqual(resp.getData(),
+                         oembed.OEmbedResponse.newFromXML(b''.join(chunks))
+                         .getData())
+        resp = oembed.OEmbedResponse.newFromXML(
+            [b'<oembed><type>link</type>', b'',
+             b'<version>1.0</version></oembed>'])
+        self.assertEqual(resp['version'], '1.0')
+
+    def testNewFromJSON(self):
+        raw = b'{"type": "link", "version": "1.0", "title": "\xc3\xa9"}'
+        resp = oembed.OEmbedResponse.newFromJSON(raw)
+        self.assertEqual(resp['title'], u'\xe9')
+        resp = oembed.OEmbedResponse.newFromJSON(
+            [u'{"type": "link", ', u'"version": "1.0"}'])
+        self.assertEqual(resp['version'], '1.0')
+
+    def testJSONDecoder(self):
+        calls = []
+
+        def decode(raw):
+            calls.append(raw)
+            return {'type': 'link', 'version': '1.0'}
+        oembed.setJSONDecoder(decode)
+        try:
+            resp = oembed.OEmbedResponse.newFromJSON([b'{"a"', b': 1}'])
+        finally:
+            oembed.setJSONDecoder(None)
+        self.assertEqual(calls, [b'{"a": 1}'])
+        self.assertEqual(resp['type'], 'link')
+        self.assertEqual(oembed.OEmbedResponse.newFromJSON(
+            b'{"type": "rich", "version": "1.0", "html": "", "width": 1, '
+            b'"height": 1}')['type'], 'rich')
+
+    def testMediaTypes(self):
+        endpoint = oembed.OEmbedEndpoint('http://example.com/oembed')
+        json = b'{"type": "link", "version": "1.0"}'
+        xml = b'<oembed><type>link</type><version>1.0</version></oembed>'
+        for contentType, raw in [('application/json', json),
+                                 ('Application/JSON; charset=UTF-8', json),
+                                 ('text/javascript', json),
+                                 ('application/json+oembed', json),
+                                 ('text/xml; charset=utf-8', xml),
+                                 ('application/xml+oembed', xml),
+                                 ('application/json-p', json)]:
+            resp = endpoint.parse({'Content-Type': contentType}, raw)
+            self.assertEqual(resp['type'], 'link')
+        self.assertRaises(oembed.OEmbedError, endpoint.parse,
+                          {'Content-Type': 'text/html'}, b'<html></html>')
+        self.assertRaises(oembed.OEmbedError, endpoint.parse, {}, json)
+
+    def testCompactFields(self):
+        data = {'type': 'video', 'version': '1.0', 'html': '<b/>',
+                'width': 10, 'height': 20, 'title': None, 'custom': 'x'}
+        resp = oembed.OEmbedResponse.createLoad(dict(data))
+        self.assertFalse(hasattr(resp, '__dict__'))
+        self.assertEqual(resp.getData(), data)
+        self.assertEqual(resp['custom'], 'x')
+        self.assertEqual(resp['title'], None)
+        self.assertEqual(resp['url'], None)
+        self.assertEqual(resp['missing'], None)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTests(unittest.makeSuite(EndpointTest))
     suite.addTests(unittest.makeSuite(UrlSchemeTest))
     suite.addTests(unittest.makeSuite(ConsumerTest))
+    suite.addTests(unittest.makeSuite(ResponseTest))
     return suite
 
 
@@ -0,0 +1,102 @@
+import time
+import unittest
+
+import oembed
+from stubserver import StubProvider, photo
+
+try:
+    import urllib.request as urllib2 # Python 3
+except ImportError:
+    import urllib2 # Python 2
+
+
+class RateLimitTest(unittest.TestCase):
+    def testTokenBucket(self):
+        limit = oembed.OEmbedRateLimit(20, burst=2)
+        start = time.time()
+        for i in range(6):
+            limit.acquire()
+        elapsed = time.time() - start
+        self.assertTrue(0.15 < elapsed < 0.4)
+
+    def testShed(self):
+        limit = oembed.OEmbedRateLimit(1, maxWait=0.05)
+        limit.acquire()
+        self.assertRaises(oembed.OEmbedRateLimited, limit.acquire)
+        self.assertRaises(oembed.OEmbedRateLimited, limit.reserve)
+
+    def testBlock(self):
+        limit = oembed.OEmbedRateLimit(100)
+        self.assertEqual(limit.delay(), 0)
+        limit.block(5)
+        self.assertTrue(limit.delay() > 4)
+
+
+class ConsumerRateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = oembed.OEmbedConsumer()
+        self.endpoints = []
+        for i in range(2):
+            endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                             ['http://example%d.com/*' % i])
+            self.consumer.addEndpoint(endpoint)
+            self.endpoints.append(endpoint)
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testRetryAfter(self):
+        responses = [(429, {'Retry-After': '30'}, 'Slow down')]
+        self.provider.setResponder(
+            lambda query: responses.pop() if responses else photo(query))
+        limit = oembed.OEmbedRateLimit(100, maxWait=1)
+        self.endpoints[0].setRateLimit(limit)
+        self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                          'http://example0.com/1')
+        self.assertTrue(limit.delay() > 25)
+        self.assertRaises(oembed.OEmbedRateLimited, self.consumer.embed,
+                          'http://example0.com/1')
+        self.assertEqual(len(self.provider.requests), 1)
+
+    def testRetry(self):
+        responses = [(503, {'Retry-After': '0'}, 'Unavailable')]
+        self.provider.setResponder(
+            lambda query: responses.pop() if responses else photo(query))
+        self.endpoints[0].setRetries(1)
+        self.assertEqual(self.consumer.embed('http://example0.com/1')['url'],
+                         'http://example0.com/1')
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testDeadline(self):
+        limit = oembed.OEmbedRateLimit(10, burst=1)
+        self.endpoints[0].setRateLimit(limit)
+        end = time.time() + 0.5
+        i = 0
+        while time.time() < end:
+            try:
+                self.consumer.embed('http://example0.com/%d' % i,
+                                    deadline=0.05)
+            except oembed.OEmbedTimeout:
+                pass
+            i += 1
+        # The embeds given up on did not hold back the following ones.
+        self.assertTrue(limit.delay() <= 0.1)
+        start = time.time()
+        self.consumer.embed('http://example0.com/last', deadline=1)
+        self.assertTrue(time.time() - start < 0.2)
+
+    def testFairness(self):
+        self.endpoints[0].setRateLimit(oembed.OEmbedRateLimit(10, burst=1))
+        urls = ['http://example%d.com/%d' % (i % 2, i) for i in range(20)]
+        order = [url for url, response in
+                 self.consumer.iterEmbedMany(urls, workers=2,
+                                             maxPerEndpoint=2)]
+        self.assertEqual(sorted(order), sorted(urls))
+        # The unlimited endpoint is not held back by the limited one.
+        self.assertTrue(max([order.index(url) for url in urls
+                             if url.startswith('http://example1')]) < 14)
+
+
+if __name__ == '__main__':
+    unittest.main()
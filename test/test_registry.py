@@ -0,0 +1,142 @@
+import threading
+import time
+import unittest
+try:
+    from urllib.parse import urlsplit, parse_qsl
+except ImportError:
+    from urlparse import urlsplit, parse_qsl
+
+import oembed
+from stubserver import StubProvider
+
+
+class RegistryTest(unittest.TestCase):
+    def testSnapshots(self):
+        consumer = oembed.OEmbedConsumer()
+        first = oembed.OEmbedEndpoint('http://a.com/oembed', ['http://a.com/*'])
+        consumer.addEndpoint(first)
+        endpoints = consumer.getEndpoints()
+        schemes = first.getUrlSchemes()
+        consumer.addEndpoint(oembed.OEmbedEndpoint('http://b.com/oembed',
+                                                   ['http://b.com/*']))
+        first.addUrlScheme('http://www.a.com/*')
+        self.assertEqual(endpoints, [first])
+        self.assertEqual(list(schemes), ['http://a.com/*'])
+        self.assertTrue(consumer._endpointFor('http://www.a.com/1') is first)
+
+    def testSetEndpoints(self):
+        consumer = oembed.OEmbedConsumer()
+        old = oembed.OEmbedEndpoint('http://a.com/oembed', ['http://a.com/*'])
+        new = oembed.OEmbedEndpoint('http://b.com/oembed', ['http://a.com/*'])
+        consumer.addEndpoint(old)
+        consumer.setEndpoints([new])
+        self.assertTrue(consumer._endpointFor('http://a.com/1') is new)
+        # A replaced endpoint no longer changes the registry.
+        registry = consumer._registry
+        old.addUrlScheme('http://c.com/*')
+        self.assertTrue(consumer._registry is registry)
+
+    def testManyEndpoints(self):
+        consumer = oembed.OEmbedConsumer()
+        endpoints = [oembed.OEmbedEndpoint('http://p%d.com/oembed' % i,
+                                           ['http://p%d.com/*' % i])
+                     for i in range(2000)]
+        start = time.time()
+        for endpoint in endpoints:
+            consumer.addEndpoint(endpoint)
+        # Adding endpoints one at a time does not go over all the others.
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(consumer._endpointFor('http://p1999.com/1')
+                        is endpoints[-1])
+        self.assertEqual(endpoints[0]._listeners,
+                         (consumer._invalidateIndex,))
+
+        consumer.setEndpoints(endpoints[1:] + endpoints[:1])
+        self.assertEqual(len(endpoints[0]._listeners), 1)
+        consumer.delEndpoint(endpoints[0])
+        self.assertEqual(endpoints[0]._listeners, ())
+        self.assertEqual(len(endpoints[1]._listeners), 1)
+
+    def testRequestLeavesOptions(self):
+        endpoint = oembed.OEmbedEndpoint('http://a.com/oembed.{format}')
+        opt = {'format': 'json', 'maxwidth': 100}
+        parts = urlsplit(endpoint.request('http://a.com/1', **opt))
+        self.assertEqual(parts.path, '/oembed.json')
+        self.assertEqual(dict(parse_qsl(parts.query)),
+                         {'maxwidth': '100', 'url': 'http://a.com/1'})
+        self.assertEqual(opt, {'format': 'json', 'maxwidth': 100})
+
+
+class ReloadStressTest(unittest.TestCase):
+    threads = 8
+    duration = 1.0
+
+    def setUp(self):
+        self.provider = StubProvider()
+        self.providers = [
+            {'provider_name': 'Example',
+             'endpoints': [{'url': self.provider.url,
+                            'schemes': ['http://example.com/*']}]},
+            {'provider_name': 'Other',
+             'endpoints': [{'url': self.provider.url,
+                            'schemes': ['http://other.com/*',
+                                        'http://*.other.com/*']}]}]
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testEmbedDuringReloads(self):
+        consumer = oembed.OEmbedConsumer()
+        consumer.loadProviders(self.providers)
+        extra = oembed.OEmbedEndpoint(self.provider.url)
+        consumer.addEndpoint(extra)
+        stop = threading.Event()
+        lock = threading.Lock()
+        errors = []
+        counts = []
+
+        def embed(worker):
+            count = 0
+            opt = {'maxwidth': 100 + worker}
+            while not stop.is_set():
+                for url in ('http://example.com/%d' % count,
+                            'http://www.other.com/%d' % count):
+                    try:
+                        response = consumer.embed(url, **opt)
+                        if response['url'] != url or \
+                           response['width'] != 100 + worker:
+                            raise AssertionError(response.getData())
+                    except Exception as e:
+                        with lock:
+                            errors.append((url, e))
+                    count += 1
+            with lock:
+                counts.append(count)
+
+        workers = [threading.Thread(target=embed, args=(i,))
+                   for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        reloads = 0
+        end = time.time() + self.duration
+        try:
+            while time.time() < end:
+                consumer.loadProviders(self.providers, replace=True)
+                consumer.addEndpoint(extra)
+                extra.addUrlScheme('http://third.com/*')
+                extra.delUrlScheme('http://third.com/*')
+                reloads += 1
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(counts), self.threads)
+        self.assertTrue(min(counts) > 0)
+        self.assertTrue(reloads > 10)
+        self.assertEqual(len(consumer.getEndpoints()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
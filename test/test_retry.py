@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+
+import oembed
+from stubserver import StubProvider, photo
+
+try:
+    import urllib.request as urllib2 # Python 3
+except ImportError:
+    import urllib2 # Python 2
+
+
+class Flaky(object):
+    '''A responder failing with a status a number of times.'''
+
+    def __init__(self, failures, status=503, delay=0):
+        self.failures = failures
+        self.status = status
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def __call__(self, query):
+        with self.lock:
+            failing = self.failures > 0
+            self.failures -= 1
+        if failing:
+            time.sleep(self.delay)
+            return self.status, {}, 'Unavailable'
+        return photo(query)
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.pool = oembed.OEmbedConnectionPool()
+        self.endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                              ['http://example.com/*'])
+        self.endpoint.setConnectionPool(self.pool)
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(self.endpoint)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.provider.stop()
+
+    def testTimeout(self):
+        self.provider.setResponder(Flaky(1, delay=0.5))
+        self.endpoint.setTimeout(1, 0.1)
+        start = time.time()
+        self.assertRaises(urllib2.URLError, self.consumer.embed,
+                          'http://example.com/1')
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(len(self.provider.requests), 1)
+
+    def testRetries(self):
+        self.provider.setResponder(Flaky(2))
+        self.endpoint.setRetries(2, backoff=0.01)
+        self.assertEqual(self.consumer.embed('http://example.com/1')['url'],
+                         'http://example.com/1')
+        self.assertEqual(len(self.provider.requests), 3)
+
+        self.provider.setResponder(Flaky(2))
+        self.endpoint.setRetries(1, backoff=0.01)
+        self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                          'http://example.com/2')
+
+    def testNoRetry(self):
+        self.provider.setResponder(Flaky(1, status=404))
+        self.endpoint.setRetries(3, backoff=0.01)
+        self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                          'http://example.com/1')
+        self.assertEqual(len(self.provider.requests), 1)
+
+    def testPermanentErrors(self):
+        breaker = oembed.OEmbedCircuitBreaker(failureThreshold=1)
+        self.endpoint.setRetries(3, backoff=0.5)
+        self.endpoint.setCircuitBreaker(breaker)
+        for url in ('ftp://%s/oembed' % self.provider.base[7:],
+                    'http://unknown.invalid/oembed'):
+            start = time.time()
+            self.assertRaises(urllib2.URLError, self.endpoint.fetch, url)
+            self.assertTrue(time.time() - start < 0.5)
+        self.assertFalse(breaker.isOpen())
+
+    def testConnectionRefused(self):
+        self.provider.stop()
+        self.endpoint.setRetries(1, backoff=0.01)
+        self.endpoint.setCircuitBreaker(
+            oembed.OEmbedCircuitBreaker(failureThreshold=1))
+        self.assertRaises(urllib2.URLError, self.consumer.embed,
+                          'http://example.com/1')
+        self.assertTrue(self.endpoint.getCircuitBreaker().isOpen())
+        self.provider = StubProvider()
+
+    def testCircuitBreaker(self):
+        breaker = oembed.OEmbedCircuitBreaker(failureThreshold=2,
+                                              resetTimeout=0.2)
+        self.endpoint.setCircuitBreaker(breaker)
+        self.provider.setResponder(Flaky(100))
+        for i in range(2):
+            self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                              'http://example.com/%d' % i)
+        self.assertTrue(breaker.isOpen())
+        self.assertRaises(oembed.OEmbedProviderUnavailable,
+                          self.consumer.embed, 'http://example.com/3')
+        self.assertEqual(len(self.provider.requests), 2)
+
+        # A failed probe keeps the circuit open.
+        time.sleep(0.25)
+        self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                          'http://example.com/4')
+        self.assertRaises(oembed.OEmbedProviderUnavailable,
+                          self.consumer.embed, 'http://example.com/5')
+
+        time.sleep(0.25)
+        self.provider.setResponder(photo)
+        self.consumer.embed('http://example.com/6')
+        self.assertFalse(breaker.isOpen())
+
+    def testClientErrors(self):
+        breaker = oembed.OEmbedCircuitBreaker(failureThreshold=1)
+        self.endpoint.setCircuitBreaker(breaker)
+        self.provider.setResponder(Flaky(5, status=404))
+        for i in range(3):
+            self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                              'http://example.com/%d' % i)
+        self.assertFalse(breaker.isOpen())
+
+
+if __name__ == '__main__':
+    unittest.main()
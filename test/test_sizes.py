@@ -0,0 +1,127 @@
+import json
+import unittest
+
+import oembed
+from stubserver import StubProvider, photo
+
+
+def video(query):
+    width = min(int(query.get('maxwidth', 1280)), 1280)
+    height = width * 9 // 16
+    return 200, {'Content-Type': 'application/json'}, json.dumps(
+        {'type': 'video', 'version': '1.0', 'width': width, 'height': height,
+         'html': '<iframe width="%d" height="%d" src="/v" frameborder="0">'
+                 '</iframe>' % (width, height)})
+
+
+class SizeBucketsTest(unittest.TestCase):
+    def setUp(self):
+        self.buckets = oembed.OEmbedSizeBuckets(widths=(320, 640, 1280),
+                                                heights=(360, 720))
+
+    def testRound(self):
+        self.assertEqual(self.buckets.round({'maxwidth': 700,
+                                             'maxheight': '400',
+                                             'format': 'json'}),
+                         {'maxwidth': 640, 'maxheight': 360,
+                          'format': 'json'})
+        self.assertEqual(self.buckets.round({'maxwidth': 1280}),
+                         {'maxwidth': 1280})
+        self.assertEqual(self.buckets.round({'maxwidth': 100}),
+                         {'maxwidth': 100})
+        self.assertEqual(self.buckets.round({'maxwidth': 'wide'}),
+                         {'maxwidth': 'wide'})
+
+    def testVariants(self):
+        self.assertEqual(self.buckets.variants({'maxwidth': 320}),
+                         [{'maxwidth': 640}, {'maxwidth': 1280}])
+        self.assertEqual(self.buckets.variants({'maxwidth': 640,
+                                                'maxheight': 360}),
+                         [{'maxwidth': 640, 'maxheight': 720},
+                          {'maxwidth': 1280, 'maxheight': 360},
+                          {'maxwidth': 1280, 'maxheight': 720}])
+        self.assertEqual(self.buckets.variants({'format': 'json'}), [])
+        self.assertEqual(oembed.OEmbedSizeBuckets()
+                         .variants({'maxwidth': 100, 'maxheight': 100}),
+                         [{'maxwidth': 100, 'maxheight': 160},
+                          {'maxwidth': 160, 'maxheight': 100},
+                          {'maxwidth': 160, 'maxheight': 160},
+                          {'maxwidth': 100, 'maxheight': 240}])
+        self.assertEqual(oembed.OEmbedSizeBuckets(scale=False)
+                         .variants({'maxwidth': 320}), [])
+
+    def testScale(self):
+        response = oembed.OEmbedResponse.newFromJSON(
+            video({'maxwidth': '1280'})[2])
+        scaled = self.buckets.scale(response, {'maxwidth': 640})
+        self.assertEqual((scaled['width'], scaled['height']), (640, 360))
+        self.assertEqual(scaled['html'], '<iframe width="640" height="360" '
+                         'src="/v" frameborder="0"></iframe>')
+        scaled = self.buckets.scale(response, {'maxwidth': 1280,
+                                               'maxheight': 360})
+        self.assertEqual((scaled['width'], scaled['height']), (640, 360))
+        self.assertTrue(self.buckets.scale(response, {'maxwidth': 1280})
+                        is response)
+
+        rich = oembed.OEmbedResponse.createLoad(
+            {'type': 'rich', 'version': '1.0', 'html': '<div></div>',
+             'width': 1280, 'height': 720})
+        self.assertEqual(self.buckets.scale(rich, {'maxwidth': 640}), None)
+
+
+class ConsumerSizeBucketsTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider(video)
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(
+            self.provider.url, ['http://example.com/*']))
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+        self.consumer.setSizeBuckets(oembed.OEmbedSizeBuckets(
+            widths=(320, 640, 1280)))
+        self.outcomes = []
+        self.consumer.addObserver(
+            lambda timing: self.outcomes.append(timing.tags['outcome']))
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testBuckets(self):
+        url = 'http://example.com/video'
+        for width in (650, 700, 1000):
+            self.assertEqual(self.consumer.embed(url, maxwidth=width)['width'],
+                             640)
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertTrue('maxwidth=640' in self.provider.requests[0])
+        self.assertEqual(self.outcomes, ['fetch', 'hit', 'hit'])
+
+    def testScaledFromLarger(self):
+        url = 'http://example.com/video'
+        self.consumer.embed(url, maxwidth=1280)
+        response = self.consumer.embed(url, maxwidth=400)
+        self.assertEqual((response['width'], response['height']), (320, 180))
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertEqual(self.outcomes, ['fetch', 'scaled'])
+
+    def testRichNotScaled(self):
+        self.provider.setResponder(
+            lambda query: (200, {'Content-Type': 'application/json'},
+                           json.dumps({'type': 'rich', 'version': '1.0',
+                                       'html': '<div></div>',
+                                       'width': int(query['maxwidth']),
+                                       'height': 100})))
+        url = 'http://example.com/rich'
+        self.consumer.embed(url, maxwidth=1280)
+        self.assertEqual(self.consumer.embed(url, maxwidth=400)['width'], 320)
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testNoBuckets(self):
+        self.consumer.setSizeBuckets(None)
+        self.provider.setResponder(photo)
+        url = 'http://example.com/photo'
+        self.consumer.embed(url, maxwidth=650)
+        self.consumer.embed(url, maxwidth=700)
+        self.assertEqual(len(self.provider.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+import oembed
+from stubserver import StubProvider
+
+try:
+    import urllib.request as urllib2 # Python 3
+except ImportError:
+    import urllib2 # Python 2
+
+
+class TimingTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.consumer = oembed.OEmbedConsumer()
+        self.consumer.addEndpoint(oembed.OEmbedEndpoint(self.provider.url,
+                                  ['http://example.com/*']))
+        self.timings = []
+        self.consumer.addObserver(self.timings.append)
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def testPhases(self):
+        self.consumer.setCache(oembed.OEmbedMemoryCache())
+        self.consumer.embed('http://example.com/1')
+        self.consumer.embed('http://example.com/1')
+
+        fetched, cached = self.timings
+        self.assertEqual(sorted(fetched.phases),
+                         ['decode', 'match', 'network', 'parse', 'request'])
+        self.assertEqual(fetched.tags['outcome'], 'fetch')
+        self.assertEqual(fetched.tags['endpoint'], self.provider.url)
+        self.assertEqual(fetched.tags['mimeType'], 'application/json')
+        self.assertTrue(fetched.bytesRead > 0)
+        self.assertTrue(fetched.total >= sum(fetched.phases.values()))
+
+        self.assertEqual(cached.tags['outcome'], 'hit')
+        self.assertEqual(sorted(cached.phases), ['match'])
+
+    def testErrors(self):
+        self.provider.setResponder(lambda query: (404, {}, 'Not Found'))
+        self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                          'http://example.com/1')
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed,
+                          'http://other.com/1')
+        self.assertEqual([t.tags['error'] for t in self.timings],
+                         ['HTTPError', 'OEmbedNoEndpoint'])
+
+        self.consumer.delObserver(self.timings.append)
+        self.assertRaises(oembed.OEmbedNoEndpoint, self.consumer.embed,
+                          'http://other.com/1')
+        self.assertEqual(len(self.timings), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import unittest
+import zlib
+
+import oembed
+from stubserver import StubProvider, photo
+
+try:
+    import urllib.request as urllib2 # Python 3
+except ImportError:
+    import urllib2 # Python 2
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = StubProvider()
+        self.pool = oembed.OEmbedConnectionPool(maxConnections=4)
+        self.consumer = oembed.OEmbedConsumer()
+        for i in range(2):
+            endpoint = oembed.OEmbedEndpoint(self.provider.url,
+                                             ['http://example%d.com/*' % i])
+            endpoint.setConnectionPool(self.pool)
+            self.consumer.addEndpoint(endpoint)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.provider.stop()
+
+    def testReuse(self):
+        for i in range(10):
+            response = self.consumer.embed('http://example%d.com/%d' %
+                                           (i % 2, i))
+            self.assertEqual(response['url'], 'http://example%d.com/%d' %
+                                              (i % 2, i))
+        self.assertEqual(len(self.provider.requests), 10)
+        self.assertEqual(self.provider.connections, 1)
+
+    def testThreads(self):
+        errors = []
+
+        def run(n):
+            try:
+                for i in range(20):
+                    self.consumer.embed('http://example0.com/%d/%d' % (n, i))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.provider.requests), 80)
+        self.assertTrue(self.provider.connections <= 4)
+
+    def testHTTPError(self):
+        self.provider.setResponder(lambda query: (404, {}, 'Not Found'))
+        self.assertRaises(urllib2.HTTPError, self.consumer.embed,
+                          'http://example0.com/missing')
+        self.provider.setResponder(photo)
+        self.consumer.embed('http://example0.com/1')
+        self.assertEqual(self.provider.connections, 1)
+
+    def testLargeErrorBody(self):
+        self.provider.setResponder(
+            lambda query: (404, {}, 'x' * (1024 * 1024)))
+        self.consumer.getEndpoints()[0].setMaxResponseSize(64 * 1024)
+        try:
+            self.consumer.embed('http://example0.com/missing')
+            self.fail('HTTPError not raised')
+        except urllib2.HTTPError as e:
+            self.assertEqual(e.code, 404)
+            self.assertEqual(len(e.read()), 64 * 1024)
+        # The rest of the body is not read: the connection is closed.
+        self.provider.setResponder(photo)
+        self.consumer.embed('http://example0.com/1')
+        self.assertEqual(self.provider.connections, 2)
+
+    def testRedirect(self):
+        def responder(query):
+            if 'moved' not in query:
+                return 301, {'Location': '?moved=1&url=' + query['url']}, ''
+            return photo(query)
+        self.provider.setResponder(responder)
+        response = self.consumer.embed('http://example0.com/1')
+        self.assertEqual(response['url'], 'http://example0.com/1')
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def testProxy(self):
+        environ = dict(os.environ)
+        try:
+            # The provider plays the proxy of an unresolvable api host.
+            os.environ['http_proxy'] = self.provider.base
+            os.environ.pop('no_proxy', None)
+            os.environ.pop('NO_PROXY', None)
+            # The proxies are read when the pool is created.
+            pool = oembed.OEmbedConnectionPool()
+            endpoint = oembed.OEmbedEndpoint('http://provider.invalid/oembed',
+                                             ['http://proxied.com/*'])
+            endpoint.setConnectionPool(pool)
+            self.consumer.addEndpoint(endpoint)
+            self.consumer.embed('http://example0.com/1')
+            response = self.consumer.embed('http://proxied.com/1')
+            self.assertEqual(response['url'], 'http://proxied.com/1')
+            self.assertTrue(self.provider.requests[0].startswith('/'))
+            self.assertTrue(self.provider.requests[1].startswith(
+                'http://provider.invalid/oembed?'))
+
+            # Hosts listed in no_proxy keep using the pool.
+            os.environ['no_proxy'] = '127.0.0.1'
+            self.consumer.getEndpoints()[0].setConnectionPool(
+                oembed.OEmbedConnectionPool())
+            self.consumer.embed('http://example0.com/2')
+            self.assertTrue(self.provider.requests[2].startswith('/'))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def testMaxResponseSize(self):
+        body = '{"type": "link", "version": "1.0", "title": "%s"}' % ('x' * 5000)
+        self.provider.setResponder(
+            lambda query: (200, {'Content-Type': 'application/json'}, body))
+        endpoint = self.consumer.getEndpoints()[0]
+        endpoint.setMaxResponseSize(1000)
+        self.assertRaises(oembed.OEmbedResponseTooLarge, self.consumer.embed,
+                          'http://example0.com/1')
+        endpoint.setMaxResponseSize(None)
+        self.assertEqual(len(self.consumer.embed('http://example0.com/1')
+                             ['title']), 5000)
+
+    def testCompression(self):
+        data = json.dumps({'type': 'rich', 'version': '1.0', 'html': 'x' * 5000,
+                           'width': 1, 'height': 1}).encode('utf8')
+        gzip = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        bodies = {'gzip': gzip.compress(data) + gzip.flush(),
+                  'deflate': zlib.compress(data),
+                  'raw': raw.compress(data) + raw.flush()}
+        for name, body in bodies.items():
+            encoding = 'gzip' if name == 'gzip' else 'deflate'
+            self.provider.setResponder(
+                lambda query: (200, {'Content-Type': 'application/json',
+                                     'Content-Encoding': encoding}, body))
+            response = self.consumer.embed('http://example0.com/%s' % name)
+            self.assertEqual(len(response['html']), 5000)
+        self.assertTrue(len(bodies['gzip']) < 1000)
+
+    def testCompressionBomb(self):
+        body = zlib.compress(b' ' * (10 * 1024 * 1024))
+        self.provider.setResponder(
+            lambda query: (200, {'Content-Type': 'application/json',
+                                 'Content-Encoding': 'deflate'}, body))
+        self.assertRaises(oembed.OEmbedResponseTooLarge, self.consumer.embed,
+                          'http://example0.com/bomb')
+
+        self.provider.setResponder(
+            lambda query: (200, {'Content-Type': 'application/json',
+                                 'Content-Encoding': 'gzip'}, b'garbage'))
+        self.assertRaises(oembed.OEmbedError, self.consumer.embed,
+                          'http://example0.com/garbage')
+
+    def testReadChunks(self):
+        class Response(object):
+            def __init__(self):
+                self.reads = 0
+
+            def info(self):
+                return {}
+
+            def read(self, size):
+                self.reads += 1
+                return b'x' * size
+
+        endpoint = self.consumer.getEndpoints()[0]
+        endpoint.setMaxResponseSize(100000)
+        response = Response()
+        self.assertRaises(oembed.OEmbedResponseTooLarge, list,
+                          endpoint._readChunks(response))
+        self.assertTrue(response.reads < 10)
+
+
+if __name__ == '__main__':
+    unittest.main()